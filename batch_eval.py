@@ -0,0 +1,118 @@
+# batch_eval.py
+"""
+离线批量评测：读取 JSONL 查询文件，批量检索历史证据，并发调用大模型，
+每完成一条就把结果写入输出 JSONL。
+
+用法:
+    python batch_eval.py queries.jsonl results.jsonl --concurrency 16 --rate-limit 10
+    python batch_eval.py requests.jsonl results.jsonl --query-field body --id-field request_id
+
+输入每行一个 JSON 对象，查询文本取 --query-field 字段；
+若包含 session_id 字段，还会带上该会话最近 --recent-n 轮作为短期记忆。
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from main import bootstrap, build_llm_client
+from src.llm_client import generate_many
+from src.prompts import build_prompt, get_evidence
+
+
+def load_queries(path: str, query_field: str, id_field: str) -> list:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip(): continue
+            record = json.loads(line)
+            if query_field not in record:
+                print(f"Warn: line {line_no} has no '{query_field}' field, skipped.")
+                continue
+            records.append({
+                "id": record.get(id_field, line_no),
+                "query": record[query_field],
+                "session_id": record.get("session_id"),
+            })
+    return records
+
+
+def build_prompts(cfg, history_store, records: list, batch_size: int, recent_n: int) -> list:
+    """分批检索：每批查询一次批量编码后搜索，再组装证据和 Prompt"""
+    rag_cfg = cfg.get("rag", {})
+    system_role = cfg.get("llm", {}).get("system_role", "助理")
+    top_k = rag_cfg.get("top_k", 5)
+    threshold = rag_cfg.get("similarity_threshold", 0.5)
+
+    prompts = []
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        semantic = history_store.search_history_batch([r["query"] for r in batch], top_k, threshold)
+        for record, hits in zip(batch, semantic):
+            evidence = get_evidence(
+                history_store, record["session_id"], record["query"],
+                recent_n=recent_n if record["session_id"] else 0,
+                semantic_results=hits,
+                packing=rag_cfg.get("packing"),
+            )
+            record["evidence_turns"] = [turn_id for turn_id, _ in hits]
+            prompts.append(build_prompt(system_role, record["query"], evidence))
+        print(f"Retrieved evidence for {min(start + batch_size, len(records))}/{len(records)} queries.")
+    return prompts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="查询 JSONL 文件")
+    parser.add_argument("output", help="结果 JSONL 文件")
+    parser.add_argument("--query-field", default="query")
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的请求数")
+    parser.add_argument("--rate-limit", type=float, default=None, help="每秒最多发出的请求数")
+    parser.add_argument("--retrieval-batch", type=int, default=64, help="每批检索的查询数")
+    parser.add_argument("--recent-n", type=int, default=2)
+    args = parser.parse_args()
+
+    cfg, llm, history_store = bootstrap()
+    if history_store is None:
+        raise SystemExit("HistoryStore failed to initialize.")
+    # 连接池大小与并发数一致，所有请求复用长连接
+    llm.close()
+    llm = build_llm_client(cfg, pool_size=args.concurrency)
+
+    records = load_queries(args.input, args.query_field, args.id_field)
+    try:
+        prompts = build_prompts(cfg, history_store, records, args.retrieval_batch, args.recent_n)
+    finally:
+        history_store.close()
+
+    start_time = time.perf_counter()
+    done = {"ok": 0, "failed": 0}
+    with open(args.output, "w", encoding="utf-8") as out:
+        def write_result(i, result):
+            record = {"id": records[i]["id"], "query": records[i]["query"],
+                      "evidence_turns": records[i]["evidence_turns"]}
+            if isinstance(result, Exception):
+                record["error"] = str(result)
+                done["failed"] += 1
+            else:
+                record["answer"] = result
+                done["ok"] += 1
+            record["elapsed_s"] = round(time.perf_counter() - start_time, 3)
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+
+        asyncio.run(generate_many(
+            llm, prompts, concurrency=args.concurrency, rate_limit=args.rate_limit,
+            temperature=cfg.get("llm", {}).get("temperature", 0.7), on_result=write_result,
+        ))
+    llm.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Finished {done['ok']} queries ({done['failed']} failed) in {elapsed:.1f}s "
+          f"({len(records) / max(elapsed, 1e-9):.2f} queries/s).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# benchmarks/embedding_backends.py
+"""
+对比不同嵌入后端 (torch fp32 / int8 / onnx) 的冷启动时间与单条查询编码延迟。
+
+用法:
+    python -m benchmarks.embedding_backends --backends torch int8 onnx --queries 200
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from src.embedding_utils import EmbeddingClient
+
+SAMPLE_QUERIES = [
+    "我上次说的项目截止日期是哪天？",
+    "帮我回忆一下第一轮对话里提到的数据库路径",
+    "What was the name of the function we refactored yesterday?",
+    "FAISS 的 IndexFlatIP 和 HNSW 有什么区别",
+    "请总结一下我们之前关于向量检索的讨论",
+    "config.yaml 里的 similarity_threshold 设置为多少比较合适",
+    "How do I rebuild the history index after a crash?",
+    "你还记得我喜欢的编程语言吗",
+]
+
+# 在全新的子进程中测量：导入 + 加载模型 + 第一次编码
+_COLD_START_SNIPPET = """
+import time
+t0 = time.perf_counter()
+from src.embedding_utils import EmbeddingClient
+client = EmbeddingClient(backend={backend!r}, onnx_file={onnx_file!r})
+t1 = time.perf_counter()
+client.get_embedding("warm up")
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t0)
+"""
+
+_TOOL_IMPORT_SNIPPET = """
+import time
+t0 = time.perf_counter()
+import src.history_store
+print(time.perf_counter() - t0)
+"""
+
+
+def _run_snippet(snippet: str) -> List[float]:
+    out = subprocess.run(
+        [sys.executable, "-c", snippet], capture_output=True, text=True, check=True
+    ).stdout.strip().splitlines()[-1]
+    return [float(x) for x in out.split()]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def bench_backend(backend: str, n_queries: int, onnx_file=None) -> Dict:
+    construct_s, first_encode_s = _run_snippet(
+        _COLD_START_SNIPPET.format(backend=backend, onnx_file=onnx_file)
+    )
+
+    client = EmbeddingClient(backend=backend, onnx_file=onnx_file)
+    client.warmup(background=False)
+    if client.model is None:
+        return {"backend": backend, "error": "model failed to load"}
+
+    queries = [SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)] + f" #{i}" for i in range(n_queries)]
+    latencies = []
+    vectors = []
+    for query in queries:
+        t0 = time.perf_counter()
+        vectors.append(client.get_embedding(query))
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+
+    return {
+        "backend": backend,
+        "import_and_construct_s": construct_s,
+        "cold_start_s": first_encode_s,
+        "encode_ms_p50": _percentile(latencies, 50),
+        "encode_ms_p95": _percentile(latencies, 95),
+        "encode_ms_mean": float(np.mean(latencies)),
+        "vectors": np.stack(vectors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "int8", "onnx"])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--onnx-file", default=None)
+    parser.add_argument("--output", default=None, help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    tool_import_s = _run_snippet(_TOOL_IMPORT_SNIPPET)[0]
+    print(f"import src.history_store (tooling cold start): {tool_import_s:.3f}s")
+
+    results = []
+    baseline = None
+    for backend in args.backends:
+        res = bench_backend(backend, args.queries, args.onnx_file if backend == "onnx" else None)
+        vectors = res.pop("vectors", None)
+        if vectors is not None:
+            normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+            if baseline is None:
+                baseline = normed
+            # 与第一个后端 (通常为 fp32) 输出的平均余弦相似度
+            res["cosine_vs_first"] = float(np.mean(np.sum(normed * baseline, axis=1)))
+        results.append(res)
+
+    print(f"\n{'backend':<8}{'cold(s)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'cos':>8}")
+    for res in results:
+        if "error" in res:
+            print(f"{res['backend']:<8}  {res['error']}")
+            continue
+        print(
+            f"{res['backend']:<8}{res['cold_start_s']:>10.3f}{res['encode_ms_p50']:>10.2f}"
+            f"{res['encode_ms_p95']:>10.2f}{res['cosine_vs_first']:>8.4f}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"tool_import_s": tool_import_s, "backends": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# benchmarks/memory_pipeline.py
+"""
+记忆流水线基准测试：生成多会话的合成对话，测量 HistoryStore 与 get_evidence 随历史规模增长的表现。
+
+报告 save_turn 延迟、search_history_index p50/p99、证据组装耗时、全量重建耗时、
+RSS 与磁盘占用。每个规模在独立子进程中运行 (RSS 互不影响)，结果写为 JSON 以便跨提交对比。
+
+用法:
+    python -m benchmarks.memory_pipeline --scales 10000 100000 --output bench.json
+    python -m benchmarks.memory_pipeline --scales 1000000 --skip-rebuild --index-type hnsw
+    python -m benchmarks.memory_pipeline --scales 10000 --embedder model   # 使用真实嵌入模型
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+
+TOPICS = [
+    ("python", "装饰器 生成器 asyncio typing 打包 虚拟环境"),
+    ("database", "sqlite 索引 事务 WAL 查询计划 迁移"),
+    ("travel", "机票 酒店 签证 行程 预算 东京"),
+    ("cooking", "菜谱 火候 调料 烘焙 面团 发酵"),
+    ("fitness", "跑步 力量训练 心率 拉伸 蛋白质 睡眠"),
+    ("finance", "预算 基金 利率 还款 保险 报税"),
+    ("music", "吉他 和弦 节奏 录音 混音 乐理"),
+    ("career", "面试 简历 绩效 晋升 跳槽 薪资"),
+    ("vectors", "faiss embedding 召回 相似度 量化 hnsw"),
+    ("pets", "猫粮 疫苗 驱虫 训练 绝育 宠物医院"),
+]
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p99": 0.0, "mean": 0.0}
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(np.mean(values)),
+    }
+
+
+def synthetic_turn(rng: np.random.Generator, topic_id: int, turn_number: int):
+    """生成一轮 (user, assistant) 文本：同一主题的对话共享关键词"""
+    name, words = TOPICS[topic_id]
+    words = words.split()
+    picked = " ".join(rng.choice(words, size=3))
+    user = f"关于 {name} 的问题 {picked} 第{turn_number}轮 ref{rng.integers(1_000_000)}"
+    assistant = f"{name} 建议: {picked} 详细说明 {rng.integers(1_000_000)}"
+    return user, assistant
+
+
+def bulk_load(store, n_turns: int, turns_per_session: int, seed: int) -> List[str]:
+    """直接批量写入 SQLite (绕过逐轮 save_turn)，返回会话 id 列表"""
+    rng = np.random.default_rng(seed)
+    base_time = time.time() - n_turns * 2.0
+    sessions = []
+    rows = []
+    session_rows = []
+    conn = store.db.connection()
+    for i in range(n_turns):
+        turn_number = i % turns_per_session + 1
+        if turn_number == 1:
+            session_id = f"bench_{i // turns_per_session:08d}"
+            sessions.append(session_id)
+            topic_id = int(rng.integers(len(TOPICS)))
+            session_rows.append((session_id, base_time + i * 2.0,
+                                 datetime.fromtimestamp(base_time + i * 2.0).strftime('%Y-%m-%d %H:%M:%S'),
+                                 base_time + i * 2.0, turns_per_session))
+        ts = base_time + i * 2.0
+        created_at = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+        user, assistant = synthetic_turn(rng, topic_id, turn_number)
+        rows.append((session_id, turn_number, "user", user, ts, created_at))
+        rows.append((session_id, turn_number, "assistant", assistant, ts + 0.001, created_at))
+        if len(rows) >= 20000 or i == n_turns - 1:
+            with store.db.transaction():
+                conn.executemany(
+                    "INSERT INTO sessions (session_id, start_time, start_time_str, last_update, total_turns) VALUES (?, ?, ?, ?, ?)",
+                    session_rows,
+                )
+                conn.executemany(
+                    "INSERT INTO conversation_history (session_id, turn_number, role, content, timestamp, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+            rows, session_rows = [], []
+    return sessions
+
+
+def _dir_size(path: str) -> Dict[str, int]:
+    sizes = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            sizes[os.path.relpath(full, path)] = os.path.getsize(full)
+    return sizes
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def _two_stage_quality(store, queries: List[str], top_k: int) -> Dict[str, float]:
+    """
+    两阶段检索与全量搜索的对比 (只比较语义检索，关闭缓存和全文索引)：
+    recall 为结果轮次的重合比例；score_ratio 为两者 top_k 平均相似度之比
+    (合成数据中同主题的对话相似度几乎相同，重合比例会低估实际效果)。
+    """
+    saved = (store.retrieval_cache.config["enabled"], store.lexical_config["enabled"])
+    store.retrieval_cache.config["enabled"] = store.lexical_config["enabled"] = False
+    overlap, total, coarse_score, full_score = 0, 0, 0.0, 0.0
+    for query in queries:
+        coarse = store.search_history_index(query, top_k=top_k)
+        store.summary_config["two_stage"] = False
+        full = store.search_history_index(query, top_k=top_k)
+        store.summary_config["two_stage"] = True
+        overlap += len({turn_id for turn_id, _ in coarse} & {turn_id for turn_id, _ in full})
+        total += len(full)
+        coarse_score += sum(score for _, score in coarse)
+        full_score += sum(score for _, score in full)
+    store.retrieval_cache.config["enabled"], store.lexical_config["enabled"] = saved
+    return {"recall": overlap / total if total else 1.0,
+            "score_ratio": coarse_score / full_score if full_score else 1.0}
+
+
+def run_scale(args) -> Dict:
+    """在当前进程中运行单个规模"""
+    from src.embedding_utils import EMBEDDING_CLIENT
+    if args.embedder == "stub":
+        from benchmarks.stub_embedder import StubEmbeddingModel
+        EMBEDDING_CLIENT.set_model(StubEmbeddingModel())
+    else:
+        EMBEDDING_CLIENT.configure(backend=args.backend)
+        EMBEDDING_CLIENT.warmup(background=False)
+    from src.history_store import HistoryStore
+    from src.prompts import get_evidence
+
+    workdir = os.path.join(args.workdir, f"n{args.scale}")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    result = {"turns": args.scale, "index_type": args.index_type, "embedder": args.embedder}
+
+    store = HistoryStore(
+        os.path.join(workdir, "conversation_history.db"), workdir,
+        index_config={"type": args.index_type, "train_threshold": args.train_threshold},
+        lexical_config={"enabled": not args.no_lexical},
+        retrieval_cache_config={"enabled": not args.no_retrieval_cache},
+        summary_config={"two_stage": not args.no_two_stage, "min_vectors": args.two_stage_min_vectors},
+    )
+
+    t0 = time.perf_counter()
+    sessions = bulk_load(store, args.scale, args.turns_per_session, args.seed)
+    result["bulk_insert_s"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    store.sync_index()
+    result["initial_index_s"] = time.perf_counter() - t0
+    result["vectors"] = int(store.index.ntotal)
+
+    t0 = time.perf_counter()
+    store.consolidate_sessions()
+    result["consolidate_s"] = time.perf_counter() - t0
+
+    # save_turn：在新会话中逐轮写入
+    rng = np.random.default_rng(args.seed + 1)
+    live_session = store.start_session()
+    save_ms = []
+    for turn_number in range(1, args.save_turns + 1):
+        user, assistant = synthetic_turn(rng, int(rng.integers(len(TOPICS))), turn_number)
+        t0 = time.perf_counter()
+        store.save_turn(live_session, turn_number, user, assistant)
+        save_ms.append((time.perf_counter() - t0) * 1000.0)
+    result["save_turn_ms"] = _percentiles(save_ms)
+
+    # 查询：与历史对话同分布的新问题，其中一部分询问历史中出现过的精确编号 (refNNNNNN)
+    queries = [
+        synthetic_turn(rng, int(rng.integers(len(TOPICS))), int(rng.integers(1, args.turns_per_session + 1)))[0]
+        for _ in range(args.queries)
+    ]
+    n_exact = int(args.queries * args.exact_queries)
+    sampled = store.db.connection().execute(
+        "SELECT content FROM conversation_history WHERE role = 'user' ORDER BY random() LIMIT ?", (n_exact,)
+    ).fetchall()
+    for i, (content,) in enumerate(sampled):
+        ref = re.search(r"ref\d+", content)
+        if ref:
+            queries[i] = f"我之前提到的 {ref.group(0)} 是什么"
+    store.search_history_index(queries[-1], top_k=args.top_k)
+    search_ms, fast_ms, embedded_ms = [], [], []
+    stats_before = dict(store.search_stats)
+    for query in queries:
+        fast_before = store.search_stats["fast_path"]
+        t0 = time.perf_counter()
+        store.search_history_index(query, top_k=args.top_k)
+        elapsed = (time.perf_counter() - t0) * 1000.0
+        search_ms.append(elapsed)
+        (fast_ms if store.search_stats["fast_path"] > fast_before else embedded_ms).append(elapsed)
+    result["search_ms"] = _percentiles(search_ms)
+    result["search_ms_fast_path"] = _percentiles(fast_ms)
+    result["search_ms_embedded"] = _percentiles(embedded_ms)
+    # 全文索引快速路径省下的查询编码次数
+    result["embedding_calls_saved"] = store.search_stats["fast_path"] - stats_before["fast_path"]
+    result["two_stage_searches"] = store.search_stats["two_stage"] - stats_before["two_stage"]
+    if result["two_stage_searches"]:
+        result["two_stage_quality"] = _two_stage_quality(store, queries, args.top_k)
+
+    # 重复提问：每次重问前追加一轮新对话 (与对话中的情形一致)，缓存条目需要增量补搜
+    repeat_ms = []
+    for turn_number, query in enumerate(queries, args.save_turns + 1):
+        user, assistant = synthetic_turn(rng, int(rng.integers(len(TOPICS))), turn_number)
+        store.save_turn(live_session, turn_number, user, assistant)
+        t0 = time.perf_counter()
+        store.search_history_index(query, top_k=args.top_k)
+        repeat_ms.append((time.perf_counter() - t0) * 1000.0)
+    result["search_ms_repeat"] = _percentiles(repeat_ms)
+    result["retrieval_cache"] = dict(store.retrieval_cache.stats, hit_rate=store.retrieval_cache.hit_rate)
+    # 证据组装测量未命中缓存时的耗时
+    store.retrieval_cache.clear()
+
+    evidence_ms = []
+    for i, query in enumerate(queries):
+        session_id = sessions[i % len(sessions)] if i % 2 else live_session
+        t0 = time.perf_counter()
+        get_evidence(store, session_id, query, top_k=args.top_k, similarity_threshold=0.0)
+        evidence_ms.append((time.perf_counter() - t0) * 1000.0)
+    result["evidence_ms"] = _percentiles(evidence_ms)
+
+    if not args.skip_rebuild:
+        t0 = time.perf_counter()
+        store.rebuild_faiss_index()
+        result["rebuild_s"] = time.perf_counter() - t0
+
+    result["rss_mb"] = _current_rss_mb()
+    # ru_maxrss 在 Linux 上以 KiB 为单位
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    store.close()
+    files = _dir_size(workdir)
+    result["disk_bytes"] = sum(files.values())
+    result["disk_files"] = files
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000], help="总轮数 (可多个)")
+    parser.add_argument("--turns-per-session", type=int, default=50)
+    parser.add_argument("--embedder", choices=["stub", "model"], default="stub")
+    parser.add_argument("--backend", default="torch", help="--embedder model 时使用的后端")
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--train-threshold", type=int, default=20000)
+    parser.add_argument("--save-turns", type=int, default=200, help="测量 save_turn 的轮数")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--exact-queries", type=float, default=0.2, help="询问精确编号的查询比例")
+    parser.add_argument("--no-lexical", action="store_true", help="关闭 FTS5 全文索引 (对比用)")
+    parser.add_argument("--no-retrieval-cache", action="store_true", help="关闭检索结果缓存 (对比用)")
+    parser.add_argument("--no-two-stage", action="store_true", help="关闭摘要两阶段检索 (对比用)")
+    parser.add_argument("--two-stage-min-vectors", type=int, default=None,
+                        help="启用两阶段检索的最少向量数 (默认使用 HistoryStore 的配置)")
+    parser.add_argument("--skip-rebuild", action="store_true", help="跳过全量重建 (大规模时很慢)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="数据目录 (默认临时目录)")
+    parser.add_argument("--keep", action="store_true", help="保留生成的数据库和索引")
+    parser.add_argument("--output", default=None, help="结果 JSON 输出路径")
+    parser.add_argument("--scale", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        # 子进程：运行单个规模，最后一行输出 JSON
+        print(json.dumps(run_scale(args)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="memory_bench_")
+    passthrough = sys.argv[1:]
+    results = []
+    for scale in args.scales:
+        print(f"Running scale {scale} turns...")
+        cmd = [sys.executable, "-m", "benchmarks.memory_pipeline", *passthrough,
+               "--workdir", workdir, "--scale", str(scale)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stderr[-2000:])
+            results.append({"turns": scale, "error": f"exit code {proc.returncode}"})
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'turns':>9}{'save p50':>10}{'save p99':>10}{'srch p50':>10}{'srch p99':>10}"
+          f"{'fast p50':>10}{'emb p50':>10}{'evid p50':>10}{'rebuild s':>11}{'rss MB':>9}{'disk MB':>9}{'emb saved':>10}"
+          f"{'repeat p50':>11}")
+    for res in results:
+        if "error" in res:
+            print(f"{res['turns']:>9}  {res['error']}")
+            continue
+        print(
+            f"{res['turns']:>9}{res['save_turn_ms']['p50']:>10.2f}{res['save_turn_ms']['p99']:>10.2f}"
+            f"{res['search_ms']['p50']:>10.2f}{res['search_ms']['p99']:>10.2f}"
+            f"{res['search_ms_fast_path']['p50']:>10.2f}{res['search_ms_embedded']['p50']:>10.2f}"
+            f"{res['evidence_ms']['p50']:>10.2f}"
+            f"{res.get('rebuild_s', float('nan')):>11.2f}{res['peak_rss_mb']:>9.0f}{res['disk_bytes'] / 2**20:>9.1f}"
+            f"{res['embedding_calls_saved']:>10}{res['search_ms_repeat']['p50']:>11.2f}"
+        )
+
+    if args.output:
+        meta = {
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("scale", "output")},
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
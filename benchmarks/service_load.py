@@ -0,0 +1,267 @@
+# benchmarks/service_load.py
+"""
+多用户记忆服务的负载测试：多个客户端线程并发模拟完整会话
+(开始会话 -> 每轮检索证据并保存 -> 结束会话)，报告每秒完成的会话数、每秒轮数与各接口的尾延迟。
+
+用法:
+    python -m benchmarks.service_load --url http://127.0.0.1:8765 --clients 1 4 16 --sessions 200
+    python -m benchmarks.service_load --spawn --preload 20000 --embed-workers 4 --clients 1 4 16
+
+--spawn 在临时目录中启动一个服务子进程 (默认使用桩嵌入模型，可先用 --preload 写入历史)，测试结束后关闭。
+--clients 给出多个值时依次测试各并发度，用于观察吞吐随并发 (核数) 的扩展。
+"""
+
+import argparse
+import http.client
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List
+from urllib.parse import urlparse
+
+import numpy as np
+
+from benchmarks.memory_pipeline import TOPICS, _git_commit, bulk_load, synthetic_turn
+
+OPERATIONS = ("start", "evidence", "save", "end")
+
+
+def _latency_summary(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ms = np.asarray(values) * 1000.0
+    return {
+        "count": len(values),
+        "p50": float(np.percentile(ms, 50)),
+        "p95": float(np.percentile(ms, 95)),
+        "p99": float(np.percentile(ms, 99)),
+        "max": float(ms.max()),
+    }
+
+
+class _Client:
+    """每个客户端线程一个 keep-alive 连接"""
+
+    def __init__(self, url: str, timeout: float = 120.0):
+        parsed = urlparse(url)
+        self._conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+
+    def call(self, method: str, path: str, body: dict = None) -> dict:
+        data = json.dumps(body or {}, ensure_ascii=False).encode("utf-8")
+        self._conn.request(method, path, body=data, headers={"Content-Type": "application/json"})
+        response = self._conn.getresponse()
+        payload = json.loads(response.read() or b"{}")
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path}: HTTP {response.status} {payload.get('error', '')}")
+        return payload
+
+    def close(self):
+        self._conn.close()
+
+
+def run_load(url: str, clients: int, sessions: int, turns: int, seed: int) -> Dict:
+    """clients 个线程共完成 sessions 个会话，每个会话 turns 轮"""
+    latencies = {op: [] for op in OPERATIONS}
+    session_seconds = []
+    errors = []
+    remaining = [sessions]
+    lock = threading.Lock()
+
+    def worker(worker_id: int):
+        rng = np.random.default_rng(seed * 1000 + worker_id)
+        client = _Client(url)
+        local = {op: [] for op in OPERATIONS}
+        local_sessions = []
+        try:
+            while True:
+                with lock:
+                    if remaining[0] <= 0: break
+                    remaining[0] -= 1
+                session_start = time.perf_counter()
+                try:
+                    t0 = time.perf_counter()
+                    session_id = client.call("POST", "/sessions")["session_id"]
+                    local["start"].append(time.perf_counter() - t0)
+                    topic_id = int(rng.integers(len(TOPICS)))
+                    for turn_number in range(1, turns + 1):
+                        user, assistant = synthetic_turn(rng, topic_id, turn_number)
+                        t0 = time.perf_counter()
+                        client.call("POST", f"/sessions/{session_id}/evidence", {"query": user})
+                        local["evidence"].append(time.perf_counter() - t0)
+                        t0 = time.perf_counter()
+                        client.call("POST", f"/sessions/{session_id}/turns",
+                                    {"user": user, "assistant": assistant, "turn_number": turn_number})
+                        local["save"].append(time.perf_counter() - t0)
+                    t0 = time.perf_counter()
+                    client.call("POST", f"/sessions/{session_id}/end")
+                    local["end"].append(time.perf_counter() - t0)
+                    local_sessions.append(time.perf_counter() - session_start)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+                    client.close()
+                    client = _Client(url)
+        finally:
+            client.close()
+            with lock:
+                for op in OPERATIONS:
+                    latencies[op].extend(local[op])
+                session_seconds.extend(local_sessions)
+
+    threads = [threading.Thread(target=worker, args=(i,), name=f"load-client-{i}") for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    completed = len(session_seconds)
+    return {
+        "clients": clients,
+        "sessions": completed,
+        "turns": completed * turns,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_s": wall,
+        "sessions_per_s": completed / wall if wall else 0.0,
+        "turns_per_s": completed * turns / wall if wall else 0.0,
+        "session_ms": _latency_summary(session_seconds),
+        "latency_ms": {op: _latency_summary(latencies[op]) for op in OPERATIONS},
+    }
+
+
+def serve(args):
+    """子进程：在 workdir 中建立 HistoryStore 并启动服务，就绪后输出一行 LISTENING <url>"""
+    from src.embedding_utils import EMBEDDING_CLIENT
+    if args.embedder == "stub":
+        from benchmarks.stub_embedder import StubEmbeddingModel
+        if args.embed_workers:
+            EMBEDDING_CLIENT.enable_process_pool(args.embed_workers, model_factory=StubEmbeddingModel)
+        else:
+            EMBEDDING_CLIENT.set_model(StubEmbeddingModel())
+    else:
+        EMBEDDING_CLIENT.configure(backend=args.backend)
+        if args.embed_workers:
+            EMBEDDING_CLIENT.enable_process_pool(args.embed_workers)
+        else:
+            EMBEDDING_CLIENT.warmup(background=False)
+    if args.micro_batching:
+        EMBEDDING_CLIENT.enable_batching()
+    from src.history_store import HistoryStore
+    from src.memory_service import MemoryServer, MemoryService
+
+    store = HistoryStore(
+        os.path.join(args.workdir, "conversation_history.db"), args.workdir,
+        index_config={"type": args.index_type},
+    )
+    if args.preload:
+        bulk_load(store, args.preload, 50, args.seed)
+        store.sync_index()
+        store.consolidate_sessions()
+    server = MemoryServer(MemoryService(store), {"port": 0, "workers": args.server_workers})
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print(f"LISTENING {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+        EMBEDDING_CLIENT.close()
+
+
+def _echo_server_output(stream):
+    for line in stream:
+        print(f"  [server] {line.rstrip()}")
+
+
+def _spawn_server(args, workdir: str):
+    passthrough = [arg for arg in sys.argv[1:] if arg != "--spawn"]
+    cmd = [sys.executable, "-m", "benchmarks.service_load", *passthrough, "--workdir", workdir, "--serve"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    for line in proc.stdout:
+        if line.startswith("LISTENING "):
+            # 继续转发服务的输出，避免管道写满后阻塞服务进程
+            threading.Thread(target=_echo_server_output, args=(proc.stdout,), daemon=True).start()
+            return proc, line.split()[1]
+        print(f"  [server] {line.rstrip()}")
+    raise RuntimeError(f"Server exited with code {proc.wait()} before listening.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8765", help="已运行的服务地址")
+    parser.add_argument("--spawn", action="store_true", help="启动临时服务子进程进行测试")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16], help="并发客户端数 (可多个)")
+    parser.add_argument("--sessions", type=int, default=100, help="每个并发度完成的会话数")
+    parser.add_argument("--turns", type=int, default=5, help="每个会话的轮数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="结果 JSON 输出路径")
+    # 以下参数只用于 --spawn
+    parser.add_argument("--embedder", choices=["stub", "model"], default="stub")
+    parser.add_argument("--backend", default="torch", help="--embedder model 时使用的后端")
+    parser.add_argument("--embed-workers", type=int, default=0, help="编码进程数，0 表示在服务进程内编码")
+    parser.add_argument("--micro-batching", action="store_true", help="开启编码微批处理")
+    parser.add_argument("--server-workers", type=int, default=32, help="服务的请求线程数")
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--preload", type=int, default=0, help="启动前写入的历史轮数")
+    parser.add_argument("--workdir", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    proc, workdir = None, None
+    url = args.url
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix="service_load_")
+        print("Starting memory service...")
+        proc, url = _spawn_server(args, workdir)
+    try:
+        results = []
+        for clients in args.clients:
+            print(f"Running {args.sessions} sessions x {args.turns} turns with {clients} clients...")
+            results.append(run_load(url, clients, args.sessions, args.turns, args.seed))
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'clients':>8}{'sess/s':>9}{'turns/s':>9}{'errors':>8}"
+          f"{'evid p50':>10}{'evid p99':>10}{'save p50':>10}{'save p99':>10}{'sess p99':>10}")
+    for res in results:
+        lat = res["latency_ms"]
+        print(f"{res['clients']:>8}{res['sessions_per_s']:>9.2f}{res['turns_per_s']:>9.1f}{res['errors']:>8}"
+              f"{lat['evidence']['p50']:>10.1f}{lat['evidence']['p99']:>10.1f}"
+              f"{lat['save']['p50']:>10.1f}{lat['save']['p99']:>10.1f}{res['session_ms']['p99']:>10.0f}")
+        if res["first_error"]:
+            print(f"         first error: {res['first_error']}")
+
+    if args.output:
+        meta = {
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("serve", "workdir", "output")},
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# benchmarks/sharded_store.py
+"""
+单库与按时间分片的存储对比：同一批跨越多个月的合成历史分别写入 HistoryStore 与 ShardedHistoryStore，
+报告打开耗时、全量检索与按时间过滤检索的延迟 (分片模式下过滤会裁剪分片)、单个分片与整库的重建耗时。
+
+用法:
+    python -m benchmarks.sharded_store --turns 200000 --months 12 --window month
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks.memory_pipeline import TOPICS, _git_commit, _percentiles, synthetic_turn
+
+DAY = 86400.0
+
+
+def synthetic_rows(n_turns: int, months: int, turns_per_session: int, seed: int) -> List[tuple]:
+    """n_turns 轮对话，会话开始时间均匀分布在最近 months 个月内"""
+    rng = np.random.default_rng(seed)
+    n_sessions = max(1, n_turns // turns_per_session)
+    span = months * 30 * DAY
+    now = time.time()
+    rows = []
+    for s in range(n_sessions):
+        start = now - span + span * s / n_sessions
+        topic_id = int(rng.integers(len(TOPICS)))
+        for turn_number in range(1, turns_per_session + 1):
+            user, assistant = synthetic_turn(rng, topic_id, turn_number)
+            ts = start + turn_number * 60.0
+            rows.append((f"bench_{s:08d}", turn_number, "user", user, ts))
+            rows.append((f"bench_{s:08d}", turn_number, "assistant", assistant, ts + 0.001))
+    return rows
+
+
+def _load(store, rows: List[tuple], batch: int = 20000) -> float:
+    t0 = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        store.bulk_insert(rows[i:i + batch])
+    store.finish_bulk_insert()
+    return time.perf_counter() - t0
+
+
+def _search_ms(store, queries: List[str], top_k: int, **filters) -> Dict[str, float]:
+    store.search_history_index(queries[0], top_k=top_k, **filters)
+    elapsed = []
+    for query in queries:
+        t0 = time.perf_counter()
+        store.search_history_index(query, top_k=top_k, **filters)
+        elapsed.append((time.perf_counter() - t0) * 1000.0)
+    return _percentiles(elapsed)
+
+
+def run(args) -> Dict:
+    from src.embedding_utils import EMBEDDING_CLIENT
+    from benchmarks.stub_embedder import StubEmbeddingModel
+    EMBEDDING_CLIENT.set_model(StubEmbeddingModel())
+    from src.history_store import HistoryStore
+    from src.sharded_store import ShardedHistoryStore
+
+    rows = synthetic_rows(args.turns, args.months, args.turns_per_session, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    queries = [synthetic_turn(rng, int(rng.integers(len(TOPICS))), 3)[0] + f" {i}" for i in range(args.queries)]
+    since = time.time() - args.recent_days * DAY
+    # 关闭检索缓存，测量的是实际检索
+    store_kwargs = dict(index_config={"type": args.index_type}, retrieval_cache_config={"enabled": False})
+    sharding = {"window": args.window, "max_open_shards": args.max_open_shards, "search_workers": args.search_workers}
+
+    def open_single():
+        return HistoryStore(os.path.join(args.workdir, "single", "conversation_history.db"),
+                            os.path.join(args.workdir, "single"), **store_kwargs)
+
+    def open_sharded():
+        return ShardedHistoryStore(os.path.join(args.workdir, "sharded"), sharding, **store_kwargs)
+
+    result = {"turns": args.turns, "months": args.months, "window": args.window, "index_type": args.index_type}
+    for mode, opener in (("single", open_single), ("sharded", open_sharded)):
+        store = opener()
+        load_s = _load(store, rows)
+        store.close()
+        t0 = time.perf_counter()
+        store = opener()
+        open_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        store.search_history_index(queries[0], top_k=args.top_k)
+        first_search_ms = (time.perf_counter() - t0) * 1000.0
+        res = {
+            "load_s": load_s,
+            "open_s": open_s,
+            "first_search_ms": first_search_ms,
+            "search_ms": _search_ms(store, queries, args.top_k),
+            "search_ms_recent": _search_ms(store, queries, args.top_k, since=since),
+        }
+        t0 = time.perf_counter()
+        if mode == "single":
+            store.rebuild_faiss_index()
+        else:
+            # 只重建最新的分片
+            store.rebuild_faiss_index(store.describe_shards()[-1]["name"])
+            res["shards"] = len(store.describe_shards())
+            res["search_stats"] = dict(store.search_stats)
+        res["rebuild_s"] = time.perf_counter() - t0
+        store.close()
+        result[mode] = res
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100000)
+    parser.add_argument("--months", type=int, default=12, help="历史跨越的月数")
+    parser.add_argument("--turns-per-session", type=int, default=20)
+    parser.add_argument("--window", default="month")
+    parser.add_argument("--index-type", default="flat")
+    parser.add_argument("--max-open-shards", type=int, default=4)
+    parser.add_argument("--search-workers", type=int, default=4)
+    parser.add_argument("--recent-days", type=float, default=30, help="按时间过滤检索的范围 (最近 N 天)")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None, help="数据目录 (默认临时目录，结束后删除)")
+    parser.add_argument("--output", default=None, help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    cleanup = args.workdir is None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix="sharded_store_")
+    try:
+        result = run(args)
+    finally:
+        if cleanup:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    print(f"\n{'mode':>8}{'load s':>9}{'open s':>9}{'1st ms':>9}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'recent p50':>12}{'recent p99':>12}{'rebuild s':>11}")
+    for mode in ("single", "sharded"):
+        res = result[mode]
+        print(f"{mode:>8}{res['load_s']:>9.1f}{res['open_s']:>9.2f}{res['first_search_ms']:>9.1f}"
+              f"{res['search_ms']['p50']:>9.2f}{res['search_ms']['p99']:>9.2f}"
+              f"{res['search_ms_recent']['p50']:>12.2f}{res['search_ms_recent']['p99']:>12.2f}{res['rebuild_s']:>11.2f}")
+    print(f"(sharded: {result['sharded']['shards']} shards; rebuild = newest shard only)")
+
+    if args.output:
+        meta = {
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("workdir", "output")},
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "result": result}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# benchmarks/stub_embedder.py
+"""
+确定性的桩嵌入模型：不依赖 sentence-transformers，可离线运行基准测试。
+每个词经哈希映射到一个固定随机向量，文本向量为词向量之和，
+因此共享词语的文本彼此相似，检索行为接近真实模型。
+"""
+
+import hashlib
+import re
+from typing import List, Union
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class StubEmbeddingModel:
+    def __init__(self, dim: int = 384, table_size: int = 1 << 16, seed: int = 0):
+        self.dim = dim
+        self.table_size = table_size
+        rng = np.random.default_rng(seed)
+        self._table = rng.standard_normal((table_size, dim)).astype(np.float32)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _bucket(self, token: str) -> int:
+        digest = hashlib.blake2b(token.lower().encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") % self.table_size
+
+    def encode(self, texts: Union[str, List[str]], batch_size: int = 32, convert_to_numpy: bool = True,
+               show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            buckets = [self._bucket(token) for token in _TOKEN_RE.findall(text)]
+            if buckets:
+                out[i] = self._table[buckets].sum(axis=0)
+        return out[0] if single else out
@@ -0,0 +1,67 @@
+# history_io.py
+"""
+对话历史的批量导入与导出 (使用 config.yaml 中的存储与嵌入配置)。
+
+用法:
+    python history_io.py import dump.jsonl more.jsonl          # 可断点续传，中断后重新运行即可
+    python history_io.py import ./history_export               # export 导出的目录，直接使用其中的向量
+    python history_io.py export ./history_export --shard-rows 200000
+    python history_io.py import ./history_export/*             # 分片模式的导出 (每个时间分片一个子目录)
+
+导入的 JSONL 每行一轮 {"session_id", "turn_number", "user", "assistant", "timestamp"?}
+或一条消息 {"session_id", "turn_number", "role", "content", "timestamp"?}；timestamp 为 Unix 时间戳或 ISO 8601。
+"""
+
+import argparse
+import os
+
+from main import bootstrap
+from src import bulk_io
+from src.embedding_utils import EMBEDDING_CLIENT
+from src.sharded_store import ShardedHistoryStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="导入 JSONL 文件或导出目录")
+    p_import.add_argument("paths", nargs="+")
+    p_import.add_argument("--replace", action="store_true", help="覆盖已存在的轮次 (默认跳过)")
+    p_import.add_argument("--restart", action="store_true", help="忽略上次的导入进度，从头导入")
+    p_import.add_argument("--reembed", action="store_true", help="导入导出目录时不使用其中的向量")
+    p_import.add_argument("--batch-lines", type=int, default=bulk_io.IMPORT_BATCH_LINES, help="每个事务的输入行数")
+    p_export = sub.add_parser("export", help="导出对话与向量")
+    p_export.add_argument("directory")
+    p_export.add_argument("--shard-rows", type=int, default=bulk_io.EXPORT_SHARD_ROWS)
+    p_export.add_argument("--no-vectors", action="store_true", help="只导出对话文本")
+    args = parser.parse_args()
+
+    _, llm, history_store = bootstrap()
+    llm.close()
+    if history_store is None:
+        raise SystemExit("HistoryStore failed to initialize.")
+    try:
+        if args.command == "export":
+            if isinstance(history_store, ShardedHistoryStore):
+                # 分片模式：每个分片导出到一个子目录 (行 id 只在分片内唯一)，可分别导入
+                for shard in history_store.describe_shards():
+                    with history_store.shard(shard["name"]) as store:
+                        bulk_io.export_jsonl(store, os.path.join(args.directory, shard["name"]),
+                                             args.shard_rows, not args.no_vectors)
+            else:
+                bulk_io.export_jsonl(history_store, args.directory, args.shard_rows, not args.no_vectors)
+            return
+        for path in args.paths:
+            if os.path.isdir(path):
+                bulk_io.import_export(history_store, path, args.replace, args.reembed, args.restart)
+            else:
+                bulk_io.import_jsonl(history_store, path, args.batch_lines, args.replace, restart=args.restart)
+        # 为导入的会话生成摘要
+        history_store.consolidate_sessions()
+    finally:
+        history_store.close()
+        EMBEDDING_CLIENT.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,29 @@
 from src.llm_client import ApiLLMClient
 from src.prompts import build_prompt, get_evidence
 from src.history_store import HistoryStore
+from src.sharded_store import ShardedHistoryStore
 from src.embedding_utils import EMBEDDING_CLIENT 
+from src.turn_writer import TurnWriter, TurnSaveError, DEFAULT_QUEUE_SIZE
+from src.metrics import METRICS
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 import os
 
 CFG_PATH = r"config.yaml" 
 
+def build_llm_client(cfg, pool_size: int = 4) -> ApiLLMClient:
+    """按配置创建 LLM 客户端 (并发调用时 pool_size 应不小于并发数)"""
+    llm_cfg = cfg.get("llm", {})
+    return ApiLLMClient(
+        api_key=llm_cfg.get("api_key"),
+        base_url=llm_cfg.get("base_url"),
+        model=llm_cfg.get("model"),
+        connect_timeout=llm_cfg.get("connect_timeout", 10.0),
+        read_timeout=llm_cfg.get("read_timeout", 120.0),
+        max_retries=llm_cfg.get("max_retries", 3),
+        pool_size=pool_size,
+    )
+
 def bootstrap():
     if not os.path.exists(CFG_PATH):
         raise FileNotFoundError(f"Config file not found at {CFG_PATH}.")
@@ -16,20 +33,70 @@ def bootstrap():
     with open(CFG_PATH, "r", encoding="utf-8") as f:
         cfg = yaml.safe_load(f)
     print("Loaded config:", cfg)
-    
-    llm = ApiLLMClient(
-        api_key=cfg.get("llm", {}).get("api_key"),
-        base_url=cfg.get("llm", {}).get("base_url"),
-        model=cfg.get("llm", {}).get("model"),
+
+    emb_cfg = cfg.get("embedding", {})
+    EMBEDDING_CLIENT.configure(
+        backend=emb_cfg.get("backend", "torch"),
+        onnx_file=emb_cfg.get("onnx_file"),
     )
+    pool_cfg = emb_cfg.get("process_pool", {})
+    if pool_cfg.get("enabled", False):
+        # 多进程编码 (多用户服务)：每个工作进程各加载一份模型，主进程不加载
+        EMBEDDING_CLIENT.enable_process_pool(
+            workers=pool_cfg.get("workers", 0),
+            torch_threads=pool_cfg.get("torch_threads", 1),
+        )
+    elif emb_cfg.get("warmup", True):
+        # 模型在后台线程加载，与索引加载并行
+        EMBEDDING_CLIENT.warmup(background=True)
+    EMBEDDING_CLIENT.batch_size = emb_cfg.get("batch_size", EMBEDDING_CLIENT.batch_size)
+    mb_cfg = emb_cfg.get("micro_batching", {})
+    if mb_cfg.get("enabled", False):
+        EMBEDDING_CLIENT.enable_batching(
+            max_batch_size=mb_cfg.get("max_batch_size", 32),
+            max_wait_ms=mb_cfg.get("max_wait_ms", 5.0),
+        )
+
+    # 分阶段计时 (默认关闭)
+    metrics_cfg = cfg.get("metrics", {})
+    if metrics_cfg.get("enabled", False):
+        METRICS.configure(
+            enabled=True,
+            trace_path=metrics_cfg.get("trace_path", "./cache/metrics/traces.jsonl"),
+            prometheus_path=metrics_cfg.get("prometheus_path", "./cache/metrics/chat.prom"),
+            window=metrics_cfg.get("window", 1024),
+        )
+
+    llm = build_llm_client(cfg)
 
     db_path = cfg.get("storage", {}).get("history_db_path", "./cache/conversation_history.db")
     faiss_dir = cfg.get("storage", {}).get("faiss_index_dir", "./cache")
 
     try:
-        history_store = HistoryStore(db_path=db_path, faiss_index_dir=faiss_dir)
-        # 核心修复：调用重建索引，确保之前的记录被加载
-        history_store.rebuild_faiss_index()
+        cache_cfg = emb_cfg.get("cache", {})
+        store_kwargs = dict(
+            use_embedding_cache=cache_cfg.get("enabled", True),
+            embedding_cache_items=cache_cfg.get("memory_items", 10000),
+            checkpoint_every_records=cfg.get("storage", {}).get("checkpoint_every_records", 1000),
+            index_config=cfg.get("index"),
+            sqlite_pragmas=cfg.get("storage", {}).get("sqlite_pragmas"),
+            lexical_config=cfg.get("lexical"),
+            retrieval_cache_config=cfg.get("retrieval_cache"),
+            summary_config=cfg.get("summaries"),
+            compaction_config=cfg.get("compaction"),
+            mmap_index=cfg.get("storage", {}).get("mmap_index", True),
+        )
+        sharding_cfg = cfg.get("storage", {}).get("sharding", {})
+        if sharding_cfg.get("enabled", False):
+            # 按时间窗口分片：每个窗口一个数据库和索引，历史分片在第一次使用时才打开
+            history_store = ShardedHistoryStore(sharding_cfg.get("root", "./cache/shards"), sharding_cfg,
+                                                **store_kwargs)
+        else:
+            history_store = HistoryStore(db_path=db_path, faiss_index_dir=faiss_dir, **store_kwargs)
+        # 增量同步：只索引高水位线之后的行和被替换的行
+        history_store.sync_index()
+        # 为上次未正常结束的会话补齐摘要
+        history_store.consolidate_sessions()
     except Exception as e:
         print(f"Error initializing HistoryStore: {e}")
         history_store = None
@@ -49,43 +116,98 @@ def chat_loop(cfg, llm, history_store, session_id, last_turn_number):
     turn_number = last_turn_number
     rag_cfg = cfg.get("rag", {})
     system_role = cfg.get("llm", {}).get("system_role", "助理")
-    
-    while True:
-        user_input = input("用户: ").strip()
-        if user_input.lower() in ["quit", "exit", "退出"]:
-            history_store.update_session_total_turns(session_id, turn_number)
-            print("对话结束。")
-            break
-        if not user_input: continue
-
-        turn_number += 1
-
-        # 对话式 RAG：从历史中检索证据
-        evidence = ""
-        try:
-            evidence = get_evidence(
-                history_store, 
-                session_id, 
-                user_input, 
-                top_k=rag_cfg.get("top_k", 5), 
-                similarity_threshold=rag_cfg.get("similarity_threshold", 0.5)
-            )
-        except Exception as e:
-            print(f"Warn: History retrieval failed: {e}")
-            
-        prompt = build_prompt(system_role, user_input, evidence)
-        print(f"--- Context ---\n{evidence}\n----------------")
 
-        try:
-            answer = llm.generate(prompt, temperature=cfg.get("llm", {}).get("temperature", 0.7))
-            print(f"助手: {answer}")
-            history_store.save_turn(session_id, turn_number, user_input, answer)
-        except Exception as e:
-            print(f"Error: {e}")
-            turn_number -= 1
-        print("--------------------------\n")
+    # 流水线模式：保存/索引在后台线程进行，最近 N 轮查询与查询编码并行
+    pipeline_cfg = cfg.get("pipeline", {})
+    writer, executor = None, None
+    if pipeline_cfg.get("enabled", False):
+        writer = TurnWriter(history_store, pipeline_cfg.get("queue_size", DEFAULT_QUEUE_SIZE))
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recent-history")
+
+    try:
+        while True:
+            user_input = input("用户: ").strip()
+            if user_input.lower() in ["quit", "exit", "退出"]:
+                if writer is not None:
+                    try:
+                        writer.flush()
+                    except TurnSaveError as e:
+                        print(f"Error: {e}")
+                        turn_number = e.turn_number - 1
+                history_store.update_session_total_turns(session_id, turn_number)
+                print("对话结束。")
+                break
+            if not user_input: continue
+
+            turn_number += 1
+
+            # 整轮 (检索、构建 Prompt、生成、保存) 计为一个 trace，不包括等待用户输入的时间
+            with METRICS.span("turn", turn=turn_number):
+                # 检索前等待上一轮写入完成，保证它可以被检索到 (通常在用户输入期间已经完成)
+                if writer is not None:
+                    try:
+                        with METRICS.span("history.flush_wait"):
+                            writer.flush()
+                    except TurnSaveError as e:
+                        # 与同步保存失败时一致：回退轮次，本轮沿用保存失败的轮次编号
+                        print(f"Error: {e}")
+                        turn_number = e.turn_number
+
+                # 对话式 RAG：从历史中检索证据
+                evidence = ""
+                try:
+                    evidence = get_evidence(
+                        history_store, 
+                        session_id, 
+                        user_input, 
+                        top_k=rag_cfg.get("top_k", 5), 
+                        similarity_threshold=rag_cfg.get("similarity_threshold", 0.5),
+                        executor=executor,
+                        packing=rag_cfg.get("packing"),
+                    )
+                except Exception as e:
+                    print(f"Warn: History retrieval failed: {e}")
+                
+                prompt = build_prompt(system_role, user_input, evidence)
+                print(f"--- Context ---\n{evidence}\n----------------")
+
+                try:
+                    temperature = cfg.get("llm", {}).get("temperature", 0.7)
+                    with METRICS.span("llm"):
+                        if cfg.get("llm", {}).get("stream", True):
+                            # 流式输出：收到一段打印一段
+                            print("助手: ", end="", flush=True)
+                            pieces = []
+                            for piece in llm.generate_stream(prompt, temperature=temperature):
+                                print(piece, end="", flush=True)
+                                pieces.append(piece)
+                            print()
+                            answer = "".join(pieces)
+                        else:
+                            answer = llm.generate(prompt, temperature=temperature)
+                            print(f"助手: {answer}")
+                    if writer is not None:
+                        writer.submit(session_id, turn_number, user_input, answer)
+                    else:
+                        history_store.save_turn(session_id, turn_number, user_input, answer)
+                except Exception as e:
+                    print(f"Error: {e}")
+                    turn_number -= 1
+                print("--------------------------\n")
+            METRICS.export_prometheus()
+    finally:
+        # 退出前写完队列中剩余的对话
+        if writer is not None:
+            writer.close()
+            executor.shutdown()
 
 if __name__ == "__main__":
     cfg, llm, history_store = bootstrap()
     if history_store:
-        chat_first_turn(cfg, llm, history_store)
\ No newline at end of file
+        try:
+            chat_first_turn(cfg, llm, history_store)
+        finally:
+            history_store.close()
+            llm.close()
+            METRICS.export_prometheus()
+            METRICS.close()
\ No newline at end of file
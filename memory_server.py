@@ -0,0 +1,63 @@
+# memory_server.py
+"""
+多用户记忆服务：一个进程、一个 HistoryStore，通过 HTTP (JSON) 同时服务多个对话会话。
+配置与 main.py 相同 (config.yaml)，另读取 service 段；命令行参数优先。
+
+用法:
+    python memory_server.py --port 8765 --workers 32
+
+接口:
+    POST /sessions                     -> {"session_id"}
+    POST /sessions/<id>/evidence       {"query"} -> {"evidence"}
+    POST /sessions/<id>/turns          {"user", "assistant", "turn_number"?} -> {"turn_number"}
+    POST /sessions/<id>/chat           {"message"} -> {"turn_number", "answer"}  (检索 + 大模型 + 保存)
+    POST /sessions/<id>/end            -> {"total_turns"}
+    GET  /sessions/<id>/history
+    POST /search                       {"query", "top_k"?, "session_id"?, "role"?, "since"?, "until"?}
+    GET  /health, GET /stats
+"""
+
+import argparse
+
+from main import bootstrap, build_llm_client
+from src.embedding_utils import EMBEDDING_CLIENT
+from src.memory_service import MemoryServer, MemoryService, resolve_config
+from src.metrics import METRICS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None, help="处理请求的线程数")
+    args = parser.parse_args()
+
+    cfg, llm, history_store = bootstrap()
+    if history_store is None:
+        raise SystemExit("HistoryStore failed to initialize.")
+    service_cfg = resolve_config(cfg.get("service"))
+    service_cfg.update({k: v for k, v in vars(args).items() if v is not None})
+    # 每个请求线程都可能同时调用大模型
+    llm.close()
+    llm = build_llm_client(cfg, pool_size=service_cfg["workers"])
+
+    llm_cfg = cfg.get("llm", {})
+    service = MemoryService(history_store, llm, cfg.get("rag"), llm_cfg.get("system_role", "助理"),
+                            llm_cfg.get("temperature", 0.7))
+    server = MemoryServer(service, service_cfg)
+    print(f"Memory service listening on {server.url} ({service_cfg['workers']} workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        history_store.close()
+        llm.close()
+        EMBEDDING_CLIENT.close()
+        METRICS.export_prometheus()
+        METRICS.close()
+
+
+if __name__ == "__main__":
+    main()
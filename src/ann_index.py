@@ -0,0 +1,359 @@
+# src/ann_index.py
+
+import contextlib
+import math
+import time
+from typing import Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+# 可选的向量索引类型
+#   flat     - 暴力内积搜索 (精确)
+#   hnsw     - HNSW 图索引，无需训练
+#   ivf_flat - 倒排 + 原始向量，需要训练
+#   ivf_pq   - 倒排 + 乘积量化，内存最小，需要训练
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_pq')
+
+# 各类型可靠训练所需的最少向量数 (PQ 每个子量化器有 256 个中心)
+MIN_TRAIN_POINTS = {"flat": 0, "hnsw": 0, "ivf_flat": 1000, "ivf_pq": 10000}
+
+# 过滤后的候选数不超过该值时，按精确方式在候选集内搜索
+SMALL_FILTER_SIZE = 4096
+
+DEFAULT_INDEX_CONFIG = {
+    "type": "flat",
+    # 向量数达到该阈值后才从 flat 迁移到配置的 ANN 索引 (小规模下 flat 更快也更准)
+    "train_threshold": 20000,
+    "hnsw_m": 32,
+    "ef_construction": 80,
+    "ef_search": 64,
+    "nlist": 0,          # 0 表示按 4 * sqrt(N) 自动选择
+    "nprobe": 16,
+    "pq_m": 48,          # 子量化器个数，需要整除向量维度
+}
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    """合并用户配置与默认值，并校验索引类型"""
+    merged = dict(DEFAULT_INDEX_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    if merged["type"] not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {merged['type']}. Choose from {INDEX_TYPES}.")
+    return merged
+
+
+def _auto_nlist(n: int, cfg: dict) -> int:
+    nlist = cfg["nlist"] or int(4 * math.sqrt(max(n, 1)))
+    # 每个聚类中心至少需要约 39 个训练样本
+    return max(1, min(nlist, n // 39))
+
+
+def _factory_string(index_type: str, n: int, dim: int, cfg: dict) -> str:
+    # flat / HNSW 通过 IDMap2 以行 id 为键；IVF 原生支持自定义 id (IDMap 包装 IVF 后删除会错位)
+    if index_type == "flat":
+        return "IDMap2,Flat"
+    if index_type == "hnsw":
+        return f"IDMap2,HNSW{cfg['hnsw_m']}"
+    nlist = _auto_nlist(n, cfg)
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},Flat"
+    pq_m = cfg["pq_m"]
+    if dim % pq_m != 0:
+        raise ValueError(f"pq_m={pq_m} must divide the vector dimension {dim}.")
+    return f"IVF{nlist},PQ{pq_m}"
+
+
+def _inner(index: faiss.Index) -> faiss.Index:
+    """IDMap2 包装下的实际索引 (IVF 索引本身)"""
+    return faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+
+
+def is_id_keyed(index: faiss.Index) -> bool:
+    """索引是否以行 id 为键 (而非旧版的位置编号)"""
+    return hasattr(index, "id_map") or isinstance(index, faiss.IndexIVF)
+
+
+def create_index(dim: int, index_type: str = "flat", cfg: Optional[dict] = None,
+                 train_vectors: Optional[np.ndarray] = None) -> faiss.Index:
+    """创建以 SQLite 行 id 为键的索引 (需要训练的类型用 train_vectors 训练)"""
+    cfg = resolve_config(cfg)
+    n = 0 if train_vectors is None else len(train_vectors)
+    index = faiss.index_factory(dim, _factory_string(index_type, n, dim, cfg), faiss.METRIC_INNER_PRODUCT)
+    if index_type == "hnsw":
+        _inner(index).hnsw.efConstruction = cfg["ef_construction"]
+    if isinstance(index, faiss.IndexIVF):
+        # 哈希表形式的 direct map 支持按行 id 重建向量和删除
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    if not index.is_trained:
+        if train_vectors is None:
+            raise ValueError(f"Index type {index_type} requires training vectors.")
+        index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+    apply_search_params(index, cfg)
+    return index
+
+
+def read_index(path: str, index_type: Optional[str] = None, mmap: bool = True,
+               cfg: Optional[dict] = None) -> Tuple[faiss.Index, bool]:
+    """
+    读取索引检查点，返回 (索引, 是否为只读映射)。
+    mmap=True 时向量 (flat / HNSW 的存储) 或倒排表 (IVF) 通过 mmap 只读映射，按需从页缓存换入，
+    打开耗时与向量数基本无关，多个进程共享同一份物理内存；映射的索引不能添加或删除向量。
+    index_type 未知时 (旧的检查点) 按 flat / HNSW 的方式映射。
+    """
+    if not mmap:
+        index = faiss.read_index(path)
+    else:
+        flag = faiss.IO_FLAG_MMAP if index_type in ("ivf_flat", "ivf_pq") else faiss.IO_FLAG_MMAP_IFC
+        index = faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+    apply_search_params(index, cfg)
+    return index, mmap
+
+
+def index_type_of(index: faiss.Index) -> str:
+    """识别索引类型"""
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def apply_search_params(index: faiss.Index, cfg: Optional[dict] = None):
+    """设置 nprobe / efSearch 等查询参数"""
+    cfg = resolve_config(cfg)
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = cfg["nprobe"]
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = cfg["ef_search"]
+
+
+def search_filtered(index: faiss.Index, query: np.ndarray, k: int, ids: np.ndarray,
+                    cfg: Optional[dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    只在给定行 id 集合内搜索 (FAISS ID 选择器，不合格的向量不计算距离)。
+    候选集较小时：IVF 探查全部倒排表；flat / HNSW 直接取出候选向量精确打分，
+    开销与候选数成正比，也避免 HNSW 漏召回。
+    """
+    cfg = resolve_config(cfg)
+    ids = np.asarray(ids, dtype=np.int64)
+    k = min(k, len(ids))
+    small = len(ids) <= SMALL_FILTER_SIZE
+    inner = _inner(index)
+
+    if small and not isinstance(inner, faiss.IndexIVF):
+        vectors = index.reconstruct_batch(ids)
+        scores = vectors @ query[0]
+        order = np.argsort(-scores)[:k]
+        return scores[order][None, :], ids[order][None, :]
+
+    selector = faiss.IDSelectorBatch(ids)
+    if isinstance(inner, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=inner.nlist if small else cfg["nprobe"])
+    elif isinstance(inner, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(cfg["ef_search"], k))
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(query, k, params=params)
+
+
+def all_ids(index: faiss.Index) -> np.ndarray:
+    """索引中全部向量的行 id"""
+    if hasattr(index, "id_map"):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    invlists = index.invlists
+    chunks = [
+        faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+        for list_no in range(index.nlist) if invlists.list_size(list_no)
+    ]
+    return np.concatenate(chunks).astype(np.int64) if chunks else np.zeros(0, dtype=np.int64)
+
+
+def export_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """导出索引中的全部 (向量, 行 id)；PQ 索引导出的是重建后的近似向量"""
+    ids = all_ids(index)
+    if len(ids) == 0:
+        return np.zeros((0, index.d), dtype=np.float32), ids
+    vectors = index.reconstruct_batch(ids)
+    return np.ascontiguousarray(vectors, dtype=np.float32), ids
+
+
+def desired_type(index: faiss.Index, cfg: Optional[dict] = None) -> str:
+    """根据配置和当前向量数决定应使用的索引类型"""
+    cfg = resolve_config(cfg)
+    current = index_type_of(index)
+    if cfg["type"] == "flat" or current == cfg["type"]:
+        return cfg["type"]
+    threshold = max(cfg["train_threshold"], MIN_TRAIN_POINTS[cfg["type"]])
+    return cfg["type"] if index.ntotal >= threshold else current
+
+
+def migrate(index: faiss.Index, index_type: str, cfg: Optional[dict] = None, lock=None) -> faiss.Index:
+    """
+    把现有索引的向量迁移到新类型的索引 (必要时先训练)，原索引保持不变。
+    传入 lock 时只在导出向量时持锁，训练和添加在锁外进行，期间原索引可继续服务查询和追加。
+    """
+    with lock or contextlib.nullcontext():
+        vectors, ids = export_vectors(index)
+    print(f"Migrating vector index: {index_type_of(index)} -> {index_type} ({len(ids)} vectors)...")
+    t0 = time.perf_counter()
+    new_index = create_index(index.d, index_type, cfg, train_vectors=vectors if len(vectors) else None)
+    if len(ids):
+        new_index.add_with_ids(vectors, ids)
+    print(f"Migration complete in {time.perf_counter() - t0:.1f}s.")
+    return new_index
+
+
+def remove_ids(index: faiss.Index, ids: np.ndarray, cfg: Optional[dict] = None) -> faiss.Index:
+    """删除给定行 id 的向量；HNSW 不支持删除，此时重建索引。返回 (可能是新的) 索引"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0: return index
+    if isinstance(index, faiss.IndexIVF):
+        # 哈希表 direct map 只支持 IDSelectorArray
+        index.remove_ids(faiss.IDSelectorArray(ids))
+        return index
+    if index_type_of(index) != "hnsw":
+        index.remove_ids(faiss.IDSelectorBatch(ids))
+        return index
+    vectors, all_ids = export_vectors(index)
+    keep = ~np.isin(all_ids, ids)
+    new_index = create_index(index.d, "hnsw", cfg)
+    if keep.any():
+        new_index.add_with_ids(vectors[keep], all_ids[keep])
+    return new_index
+
+
+def _empty_like(index: faiss.Index, cfg: Optional[dict] = None) -> faiss.Index:
+    """与给定索引类型相同的空索引；IVF 复制训练好的量化器和 PQ 码本，不复制倒排表"""
+    if not isinstance(index, faiss.IndexIVF):
+        return create_index(index.d, index_type_of(index), cfg)
+    quantizer = faiss.clone_index(index.quantizer)
+    if isinstance(index, faiss.IndexIVFPQ):
+        new_index = faiss.IndexIVFPQ(quantizer, index.d, index.nlist, index.pq.M, index.pq.nbits,
+                                     faiss.METRIC_INNER_PRODUCT)
+        new_index.pq = index.pq
+        new_index.by_residual = index.by_residual
+    else:
+        new_index = faiss.IndexIVFFlat(quantizer, index.d, index.nlist, faiss.METRIC_INNER_PRODUCT)
+    new_index.own_fields = True
+    quantizer.this.disown()
+    new_index.is_trained = True
+    if isinstance(new_index, faiss.IndexIVFPQ):
+        new_index.precompute_table()
+    new_index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    apply_search_params(new_index, cfg)
+    return new_index
+
+
+def rebuild_subset(index: faiss.Index, keep_ids: np.ndarray, cfg: Optional[dict] = None,
+                   lock=None, chunk: int = 65536) -> faiss.Index:
+    """
+    返回只包含 keep_ids 的新索引，原索引保持不变 (重建期间可继续服务查询)。
+    FAISS 的删除不会释放已分配的内存，重建后的存储按剩余向量数分配：
+    flat / HNSW 按块取出向量重新添加；IVF 沿用训练好的量化器，逐个倒排表复制编码 (PQ 不重新量化)。
+    传入 lock 时每次读取原索引都在锁内进行，其余时间允许其他线程向原索引添加向量。
+    """
+    lock = lock or contextlib.nullcontext()
+    keep_ids = np.asarray(keep_ids, dtype=np.int64)
+    new_index = _empty_like(index, cfg)
+    if not isinstance(index, faiss.IndexIVF):
+        for start in range(0, len(keep_ids), chunk):
+            batch = keep_ids[start:start + chunk]
+            with lock:
+                vectors = np.ascontiguousarray(index.reconstruct_batch(batch), dtype=np.float32)
+            new_index.add_with_ids(vectors, batch)
+        return new_index
+    for list_no in range(index.nlist):
+        with lock:
+            size = index.invlists.list_size(list_no)
+            if not size: continue
+            list_ids = faiss.rev_swig_ptr(index.invlists.get_ids(list_no), size)
+            keep = np.isin(list_ids, keep_ids)
+            if not keep.any(): continue
+            kept_ids = np.ascontiguousarray(list_ids[keep])
+            codes = faiss.rev_swig_ptr(index.invlists.get_codes(list_no), size * index.code_size)
+            kept_codes = np.ascontiguousarray(codes.reshape(size, index.code_size)[keep])
+        new_index.invlists.add_entries(list_no, len(kept_ids), faiss.swig_ptr(kept_ids), faiss.swig_ptr(kept_codes))
+    new_index.ntotal = new_index.invlists.compute_ntotal()
+    # 按复制后的倒排表重建哈希 direct map
+    new_index.set_direct_map_type(faiss.DirectMap.NoMap)
+    new_index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return new_index
+
+
+def memory_bytes(index: faiss.Index, cfg: Optional[dict] = None) -> int:
+    """估算索引的常驻内存：向量或编码 + 行 id 映射 (每条约 24 字节) + HNSW 的邻接表"""
+    cfg = resolve_config(cfg)
+    index_type = index_type_of(index)
+    per_vector = 24
+    if index_type in ("flat", "ivf_flat"):
+        per_vector += index.d * 4
+    elif index_type == "hnsw":
+        per_vector += index.d * 4 + cfg["hnsw_m"] * 2 * 4
+    else:
+        per_vector += _inner(index).code_size
+    return index.ntotal * per_vector
+
+
+def measure_recall(index: faiss.Index, k: int = 10, n_queries: int = 200, seed: int = 0,
+                   vectors: Optional[np.ndarray] = None, ids: Optional[np.ndarray] = None) -> Dict:
+    """
+    以 flat 精确搜索为基准，估计 ANN 索引的 recall@k。
+    基准默认使用从索引导出的向量 (PQ 索引导出的是近似向量，最好传入原始 vectors/ids)；
+    查询向量取自这些向量并加入少量噪声。
+    """
+    if vectors is None or ids is None:
+        vectors, ids = export_vectors(index)
+    n = len(ids)
+    if n == 0:
+        return {"index_type": index_type_of(index), "recall_at_k": 1.0, "k": k, "queries": 0}
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(n, size=min(n_queries, n), replace=False)].copy()
+    queries += rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+
+    baseline = faiss.IndexFlatIP(index.d)
+    baseline.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    t0 = time.perf_counter()
+    _, exact = baseline.search(queries, k)
+    flat_ms = (time.perf_counter() - t0) * 1000.0 / len(queries)
+    t0 = time.perf_counter()
+    _, approx = index.search(queries, k)
+    ann_ms = (time.perf_counter() - t0) * 1000.0 / len(queries)
+
+    exact_ids = ids[exact]
+    hits = sum(len(set(a) & set(e)) for a, e in zip(approx, exact_ids))
+    return {
+        "index_type": index_type_of(index),
+        "k": k,
+        "queries": len(queries),
+        "recall_at_k": hits / float(len(queries) * k),
+        "flat_ms_per_query": flat_ms,
+        "ann_ms_per_query": ann_ms,
+    }
+
+
+def compare_index_types(vectors: np.ndarray, ids: np.ndarray, cfg: Optional[dict] = None,
+                        index_types=INDEX_TYPES, k: int = 10, n_queries: int = 200) -> list:
+    """在同一批向量上构建各类索引，报告 recall@k、查询延迟和构建时间"""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    ids = np.asarray(ids, dtype=np.int64)
+    results = []
+    for index_type in index_types:
+        t0 = time.perf_counter()
+        try:
+            index = create_index(vectors.shape[1], index_type, cfg,
+                                 train_vectors=None if index_type in ("flat", "hnsw") else vectors)
+        except (ValueError, RuntimeError) as e:
+            results.append({"index_type": index_type, "error": str(e)})
+            continue
+        index.add_with_ids(vectors, ids)
+        build_s = time.perf_counter() - t0
+        res = measure_recall(index, k, n_queries, vectors=vectors, ids=ids)
+        res["build_s"] = build_s
+        results.append(res)
+    return results
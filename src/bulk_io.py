@@ -0,0 +1,287 @@
+# src/bulk_io.py
+
+import json
+import os
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from . import ann_index
+from .embedding_utils import EMBEDDING_CLIENT
+from .history_store import HistoryStore
+
+# 每个事务 (及每次批量编码) 处理的输入行数
+IMPORT_BATCH_LINES = 5000
+# 导出时每个分片的对话行数，以及每次从 SQLite 读取的行数
+EXPORT_SHARD_ROWS = 200000
+EXPORT_BATCH_ROWS = 10000
+EXPORT_FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+# 校验失败时最多打印的警告条数 (其余只计数)
+MAX_WARNINGS = 20
+
+ROLES = ("user", "assistant")
+
+# 解析后的一行：(session_id, turn_number, role, content, timestamp, 向量在分片中的位置或 None)
+Row = Tuple[str, int, str, str, float, Optional[int]]
+
+
+class RecordError(ValueError):
+    pass
+
+
+def _timestamp(value, default: float) -> float:
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        raise RecordError("timestamp must be a number or an ISO 8601 string")
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            pass
+    raise RecordError(f"invalid timestamp: {value!r}")
+
+
+def _text(record: dict, field: str) -> str:
+    value = record.get(field)
+    if not isinstance(value, str):
+        raise RecordError(f"'{field}' must be a string")
+    return value
+
+
+def parse_record(record, default_time: float) -> List[Row]:
+    """
+    校验一条记录并展开为行。支持两种格式：
+      整轮: {"session_id", "turn_number", "user", "assistant", "timestamp"?}
+      单条: {"session_id", "turn_number", "role", "content", "timestamp"?, "vector"?} (export_jsonl 的输出)
+    timestamp 为 Unix 时间戳或 ISO 8601 字符串，缺省时取 default_time。
+    """
+    if not isinstance(record, dict):
+        raise RecordError("record must be a JSON object")
+    session_id = record.get("session_id")
+    if isinstance(session_id, int) and not isinstance(session_id, bool):
+        session_id = str(session_id)
+    if not isinstance(session_id, str) or not session_id:
+        raise RecordError("'session_id' must be a non-empty string")
+    turn_number = record.get("turn_number")
+    if not isinstance(turn_number, int) or isinstance(turn_number, bool) or turn_number < 1:
+        raise RecordError("'turn_number' must be a positive integer")
+    timestamp = _timestamp(record.get("timestamp"), default_time)
+
+    if "role" in record:
+        role = record["role"]
+        if role not in ROLES:
+            raise RecordError(f"'role' must be one of {ROLES}")
+        vector = record.get("vector")
+        if vector is not None and (not isinstance(vector, int) or isinstance(vector, bool) or vector < 0):
+            raise RecordError("'vector' must be a non-negative integer or null")
+        return [(session_id, turn_number, role, _text(record, "content"), timestamp, vector)]
+    # 与 save_turn 一致：回答的时间戳比提问晚 1 毫秒
+    return [(session_id, turn_number, "user", _text(record, "user"), timestamp, None),
+            (session_id, turn_number, "assistant", _text(record, "assistant"), timestamp + 0.001, None)]
+
+
+def _read_batches(path: str, offset: int, line_no: int,
+                  batch_lines: int) -> Iterator[Tuple[List[Tuple[int, bytes]], int, int]]:
+    """从 offset 处流式读取，每次产出 (一批 (行号, 内容), 这批之后的偏移, 这批之后的行号)"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        batch = []
+        for raw in f:
+            line_no += 1
+            offset += len(raw)
+            if raw.strip():
+                batch.append((line_no, raw))
+            if len(batch) >= batch_lines:
+                yield batch, offset, line_no
+                batch = []
+        yield batch, offset, line_no
+
+
+def import_jsonl(store: HistoryStore, path: str, batch_lines: int = IMPORT_BATCH_LINES, replace: bool = False,
+                 vectors: Optional[np.ndarray] = None, restart: bool = False, finish: bool = True,
+                 verbose: bool = True) -> dict:
+    """
+    流式导入 JSONL 对话记录：逐批校验、一个事务写入 SQLite、批量编码并添加到索引，最后写一次检查点。
+    导入进度 (文件偏移) 与每批数据在同一事务中提交，中断后再次调用从断点继续 (restart=True 从头开始)。
+    vectors 为与记录中 "vector" 字段对应的向量数组 (导出的分片)，有向量的行不再编码。
+    内存占用只与 batch_lines 有关，与文件大小无关。返回导入统计。
+    """
+    path = os.path.abspath(path)
+    state_key = f"import:{path}"
+    size = os.path.getsize(path)
+    progress = {"offset": 0, "line": 0, "rows": 0, "rejected": 0, "done": False}
+    saved = store._read_state(state_key)
+    if saved and not restart:
+        progress.update(json.loads(saved))
+        if progress["offset"] > size:
+            print(f"Warn: {path} is smaller than at the last import, starting over.")
+            progress = {"offset": 0, "line": 0, "rows": 0, "rejected": 0, "done": False}
+    if progress["done"] and progress["offset"] == size:
+        if verbose:
+            print(f"{path} was already imported ({progress['rows']} rows), skipping.")
+        return dict(progress, path=path, skipped=True)
+    if verbose and progress["offset"]:
+        print(f"Resuming import of {path} at line {progress['line']}...")
+
+    start = time.perf_counter()
+    progress["done"] = False
+    for batch, offset, line_no in _read_batches(path, progress["offset"], progress["line"], batch_lines):
+        rows, row_vectors = [], []
+        now = time.time()
+        for number, raw in batch:
+            try:
+                parsed = parse_record(json.loads(raw), now)
+                for row in parsed:
+                    if row[5] is not None and (vectors is None or row[5] >= len(vectors)):
+                        raise RecordError(f"vector {row[5]} is out of range")
+            except (ValueError, UnicodeDecodeError) as e:
+                progress["rejected"] += 1
+                if progress["rejected"] <= MAX_WARNINGS:
+                    print(f"Warn: {os.path.basename(path)} line {number}: {e}")
+                continue
+            rows.extend(row[:5] for row in parsed)
+            row_vectors.extend(row[5] for row in parsed)
+        progress["offset"] = offset
+        progress["line"] = line_no
+        progress["done"] = offset >= size
+        batch_vectors = None
+        if vectors is not None and any(v is not None for v in row_vectors):
+            batch_vectors = np.full((len(rows), vectors.shape[1]), np.nan, dtype=np.float32)
+            given = [i for i, v in enumerate(row_vectors) if v is not None]
+            batch_vectors[given] = vectors[[row_vectors[i] for i in given]]
+        written = store.bulk_insert(rows, batch_vectors, replace,
+                                    state=(state_key, json.dumps({**progress, "rows": progress["rows"] + len(rows)})))
+        progress["rows"] += len(rows)
+        if verbose and batch:
+            print(f"  {os.path.basename(path)}: line {progress['line']}, {progress['rows']} rows "
+                  f"({written} new in this batch), {progress['rejected']} rejected")
+    if finish:
+        store.finish_bulk_insert()
+    elapsed = time.perf_counter() - start
+    if verbose:
+        print(f"Imported {path}: {progress['rows']} rows, {progress['rejected']} rejected records in {elapsed:.1f}s.")
+    return dict(progress, path=path, seconds=elapsed)
+
+
+def _read_manifest(directory: str) -> dict:
+    with open(os.path.join(directory, MANIFEST_NAME), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != EXPORT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported export format: {manifest.get('format')}")
+    return manifest
+
+
+def import_export(store: HistoryStore, directory: str, replace: bool = False, reembed: bool = False,
+                  restart: bool = False, verbose: bool = True) -> dict:
+    """
+    导入 export_jsonl 导出的目录。嵌入模型与导出时一致 (命名空间与维度相同) 且未指定 reembed 时
+    直接使用导出的向量，不重新编码；否则全部重新编码。各分片可分别断点续传，最后写一次检查点。
+    """
+    manifest = _read_manifest(directory)
+    use_vectors = (not reembed and manifest.get("embedding") == EMBEDDING_CLIENT.cache_namespace
+                   and manifest.get("dim") == store.vector_dim)
+    if verbose and not use_vectors and not reembed:
+        print(f"Exported vectors are from '{manifest.get('embedding')}' ({manifest.get('dim')} dims), "
+              f"re-embedding with '{EMBEDDING_CLIENT.cache_namespace}'.")
+    reports = []
+    for shard in manifest["shards"]:
+        vectors = None
+        if use_vectors and shard.get("vectors"):
+            vectors = np.load(os.path.join(directory, shard["vectors"]), mmap_mode="r")
+        reports.append(import_jsonl(store, os.path.join(directory, shard["turns"]), replace=replace,
+                                    vectors=vectors, restart=restart, finish=False, verbose=verbose))
+    store.finish_bulk_insert()
+    return {"shards": reports, "rows": sum(r["rows"] for r in reports),
+            "rejected": sum(r["rejected"] for r in reports), "used_vectors": use_vectors}
+
+
+def export_jsonl(store: HistoryStore, directory: str, shard_rows: int = EXPORT_SHARD_ROWS,
+                 with_vectors: bool = True, verbose: bool = True) -> dict:
+    """
+    流式导出全部对话 (每行一条消息，按行 id 顺序) 到 turns-NNNNN.jsonl 分片，向量写入对应的
+    vectors-NNNNN.npy (float32，行号记在消息的 "vector" 字段；没有向量的行为 null)。
+    每个分片先读出其行 id 以确定向量数，再分批读取和写入，内存占用与分片大小有关而与总量无关。
+    最后写入 manifest.json (嵌入模型、维度、分片列表)。返回 manifest。
+    """
+    os.makedirs(directory, exist_ok=True)
+    conn = store.db.connection()
+    manifest = {
+        "format": EXPORT_FORMAT_VERSION,
+        "exported_at": datetime.now().isoformat(timespec="seconds"),
+        "embedding": EMBEDDING_CLIENT.cache_namespace if with_vectors else None,
+        "dim": store.vector_dim,
+        # PQ 索引与冷存储中的向量是近似值
+        "index_type": ann_index.index_type_of(store.index) if store.index is not None else None,
+        "shards": [],
+    }
+    start = time.perf_counter()
+    last_id, total_rows, total_vectors = 0, 0, 0
+    while True:
+        shard_ids = np.array([row_id for (row_id,) in conn.execute(
+            "SELECT id FROM conversation_history WHERE id > ? ORDER BY id LIMIT ?", (last_id, shard_rows)
+        )], dtype=np.int64)
+        if not len(shard_ids): break
+        number = len(manifest["shards"])
+        shard = {"turns": f"turns-{number:05d}.jsonl", "vectors": None, "rows": len(shard_ids), "vector_count": 0}
+        vectors_out = None
+        if with_vectors and store.index is not None:
+            has_vector = np.zeros(len(shard_ids), dtype=bool)
+            for i in range(0, len(shard_ids), EXPORT_BATCH_ROWS):
+                has_vector[i:i + EXPORT_BATCH_ROWS] = store.get_vectors(shard_ids[i:i + EXPORT_BATCH_ROWS])[0]
+            shard["vector_count"] = int(has_vector.sum())
+            if shard["vector_count"]:
+                shard["vectors"] = f"vectors-{number:05d}.npy"
+                vectors_out = np.lib.format.open_memmap(
+                    os.path.join(directory, shard["vectors"]), mode="w+", dtype=np.float32,
+                    shape=(shard["vector_count"], store.vector_dim)
+                )
+
+        written = 0
+        tmp_path = os.path.join(directory, shard["turns"] + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            cursor = conn.execute(
+                "SELECT id, session_id, turn_number, role, content, timestamp FROM conversation_history "
+                "WHERE id > ? AND id <= ? ORDER BY id",
+                (last_id, int(shard_ids[-1]))
+            )
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_ROWS)
+                if not rows: break
+                positions = [None] * len(rows)
+                if vectors_out is not None:
+                    found, vectors = store.get_vectors(np.array([row[0] for row in rows], dtype=np.int64))
+                    # 分片的向量数在读取行 id 时已确定，不会超出 (导出期间不应有压缩等写入)
+                    vectors = vectors[:len(vectors_out) - written]
+                    vectors_out[written:written + len(vectors)] = vectors
+                    for i, index in enumerate(np.flatnonzero(found)[:len(vectors)]):
+                        positions[index] = written + i
+                    written += len(vectors)
+                for (_, session_id, turn_number, role, content, timestamp), position in zip(rows, positions):
+                    f.write(json.dumps({"session_id": session_id, "turn_number": turn_number, "role": role,
+                                        "content": content, "timestamp": timestamp, "vector": position},
+                                       ensure_ascii=False))
+                    f.write("\n")
+        os.replace(tmp_path, os.path.join(directory, shard["turns"]))
+        if vectors_out is not None:
+            vectors_out.flush()
+            del vectors_out
+        manifest["shards"].append(shard)
+        last_id = int(shard_ids[-1])
+        total_rows += shard["rows"]
+        total_vectors += shard["vector_count"]
+        if verbose:
+            print(f"  {shard['turns']}: {shard['rows']} rows, {shard['vector_count']} vectors")
+
+    manifest.update(rows=total_rows, vectors=total_vectors)
+    with open(os.path.join(directory, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    if verbose:
+        print(f"Exported {total_rows} rows and {total_vectors} vectors to {directory} "
+              f"in {time.perf_counter() - start:.1f}s.")
+    return manifest
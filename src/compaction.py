@@ -0,0 +1,190 @@
+# src/compaction.py
+
+import os
+from typing import Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from . import ann_index
+
+DEFAULT_COMPACTION_CONFIG = {
+    # 默认关闭：压缩会去重、移出向量并改变检索结果，需要显式开启
+    "enabled": False,
+    "interval_turns": 500,       # 每保存多少轮在后台自动压缩一次，0 表示只手动调用 compact()
+    # 余弦相似度不低于该值的同一会话、同角色向量视为重复，只保留最新的一条；
+    # 被合并的行记下别名 (指向保留的行)，过滤检索和按行取向量时仍能找到较早的轮次
+    "dedup_threshold": 0.995,
+    "dedup_neighbors": 4,        # 每个新向量检查的近邻数
+    # 保留策略 (0 表示不限制)：超出的向量移出内存索引
+    "max_age_days": 0,
+    "max_sessions": 0,
+    "max_vectors": 0,
+    # 移出的向量以 float16 写入磁盘上的冷存储；关闭时直接丢弃
+    "cold_tier": True,
+    # 检索时同时对冷存储做暴力搜索，与内存索引的结果按相似度合并 (过滤条件按 SQLite 中的行元数据应用)
+    "cold_search": True,
+}
+
+# 冷存储暴力搜索时每次转换为 float32 的向量数
+COLD_SEARCH_CHUNK = 65536
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    merged = dict(DEFAULT_COMPACTION_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    return merged
+
+
+class ColdStore:
+    """
+    冷向量存储：float16 向量与行 id 分别追加写入两个文件，读取时通过 memmap 按需换页，
+    常驻内存只有操作系统的页缓存。只支持追加和暴力搜索。
+    """
+
+    def __init__(self, directory: str, dim: int):
+        self.dim = dim
+        self.vectors_path = os.path.join(directory, "cold_vectors.f16")
+        self.ids_path = os.path.join(directory, "cold_ids.i64")
+        self._vectors: Optional[np.ndarray] = None
+        self._ids: Optional[np.ndarray] = None
+        # (排序后的行 id, 对应的位置)，第一次按 id 读取时计算
+        self._by_id: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._open()
+
+    def _open(self):
+        self._by_id = None
+        count = os.path.getsize(self.ids_path) // 8 if os.path.exists(self.ids_path) else 0
+        if os.path.exists(self.vectors_path):
+            count = min(count, os.path.getsize(self.vectors_path) // (2 * self.dim))
+        if count == 0:
+            self._vectors = np.zeros((0, self.dim), dtype=np.float16)
+            self._ids = np.zeros(0, dtype=np.int64)
+            return
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(count, self.dim))
+        self._ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(count,))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self) * (2 * self.dim + 8)
+
+    def append(self, row_ids: np.ndarray, vectors: np.ndarray):
+        if len(row_ids) == 0: return
+        # 先写向量再写 id：中途崩溃时多出的向量会按 id 文件的长度被忽略
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float16).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.ids_path, "ab") as f:
+            f.write(np.ascontiguousarray(row_ids, dtype=np.int64).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._open()
+
+    def clear(self):
+        """删除冷存储 (全量重建索引时，全部对话重新进入内存索引)"""
+        self._vectors, self._ids = None, None
+        for path in (self.vectors_path, self.ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._open()
+
+    def get(self, row_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """按行 id 读取向量，返回 (找到的掩码, 找到的向量 (float32))"""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        vectors, ids, by_id = self._vectors, self._ids, self._by_id
+        if len(ids) == 0 or len(row_ids) == 0:
+            return np.zeros(len(row_ids), dtype=bool), np.zeros((0, self.dim), dtype=np.float32)
+        if by_id is None or len(by_id[0]) != len(ids):
+            order = np.argsort(ids, kind="stable")
+            by_id = self._by_id = (np.asarray(ids)[order], order)
+        sorted_ids, order = by_id
+        pos = np.minimum(np.searchsorted(sorted_ids, row_ids), len(sorted_ids) - 1)
+        found = sorted_ids[pos] == row_ids
+        return found, np.asarray(vectors[order[pos[found]]], dtype=np.float32)
+
+    def search(self, query_vector: np.ndarray, k: int,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """暴力内积搜索，返回 (scores, row_ids)，按分数降序；传入 allowed (行 id 数组) 时只对其中的行打分"""
+        vectors, ids = self._vectors, self._ids
+        empty = np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        if len(ids) == 0 or k <= 0 or (allowed is not None and len(allowed) == 0):
+            return empty
+        query = query_vector.reshape(-1).astype(np.float32)
+        best_scores, best_ids = [], []
+        for start in range(0, len(ids), COLD_SEARCH_CHUNK):
+            chunk_ids = np.asarray(ids[start:start + COLD_SEARCH_CHUNK])
+            chunk = vectors[start:start + COLD_SEARCH_CHUNK]
+            if allowed is not None:
+                keep = np.isin(chunk_ids, allowed, assume_unique=True)
+                if not keep.any(): continue
+                chunk_ids, chunk = chunk_ids[keep], chunk[keep]
+            scores = chunk.astype(np.float32) @ query
+            top = np.argsort(-scores)[:k]
+            best_scores.append(scores[top])
+            best_ids.append(chunk_ids[top])
+        if not best_scores: return empty
+        scores, row_ids = np.concatenate(best_scores), np.concatenate(best_ids)
+        order = np.argsort(-scores)[:k]
+        return scores[order], row_ids[order]
+
+
+def find_duplicates(index: faiss.Index, row_ids: np.ndarray, vectors: np.ndarray, groups: np.ndarray,
+                    group_of, threshold: float, neighbors: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    对一批 (较新的) 向量查找近邻：同一会话、同角色且相似度不低于阈值的较早向量视为重复。
+    group_of(row_id) 返回行的 (会话, 角色) 编码，不在元数据中时返回 None。
+    返回 (要移除的较早行 id, 与之重复而保留的较新行 id)，两个数组一一对应
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if len(row_ids) == 0 or index.ntotal < 2: return empty, empty
+    D, I = index.search(np.ascontiguousarray(vectors, dtype=np.float32), min(neighbors + 1, index.ntotal))
+    drop = {}
+    for row_id, group, scores, found in zip(row_ids, groups, D, I):
+        for score, other in zip(scores, found):
+            if other == -1 or score < threshold: break
+            if other >= row_id or other in drop: continue
+            if group_of(int(other)) == group:
+                drop[int(other)] = int(row_id)
+    dropped = np.array(sorted(drop), dtype=np.int64)
+    return dropped, np.array([drop[row_id] for row_id in dropped], dtype=np.int64)
+
+
+def memory_report(index: Optional[faiss.Index], meta_bytes: int, cold: Optional[ColdStore],
+                  cfg: Optional[dict] = None) -> Dict[str, float]:
+    """内存占用概况 (MB)，压缩前后各记录一次"""
+    mb = 1024.0 * 1024.0
+    report = {
+        "vectors": int(index.ntotal) if index is not None else 0,
+        "index_mb": (ann_index.memory_bytes(index, cfg) if index is not None else 0) / mb,
+        "meta_mb": meta_bytes / mb,
+        "cold_vectors": len(cold) if cold is not None else 0,
+        "cold_disk_mb": (cold.nbytes if cold is not None else 0) / mb,
+        "rss_mb": _current_rss_mb(),
+    }
+    return report
+
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return 0.0
+
+
+def format_report(before: Dict[str, float], after: Dict[str, float], removed: Dict[str, int],
+                  seconds: float) -> str:
+    parts = ", ".join(f"{name} {count}" for name, count in removed.items() if count)
+    return (
+        f"Compaction done in {seconds:.1f}s: vectors {before['vectors']} -> {after['vectors']}"
+        f" ({parts or 'nothing removed'}); index ~{before['index_mb']:.1f}MB -> ~{after['index_mb']:.1f}MB,"
+        f" metadata {before['meta_mb']:.1f}MB -> {after['meta_mb']:.1f}MB, cold tier {after['cold_vectors']} vectors,"
+        f" RSS {before['rss_mb']:.0f}MB -> {after['rss_mb']:.0f}MB"
+    )
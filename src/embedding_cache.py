@@ -0,0 +1,105 @@
+# src/embedding_cache.py
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+# SQLite 单条 IN 查询中的最大参数个数
+_LOOKUP_CHUNK = 500
+
+
+class EmbeddingCache:
+    """
+    内容寻址的嵌入向量缓存：键为 hash(模型名, 文本)。
+    磁盘层使用 SQLite 文件持久化，前面加一层有容量上限的内存 LRU。
+    """
+
+    def __init__(self, path: str, model_name: str, max_memory_items: int = 10000):
+        self.path = path
+        self.model_name = model_name
+        self.max_memory_items = max(0, int(max_memory_items))
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+            key BLOB PRIMARY KEY,
+            vector BLOB NOT NULL
+        ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+
+    def key(self, text: str) -> bytes:
+        digest = hashlib.sha1()
+        digest.update(self.model_name.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.digest()
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        if self.max_memory_items == 0: return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """批量查询缓存，未命中的位置返回 None"""
+        keys = [self.key(text) for text in texts]
+        results: List[Optional[np.ndarray]] = [None] * len(keys)
+        with self._lock:
+            disk_lookup = {}
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                else:
+                    disk_lookup.setdefault(key, []).append(i)
+
+            pending = list(disk_lookup)
+            for start in range(0, len(pending), _LOOKUP_CHUNK):
+                chunk = pending[start:start + _LOOKUP_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(key, vector)
+                    for i in disk_lookup[key]:
+                        results[i] = vector
+
+            found = sum(1 for r in results if r is not None)
+            self.hits += found
+            self.misses += len(results) - found
+        return results
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray):
+        """批量写入缓存 (单个事务)"""
+        if len(texts) == 0: return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                vector = np.array(vector, dtype=np.float32)
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes()))
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (key, vector) VALUES (?, ?)", rows
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,33 +1,345 @@
 # src/embedding_utils.py
 
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import List
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+from .metrics import METRICS
 
 # 使用一个高效且常用的模型，其维度为 384
-EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2' 
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
 
-class EmbeddingClient:
-    """封装 Sentence-Transformer 模型的客户端"""
-    def __init__(self):
+# 批量编码时每次前向传播的默认文本数
+DEFAULT_BATCH_SIZE = 64
+
+# 已知模型的向量维度，用于在不加载模型的情况下初始化索引
+KNOWN_DIMENSIONS = {
+    'all-MiniLM-L6-v2': 384,
+}
+
+# 可选的 CPU 推理后端：
+#   torch - 原始 fp32 SentenceTransformer
+#   int8  - 对 Linear 层做 PyTorch 动态 int8 量化
+#   onnx  - 通过 sentence-transformers 的 ONNX Runtime 后端运行 (可指定量化后的 onnx 文件)
+BACKENDS = ('torch', 'int8', 'onnx')
+
+
+class MicroBatcher:
+    """
+    微批处理队列：把并发的单条编码请求合并为一次前向传播。
+    第一个请求到达后最多等待 max_wait_ms，或凑满 max_batch_size 条即提交。
+    """
+    def __init__(self, encode_fn, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self._encode_fn = encode_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="embedding-microbatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed.")
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None: return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            stop = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    nxt = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            self._flush(batch)
+            if stop: return
+
+    def _flush(self, batch):
+        texts = [text for text, _ in batch]
         try:
-            print(f"Loading Embedding Model: {EMBEDDING_MODEL_NAME}...")
-            # 将设备设置为 'cpu' 以确保在没有 GPU 的机器上也能运行
-            self.model = SentenceTransformer(EMBEDDING_MODEL_NAME, device='cpu') 
-            self.vector_dim = self.model.get_sentence_embedding_dimension()
-            print(f"Embedding Model Loaded. Dimension: {self.vector_dim}")
+            vectors = self._encode_fn(texts)
         except Exception as e:
-            print(f"Error loading embedding model: {e}")
-            self.vector_dim = 384 # 默认维度
-            self.model = None
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+# 进程池中每个工作进程各自加载的模型
+_WORKER_MODEL = None
+
+
+def _init_pool_worker(model_factory: Callable, torch_threads: int):
+    global _WORKER_MODEL
+    if torch_threads:
+        try:
+            import torch
+            torch.set_num_threads(torch_threads)
+        except ImportError:
+            pass
+    _WORKER_MODEL = model_factory()
+
+
+def _pool_worker_dimension() -> int:
+    return _WORKER_MODEL.get_sentence_embedding_dimension()
+
+
+def _pool_worker_encode(texts: List[str], batch_size: int) -> np.ndarray:
+    vectors = _WORKER_MODEL.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+
+class ProcessPoolModel:
+    """
+    进程池编码：每个工作进程加载一份模型，一次 encode 的文本按批拆分后分发到各进程并行编码。
+    与 SentenceTransformer 的 encode 接口相同，可直接替换 EmbeddingClient 的模型；
+    分词等纯 Python 部分也在各进程中执行，不受主进程 GIL 限制。
+    """
+
+    def __init__(self, model_factory: Callable, workers: int, torch_threads: int = 1):
+        self.workers = max(1, int(workers))
+        # spawn 启动：主进程中已有 FAISS/OpenMP 等线程，fork 后的子进程可能死锁
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pool_worker, initargs=(model_factory, torch_threads),
+        )
+        # 每个进程都先完成模型加载，避免第一批请求承担加载开销
+        dims = {future.result() for future in [self._pool.submit(_pool_worker_dimension) for _ in range(self.workers)]}
+        self._dim = dims.pop()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def encode(self, texts: Sequence[str], batch_size: int = DEFAULT_BATCH_SIZE, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self._dim), dtype=np.float32)
+        # 文本较少时也尽量分给所有进程，但每份不超过 batch_size
+        chunk = max(1, min(batch_size, -(-len(texts) // self.workers)))
+        futures = [self._pool.submit(_pool_worker_encode, texts[i:i + chunk], batch_size)
+                   for i in range(0, len(texts), chunk)]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        self._pool.shutdown()
+
+
+class EmbeddingClient:
+    """
+    封装 Sentence-Transformer 模型的客户端。
+    模型在第一次编码时才加载 (也可通过 warmup() 在后台线程预热)，
+    因此只读取历史记录的工具导入本模块时不会付出模型加载的开销。
+    """
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, backend: str = 'torch',
+                 batch_size: int = DEFAULT_BATCH_SIZE, onnx_file: Optional[str] = None):
+        self.batch_size = batch_size
+        self._batcher: Optional[MicroBatcher] = None
+        self.cache = None
+        self._load_lock = threading.Lock()
+        self._set_model_config(model_name, backend, onnx_file)
+
+    def _set_model_config(self, model_name: str, backend: str, onnx_file: Optional[str]):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {backend}. Choose from {BACKENDS}.")
+        self.model_name = model_name
+        self.backend = backend
+        self.onnx_file = onnx_file
+        self._model = None
+        self._load_attempted = False
+        self._vector_dim = KNOWN_DIMENSIONS.get(model_name)
+
+    def configure(self, model_name: Optional[str] = None, backend: Optional[str] = None,
+                  onnx_file: Optional[str] = None):
+        """切换模型或推理后端 (丢弃已加载的模型，下次编码时重新加载)"""
+        with self._load_lock:
+            self._set_model_config(
+                model_name or self.model_name,
+                backend or self.backend,
+                onnx_file if onnx_file is not None else self.onnx_file,
+            )
+
+    @property
+    def cache_namespace(self) -> str:
+        """嵌入缓存的命名空间：不同后端的输出存在细微差异，不能共用缓存"""
+        if self.backend == 'torch':
+            return self.model_name
+        return f"{self.model_name}:{self.backend}"
+
+    @property
+    def model(self):
+        """已加载的模型 (首次访问时加载)，加载失败时为 None"""
+        if not self._load_attempted:
+            self._load_model()
+        return self._model
+
+    @property
+    def is_loaded(self) -> bool:
+        """模型已成功加载 (不会触发加载)"""
+        return self._model is not None
+
+    @property
+    def load_failed(self) -> bool:
+        """已经尝试过加载但失败 (不会触发加载)"""
+        return self._load_attempted and self._model is None
+
+    @property
+    def vector_dim(self) -> int:
+        if self._vector_dim is None:
+            self._load_model()
+        return self._vector_dim
+
+    def warmup(self, background: bool = True) -> Optional[threading.Thread]:
+        """预加载模型；background=True 时在守护线程中加载并立即返回"""
+        if not background:
+            self._load_model()
+            return None
+        thread = threading.Thread(target=self._load_model, name="embedding-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def _load_model(self):
+        with self._load_lock:
+            if self._load_attempted: return
+            try:
+                print(f"Loading Embedding Model: {self.model_name} (backend: {self.backend})...")
+                self._model = _load_backend(self.model_name, self.backend, self.onnx_file)
+                self._vector_dim = self._model.get_sentence_embedding_dimension()
+                print(f"Embedding Model Loaded. Dimension: {self._vector_dim}")
+            except Exception as e:
+                print(f"Error loading embedding model: {e}")
+                self._model = None
+                if self._vector_dim is None:
+                    self._vector_dim = 384 # 默认维度
+            finally:
+                self._load_attempted = True
+
+    def get_embeddings(self, texts: Sequence[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """批量生成嵌入向量，返回形状为 (N, D) 的 float32 数组 (优先查询缓存)"""
+        texts = list(texts)
+        if not texts or self.model is None:
+            return np.zeros((len(texts), self.vector_dim), dtype=np.float32)
+        if self.cache is None:
+            return self._encode(texts, batch_size)
+
+        vectors = np.zeros((len(texts), self.vector_dim), dtype=np.float32)
+        missing = {}
+        for i, cached in enumerate(self.cache.get_many(texts)):
+            if cached is None:
+                missing.setdefault(texts[i], []).append(i)
+            else:
+                vectors[i] = cached
+
+        if missing:
+            miss_texts = list(missing)
+            encoded = self._encode(miss_texts, batch_size)
+            self.cache.put_many(miss_texts, encoded)
+            for text, vector in zip(miss_texts, encoded):
+                vectors[missing[text]] = vector
+        return vectors
+
+    def _encode(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        METRICS.counter("embedding.texts_encoded", len(texts))
+        with METRICS.span("embedding.encode", texts=len(texts)):
+            vectors = self.model.encode(
+                texts,
+                batch_size=batch_size or self.batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
 
     def get_embedding(self, text: str) -> np.ndarray:
-        """对单个文本生成嵌入向量"""
+        """对单个文本生成嵌入向量 (开启微批处理时与并发请求合并编码)"""
         if self.model is None:
-            return np.zeros(self.vector_dim, dtype=np.float32) 
-        
+            return np.zeros(self.vector_dim, dtype=np.float32)
+
+        if self._batcher is not None:
+            # 缓存命中时无需进入队列等待
+            if self.cache is not None:
+                cached = self.cache.get_many([text])[0]
+                if cached is not None:
+                    return cached
+            return self._batcher.submit(text).result()
         # 返回形状为 (D,) 的 NumPy 数组
-        return self.model.encode(text, convert_to_numpy=True)
+        return self.get_embeddings([text])[0]
+
+    def set_model(self, model):
+        """直接使用已构造的模型 (需提供 encode / get_sentence_embedding_dimension，例如基准测试的桩模型)"""
+        with self._load_lock:
+            self._model = model
+            self._load_attempted = True
+            self._vector_dim = model.get_sentence_embedding_dimension()
+
+    def set_cache(self, cache):
+        """挂载嵌入缓存 (见 embedding_cache.EmbeddingCache)，传入 None 则关闭"""
+        self.cache = cache
+
+    def enable_process_pool(self, workers: int = 0, torch_threads: int = 1,
+                            model_factory: Optional[Callable] = None):
+        """
+        改用进程池编码 (workers 为 0 时取 CPU 核数)：每个工作进程加载一份模型，主进程不再加载。
+        model_factory 为可序列化的无参构造函数，默认按当前的模型与后端配置加载
+        """
+        workers = workers or os.cpu_count() or 1
+        factory = model_factory or functools.partial(_load_backend, self.model_name, self.backend, self.onnx_file)
+        print(f"Starting {workers} embedding worker processes...")
+        self.set_model(ProcessPoolModel(factory, workers, torch_threads))
+
+    def close(self):
+        """关闭微批处理队列和编码进程池"""
+        self.disable_batching()
+        if isinstance(self._model, ProcessPoolModel):
+            self._model.close()
+
+    def enable_batching(self, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        """开启微批处理队列"""
+        self.disable_batching()
+        self._batcher = MicroBatcher(self.get_embeddings, max_batch_size, max_wait_ms)
+
+    def disable_batching(self):
+        """关闭微批处理队列 (等待已提交的请求完成)"""
+        batcher, self._batcher = self._batcher, None
+        if batcher is not None:
+            batcher.close()
+
+def _load_backend(model_name: str, backend: str, onnx_file: Optional[str] = None):
+    """按后端加载 SentenceTransformer 模型 (在此处才导入 torch 等重量级依赖)"""
+    from sentence_transformers import SentenceTransformer
+
+    # 将设备设置为 'cpu' 以确保在没有 GPU 的机器上也能运行
+    if backend == 'onnx':
+        model_kwargs = {"file_name": onnx_file} if onnx_file else None
+        return SentenceTransformer(model_name, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+
+    model = SentenceTransformer(model_name, device='cpu')
+    if backend == 'int8':
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
 
-# 全局初始化 EmbeddingClient，以避免重复加载模型
-EMBEDDING_CLIENT = EmbeddingClient()
\ No newline at end of file
+# 全局 EmbeddingClient (延迟加载)，以避免重复加载模型
+EMBEDDING_CLIENT = EmbeddingClient()
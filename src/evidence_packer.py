@@ -0,0 +1,177 @@
+# src/evidence_packer.py
+
+import math
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from . import lexical
+
+DEFAULT_PACKING_CONFIG = {
+    "enabled": True,
+    "max_tokens": 1200,        # 证据部分的 token 预算 (估算值)
+    "max_turn_tokens": 240,    # 单条证据的上限，超出时只保留与问题相关的句子
+    "min_turn_tokens": 24,     # 剩余预算不足以放下这么多内容时，不再截断放入新的证据
+    "recency_weight": 0.3,     # 排序时时间远近的权重，其余为检索排名
+    "dedup_threshold": 0.9,    # 字符三元组的 Jaccard 相似度不低于该值视为重复证据
+}
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]")
+_PIECE_RE = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_]")
+# 按中英文句末标点和换行切分句子
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[。！？!?；;\n])|(?<=\.)\s+")
+_ELLIPSIS = " … "
+
+# 每条证据的前缀 "[证据#12] [2025-11-05 14:30:56] [助手]: " 的估算 token 数
+HEADER_TOKENS = 24
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    merged = dict(DEFAULT_PACKING_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    return merged
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    本地快速估算 token 数 (不加载分词器)：中文字符和全角标点每个约 1 个 token，
+    英文单词和数字每 4 个字符约 1 个，其余符号各 1 个。
+    """
+    tokens = len(_CJK_RE.findall(text))
+    for piece in _PIECE_RE.findall(_CJK_RE.sub(" ", text)):
+        tokens += math.ceil(len(piece) / 4) if piece[0].isalnum() or piece[0] == "_" else 1
+    return tokens
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """按估算 token 数截断文本"""
+    if max_tokens <= 0: return ""
+    total = estimate_tokens(text)
+    if total <= max_tokens: return text
+    cut = int(len(text) * max_tokens / total)
+    while cut > 0 and estimate_tokens(text[:cut]) > max_tokens:
+        cut = int(cut * 0.9)
+    return text[:cut].rstrip() + "…"
+
+
+def extract_passages(text: str, terms: Sequence[str], max_tokens: int) -> str:
+    """
+    长文本只保留与查询词重合最多的句子 (保持原文顺序，不相邻的句子间用省略号连接)；
+    没有句子与查询相关时保留开头。
+    """
+    if estimate_tokens(text) <= max_tokens: return text
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(text) if s and s.strip()]
+    lowered_terms = [term.lower() for term in terms]
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (-sum(term in sentences[i].lower() for term in lowered_terms), i),
+    )
+    chosen, used = [], 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i]) + 1
+        if used + cost > max_tokens: continue
+        chosen.append(i)
+        used += cost
+    if not chosen:
+        return truncate_to_tokens(sentences[ranked[0]] if sentences else text, max_tokens)
+    chosen.sort()
+    parts = [sentences[chosen[0]]]
+    for prev, i in zip(chosen, chosen[1:]):
+        parts.append((" " if i == prev + 1 else _ELLIPSIS) + sentences[i])
+    passage = "".join(parts)
+    if chosen[0] > 0:
+        passage = "…" + passage
+    if chosen[-1] < len(sentences) - 1:
+        passage += "…"
+    return passage
+
+
+def _shingles(text: str) -> set:
+    text = "".join(text.lower().split())
+    return {text[i:i + 3] for i in range(max(1, len(text) - 2))}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b: return 0.0
+    return len(a & b) / len(a | b)
+
+
+class EvidenceItem:
+    """一条候选证据 (一行对话)。rank 为检索排名，短期记忆 (最近 N 轮) 的 rank 为 None"""
+    __slots__ = ("role", "content", "timestamp", "created_at", "rank", "recent")
+
+    def __init__(self, role: str, content: str, timestamp: float, created_at: str,
+                 rank: Optional[int] = None, recent: bool = False):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.created_at = created_at
+        self.rank = rank
+        self.recent = recent
+
+
+def _priorities(items: Sequence[EvidenceItem], recency_weight: float) -> List[float]:
+    """
+    短期记忆排在最前 (越新越优先)；检索到的证据按 (1 - w) * 排名分 + w * 时间分 排序，
+    两个分数都归一化到 [0, 1]
+    """
+    timestamps = [item.timestamp for item in items]
+    oldest, newest = min(timestamps), max(timestamps)
+    span = (newest - oldest) or 1.0
+    ranks = [item.rank for item in items if item.rank is not None]
+    worst = (max(ranks) + 1) if ranks else 1
+    scores = []
+    for item in items:
+        recency = (item.timestamp - oldest) / span
+        if item.recent:
+            scores.append(2.0 + recency)
+        else:
+            rank_score = 1.0 - (item.rank if item.rank is not None else worst) / worst
+            scores.append((1.0 - recency_weight) * rank_score + recency_weight * recency)
+    return scores
+
+
+def pack_evidence(query: str, items: Sequence[EvidenceItem],
+                  config: Optional[dict] = None) -> Tuple[List[EvidenceItem], Dict[str, int]]:
+    """
+    在 token 预算内挑选证据：按优先级依次放入，跳过与已选证据近乎相同的条目，
+    过长的条目只保留与问题相关的段落。
+    items 应按展示顺序给出 (先检索到的回忆，再短期记忆，各自按时间)；
+    返回 (入选证据, 统计)，入选证据保持该顺序，引用编号按这个顺序分配，与优先级和截断无关。
+    """
+    cfg = resolve_config(config)
+    raw_tokens = sum(HEADER_TOKENS + estimate_tokens(item.content) for item in items)
+    stats = {"candidates": len(items), "tokens_raw": raw_tokens, "tokens_packed": raw_tokens,
+             "dropped": 0, "deduped": 0, "truncated": 0}
+    if not items or not cfg["enabled"]:
+        return list(items), stats
+
+    terms, _ = lexical.query_terms(query)
+    priorities = _priorities(items, cfg["recency_weight"])
+    order = sorted(range(len(items)), key=lambda i: -priorities[i])
+    remaining = cfg["max_tokens"]
+    selected: Dict[int, EvidenceItem] = {}
+    selected_shingles: List[set] = []
+    for i in order:
+        item = items[i]
+        budget = min(cfg["max_turn_tokens"], remaining - HEADER_TOKENS)
+        content = item.content
+        tokens = estimate_tokens(content)
+        if tokens > budget:
+            if budget < cfg["min_turn_tokens"]:
+                stats["dropped"] += 1
+                continue
+            content = extract_passages(content, terms, budget)
+            tokens = estimate_tokens(content)
+        # 比较实际放入的内容：长回答常有相同的套话，整体相似不代表相关段落重复
+        shingles = _shingles(content)
+        if any(_jaccard(shingles, other) >= cfg["dedup_threshold"] for other in selected_shingles):
+            stats["deduped"] += 1
+            continue
+        if content is not item.content:
+            stats["truncated"] += 1
+            item = EvidenceItem(item.role, content, item.timestamp, item.created_at, item.rank, item.recent)
+        selected[i] = item
+        selected_shingles.append(shingles)
+        remaining -= HEADER_TOKENS + tokens
+    stats["tokens_packed"] = cfg["max_tokens"] - remaining
+    return [selected[i] for i in sorted(selected)], stats
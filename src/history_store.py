@@ -1,23 +1,108 @@
 # src/history_store.py
 
-import sqlite3
 import os
+import sqlite3
+import threading
 import time
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 import faiss
 import numpy as np
-import pickle 
-from .embedding_utils import EMBEDDING_CLIENT 
+import json
+import uuid
+from .embedding_utils import EMBEDDING_CLIENT
+from .embedding_cache import EmbeddingCache
+from .vector_log import VectorLog
+from .vector_meta import VectorMetadata
+from .rwlock import RWLock
+from .sqlite_pool import SQLitePool
+from .metrics import METRICS, timed
+from . import ann_index
+from . import lexical
+from .retrieval_cache import RetrievalCache, CacheEntry
+from .memory_summary import SummaryIndex
+from . import memory_summary
+from . import compaction
+from .compaction import ColdStore
+
+# 轮次区间的开放上界
+MAX_TURN = 2 ** 62
+
+# 查询词文档频率缓存的最大条目数
+TERM_DF_CACHE_ITEMS = 10000
+
+# 重建索引时每批从 SQLite 读取并编码的行数
+REBUILD_BATCH_SIZE = 256
+
+# 向量日志累积到这么多条记录或字节数时，写一次完整的索引检查点
+CHECKPOINT_EVERY_RECORDS = 1000
+CHECKPOINT_EVERY_BYTES = 64 * 1024 * 1024
+
+# 压缩时每批读取 (移入冷存储) 的向量数与每批查找近邻的查询数；
+# 每批在索引锁内完成，期间新对话的索引需要等待，搜索不受影响
+COMPACTION_BATCH_SIZE = 4096
+DEDUP_BATCH_SIZE = 64
 
 class HistoryStore:
     """对话历史存储管理类 (集成 FAISS 语义索引)"""
 
-    def __init__(self, db_path: str, faiss_index_dir: str = './cache/'):
+    def __init__(self, db_path: str, faiss_index_dir: str = './cache/',
+                 use_embedding_cache: bool = True, embedding_cache_items: int = 10000,
+                 checkpoint_every_records: int = CHECKPOINT_EVERY_RECORDS,
+                 checkpoint_every_bytes: int = CHECKPOINT_EVERY_BYTES,
+                 index_config: Optional[dict] = None, sqlite_pragmas: Optional[dict] = None,
+                 lexical_config: Optional[dict] = None, retrieval_cache_config: Optional[dict] = None,
+                 summary_config: Optional[dict] = None, compaction_config: Optional[dict] = None,
+                 mmap_index: bool = True, read_only: bool = False):
         self.db_path = db_path
         self.faiss_index_dir = faiss_index_dir
         self.faiss_path = os.path.join(faiss_index_dir, 'history.faiss')
-        self.map_path = os.path.join(faiss_index_dir, 'history_map.pkl')
+        self.meta_path = os.path.join(faiss_index_dir, 'history_meta.json')
+        self.log_path = os.path.join(faiss_index_dir, 'history.wal')
+        # 向量元数据 (行 id、会话、轮次等) 的 .npy 列，随检查点写入
+        self.vector_meta_dir = os.path.join(faiss_index_dir, 'history_vectors')
+        # 检查点以 mmap 只读打开：启动耗时与历史规模无关，多个进程共享页缓存。
+        # 写入进程在第一次修改索引时才把它读入私有内存
+        self.mmap_index = mmap_index
+        self._index_mapped = False
+        # 只读模式 (查看历史、评测等)：不写 SQLite 和索引文件，只看到最近一次检查点中的向量
+        self.read_only = read_only
+        self.checkpoint_every_records = checkpoint_every_records
+        self.checkpoint_every_bytes = checkpoint_every_bytes
+        self.index_config = ann_index.resolve_config(index_config)
+        # FTS5 全文索引 (BM25) 的检索配置
+        self.lexical_config = lexical.resolve_config(lexical_config)
+        # 检索统计：快速路径省下的查询编码次数等
+        self.search_stats = {"queries": 0, "fast_path": 0, "embedded": 0, "two_stage": 0, "cold": 0}
+        self._term_df_cache = {}
+        self._term_df_total = 0
+        # 检索结果缓存，按索引纪元失效
+        self.retrieval_cache = RetrievalCache(retrieval_cache_config)
+        # 会话/对话块摘要与两阶段检索的配置
+        self.summary_config = memory_summary.resolve_config(summary_config)
+        self.summaries: Optional[SummaryIndex] = None
+        # 有尚未被摘要覆盖的对话的会话 -> 已覆盖到的轮次
+        self._pending_sessions = {}
+        # 向量压缩、去重与保留策略；移出内存索引的向量可存入 float16 冷存储
+        self.compaction_config = compaction.resolve_config(compaction_config)
+        self.cold_store: Optional[ColdStore] = None
+        self.last_compaction = {}
+        self._compaction_thread: Optional[threading.Thread] = None
+        self._migration_thread: Optional[threading.Thread] = None
+        # 替换索引对象的后台任务 (压缩、迁移) 与原地删除向量、重建互斥
+        self._compaction_lock = threading.Lock()
+        self._saves_since_compaction = 0
+        # 读写锁：搜索 (及读取向量) 持有读锁、可并行进行；写索引 (添加、删除、检查点、替换索引对象) 持有写锁。
+        # 编码在锁外进行，多个会话的保存只在写入索引时短暂串行
+        self._index_lock = RWLock()
+        self.vector_log = None
+        # 已写入索引的最大 conversation_history.id (检查点 + 向量日志中的最大行 id)
+        self.indexed_hwm = 0
+        # 行被替换/删除或索引重建时递增；与高水位线一起构成索引纪元
+        self.index_generation = 0
+        # 每个向量的会话/轮次/角色/时间戳，用于过滤搜索和结果映射
+        self.vector_meta = VectorMetadata()
+        self.embedding_cache_path = os.path.join(faiss_index_dir, 'embedding_cache.db')
 
         db_dir = os.path.dirname(db_path)
         if db_dir and not os.path.exists(db_dir):
@@ -25,12 +110,25 @@ class HistoryStore:
         if not os.path.exists(faiss_index_dir):
             os.makedirs(faiss_index_dir)
 
+        # 每个线程一个长连接 (WAL 模式)，不再每次操作都打开/关闭数据库
+        self.db = SQLitePool(db_path, sqlite_pragmas)
         self._init_database()
+        # 嵌入缓存与索引文件放在同一目录，重建索引时可直接读盘而无需重新编码
+        if use_embedding_cache and EMBEDDING_CLIENT.cache is None and not read_only:
+            EMBEDDING_CLIENT.set_cache(
+                EmbeddingCache(self.embedding_cache_path, EMBEDDING_CLIENT.cache_namespace, embedding_cache_items)
+            )
         self.vector_dim = EMBEDDING_CLIENT.vector_dim
-        self.index, self.faiss_map = self._load_or_init_faiss_index()
+        # 向量以 conversation_history 的行 id 为键存放在 IndexIDMap2 中
+        self.index = self._load_or_init_faiss_index()
+        if self.index is not None and self.compaction_config["cold_tier"]:
+            self.cold_store = ColdStore(faiss_index_dir, self.vector_dim)
+        if self.summary_config["enabled"]:
+            self.summaries = SummaryIndex(self.db, self.vector_dim)
+            self._pending_sessions = self._load_pending_sessions()
 
     def _init_database(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.db.connection()
         cursor = conn.cursor()
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS conversation_history (
@@ -53,85 +151,339 @@ class HistoryStore:
             total_turns INTEGER DEFAULT 0
         )
         """)
-        conn.commit()
-        conn.close()
+        # 索引状态 (高水位线等)，与检查点中的值保持一致
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS index_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """)
+        # 被 INSERT OR REPLACE 覆盖的行，其旧向量需要从索引中移除
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS index_journal (
+            row_id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            turn_number INTEGER NOT NULL,
+            role TEXT NOT NULL
+        )
+        """)
+        # 压缩时被合并的重复向量：较早的行 -> 保留其向量的较新行 (同一会话、同角色)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS vector_alias (
+            row_id INTEGER PRIMARY KEY,
+            target_id INTEGER NOT NULL
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_vector_alias_target ON vector_alias (target_id)")
+        if self.lexical_config["enabled"]:
+            try:
+                if lexical.create_fts(conn):
+                    print("Created FTS5 full-text index for conversation history.")
+            except sqlite3.OperationalError as e:
+                print(f"FTS5 unavailable ({e}), lexical search disabled.")
+                self.lexical_config["enabled"] = False
+        # "某会话最近 N 轮" 按 (session_id, turn_number) 倒序扫描，
+        # 由 UNIQUE(session_id, turn_number, role) 的自动索引直接支持；
+        # 会话列表按开始时间倒序，需要单独的索引
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_start_time ON sessions (start_time)")
+        memory_summary.create_tables(conn)
 
     def _load_or_init_faiss_index(self):
-        if self.vector_dim == 384 and EMBEDDING_CLIENT.model is None:
+        # 模型延迟加载：这里只检查已经失败的加载，不触发加载
+        if EMBEDDING_CLIENT.load_failed:
              print("FAISS indexing disabled: Embedding model not loaded.")
-             return None, {}
+             return None
 
-        if os.path.exists(self.faiss_path) and os.path.exists(self.map_path):
+        index, checkpoint_seq, hwm, meta = None, 0, 0, {}
+        if os.path.exists(self.faiss_path):
             try:
-                index = faiss.read_index(self.faiss_path)
-                with open(self.map_path, 'rb') as f:
-                    faiss_map = pickle.load(f)
-                print(f"Loaded FAISS index with {index.ntotal} vectors.")
-                return index, faiss_map
+                meta = self._read_meta()
+                index, self._index_mapped = ann_index.read_index(
+                    self.faiss_path, meta.get("index_type"), self.mmap_index, self.index_config
+                )
+                if not ann_index.is_id_keyed(index) or "hwm" not in meta:
+                    raise ValueError("legacy position-keyed index")
+                if meta.get("ntotal", index.ntotal) != index.ntotal:
+                    raise ValueError("index and meta files are from different checkpoints")
+                checkpoint_seq = meta.get("log_seq", 0)
+                hwm = meta.get("hwm", 0)
+                print(f"Loaded FAISS index ({ann_index.index_type_of(index)}) with {index.ntotal} vectors"
+                      f"{' (memory-mapped)' if self._index_mapped else ''}.")
             except Exception as e:
                 print(f"Error loading index: {e}. Creating new one.")
+                index, checkpoint_seq, hwm, meta = None, 0, 0, {}
+                self._index_mapped = False
+
+        if index is None:
+            print("Initializing new FAISS index...")
+            index = ann_index.create_index(self.vector_dim, "flat", self.index_config)
 
-        print("Initializing new FAISS index...")
-        index = faiss.IndexFlatIP(self.vector_dim) 
-        faiss_map = {} 
-        return index, faiss_map
+        # 检查点中的向量元数据：优先 mmap 打开 .npy 列，不存在或与检查点不一致时从 SQLite 读取
+        snapshot = VectorMetadata.load(self.vector_meta_dir, meta.get("meta_tag", ""))
+        if snapshot is not None and len(snapshot) == index.ntotal:
+            self.vector_meta = snapshot
+        else:
+            self._load_vector_meta(index, 0, hwm)
+        self.indexed_hwm = hwm
+        if self.read_only:
+            # 检查点之后追加的向量在写入进程下次写检查点后可见
+            return index
 
+        # 重放检查点之后追加的向量日志
+        self.vector_log = VectorLog(self.log_path, self.vector_dim)
+        records = list(self.vector_log.replay(after_seq=checkpoint_seq))
+        if records:
+            if self._index_mapped:
+                index, self._index_mapped = ann_index.read_index(self.faiss_path, mmap=False, cfg=self.index_config)
+            row_ids = np.array([row_id for _, row_id, _ in records], dtype='int64')
+            index.add_with_ids(np.stack([vector for _, _, vector in records]), row_ids)
+            self.indexed_hwm = max(hwm, int(row_ids.max()))
+            self._load_vector_meta(index, hwm, self.indexed_hwm)
+            print(f"Replayed {len(records)} vectors from the vector log.")
+        self._store_hwm()
+        return index
+
+    def _load_vector_meta(self, index: faiss.Index, after: int, upto: int):
+        """从 SQLite 载入已索引行 (id 在 (after, upto] 内，且未被压缩移出索引) 的元数据"""
+        if after == 0:
+            self.vector_meta.clear()
+        cursor = self.db.connection().execute(
+            "SELECT id, session_id, turn_number, role, timestamp FROM conversation_history WHERE id > ? AND id <= ? ORDER BY id",
+            (after, upto)
+        )
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows: break
+            self.vector_meta.add(rows)
+        if len(self.vector_meta) != index.ntotal:
+            # 被去重或按保留策略移出的行仍在 SQLite 中
+            self.vector_meta.remove(np.setdiff1d(self.vector_meta.row_ids(), ann_index.all_ids(index)))
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("HistoryStore was opened read-only.")
+
+    def _ensure_writable(self):
+        """修改索引前调用：映射的检查点是只读的，第一次写入时读入私有内存"""
+        if not self._index_mapped: return
+        self._check_writable()
+        print("Loading the memory-mapped vector index into memory for writing...")
+        self.index, self._index_mapped = ann_index.read_index(self.faiss_path, mmap=False, cfg=self.index_config)
+
+    def _store_hwm(self):
+        """把高水位线同步到 SQLite 的 index_state 表"""
+        self._write_state("indexed_hwm", self.indexed_hwm)
+
+    def _write_state(self, key: str, value):
+        self.db.connection().execute(
+            "INSERT OR REPLACE INTO index_state (key, value) VALUES (?, ?)", (key, str(value))
+        )
+
+    def _read_state(self, key: str, default: str = "") -> str:
+        row = self.db.connection().execute("SELECT value FROM index_state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self.meta_path): return {}
+        with open(self.meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def _atomic_write(path: str, write_fn, mode: str = 'wb'):
+        """先写临时文件并 fsync，再原子替换目标文件"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, mode) as f:
+            write_fn(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @timed("history.checkpoint")
     def _save_faiss_index(self):
+        """
+        写入完整的索引检查点和向量元数据，并清空已被检查点覆盖的向量日志。
+        索引直接写入文件 (不在内存中序列化出一份副本)；history_meta.json 最后写入，
+        其中的 meta_tag 标识与该检查点对应的元数据文件
+        """
         if self.index is None: return
-        faiss.write_index(self.index, self.faiss_path)
-        with open(self.map_path, 'wb') as f:
-            pickle.dump(self.faiss_map, f)
-
-    def _index_text(self, text: str, turn_id: str):
-        """辅助函数：将文本向量化并添加到索引"""
-        vector = EMBEDDING_CLIENT.get_embedding(text)
-        vector = vector.astype('float32').reshape(1, -1)
-        faiss.normalize_L2(vector) 
-        self.index.add(vector)
-        new_faiss_id = self.index.ntotal - 1
-        self.faiss_map[new_faiss_id] = turn_id
+        tmp_path = self.faiss_path + '.tmp'
+        faiss.write_index(self.index, tmp_path)
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.faiss_path)
+        meta_tag = uuid.uuid4().hex
+        self.vector_meta.save(self.vector_meta_dir, meta_tag)
+        meta = {
+            "log_seq": self.vector_log.last_seq,
+            "ntotal": self.index.ntotal,
+            "hwm": self.indexed_hwm,
+            "index_type": ann_index.index_type_of(self.index),
+            "meta_tag": meta_tag,
+        }
+        self._atomic_write(self.meta_path, lambda f: json.dump(meta, f), mode='w')
+        self.vector_log.truncate()
+        # 高水位线可从检查点和日志中的行 id 恢复，SQLite 中的镜像只在检查点时更新
+        self._store_hwm()
+
+    def _maybe_checkpoint(self):
+        """
+        日志超过记录数或大小阈值时写检查点；向量数越过训练阈值时在后台迁移到配置的 ANN 索引
+        (训练耗时可达数十秒，不能阻塞持有写锁的保存)。调用方持有写锁
+        """
+        if ann_index.desired_type(self.index, self.index_config) != ann_index.index_type_of(self.index):
+            self.migrate_async()
+        if (self.vector_log.record_count >= self.checkpoint_every_records
+                or self.vector_log.size_bytes >= self.checkpoint_every_bytes):
+            self._save_faiss_index()
+
+    @staticmethod
+    def _embed_rows(rows: List[Tuple]) -> np.ndarray:
+        """批量向量化 (id, session_id, turn_number, role, content, timestamp) 行 (不需要持锁)"""
+        texts = [f"[{role}]: {content}" for _, _, _, role, content, _ in rows]
+        vectors = EMBEDDING_CLIENT.get_embeddings(texts).astype('float32')
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _index_rows(self, rows: List[Tuple], vectors: np.ndarray, log: bool = True):
+        """
+        辅助函数：以行 id 为键把已编码的行添加到索引并记录元数据 (log=True 时同时追加到向量日志)。
+        调用方持有写锁
+        """
+        if not rows: return
+        row_ids = [row[0] for row in rows]
+        if log:
+            self.vector_log.append(row_ids, vectors)
+        self.indexed_hwm = max(self.indexed_hwm, max(row_ids))
+        self._ensure_writable()
+        self.index.add_with_ids(vectors, np.asarray(row_ids, dtype='int64'))
+        self.vector_meta.add([
+            (row_id, session_id, turn_number, role, timestamp)
+            for row_id, session_id, turn_number, role, _, timestamp in rows
+        ])
 
     def rebuild_faiss_index(self):
         """
-        【修复点】重建 FAISS 索引 (遍历 SQLite 中所有历史记录)
+        全量重建 FAISS 索引：清空索引和高水位线后重新索引 SQLite 中的所有记录
+        (向量大多可从嵌入缓存读取)。日常启动请使用增量的 sync_index()。
         """
-        if self.index is None: return
-        
-        # 1. 检查数据库是否有数据
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT count(*) FROM conversation_history")
-        count = cursor.fetchone()[0]
-        
-        if count == 0:
-            conn.close()
-            return
-
-        # 如果索引为空但数据库有数据，或者强制重建
-        if self.index.ntotal < count:
-            print(f"Rebuilding index for {count} turns (current index: {self.index.ntotal})...")
-            self.index.reset()
-            self.faiss_map = {}
-            
-            cursor.execute("SELECT session_id, turn_number, role, content FROM conversation_history")
+        if self.index is None or self.read_only: return
+        with self._compaction_lock, self._index_lock.writer:
+            self.index = ann_index.create_index(self.vector_dim, "flat", self.index_config)
+            self._index_mapped = False
+            self.vector_meta.clear()
+            self.indexed_hwm = 0
+            self.index_generation += 1
+            self.db.connection().execute("DELETE FROM index_journal")
+            # 冷存储中和被去重合并的对话也重新进入内存索引
+            self.db.connection().execute("DELETE FROM vector_alias")
+            self._write_state("dedup_hwm", 0)
+            if self.cold_store is not None:
+                self.cold_store.clear()
+            # 先把空索引写成检查点，中断后从这里继续而不会与旧向量重复
+            self._save_faiss_index()
+        self.sync_index()
+
+    def sync_index(self, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+        """
+        增量同步索引：先移除被替换行的旧向量，再分批索引高水位线之后的新行。
+        每批写入向量日志并推进高水位线，中断后重新调用即可从断点继续。
+        返回新索引的行数。
+        """
+        if self.index is None or self.read_only or EMBEDDING_CLIENT.model is None: return 0
+        self._apply_index_journal()
+        return self._index_pending_rows(batch_size, verbose=True)
+
+    @timed("history.index")
+    def _index_pending_rows(self, batch_size: int = REBUILD_BATCH_SIZE, verbose: bool = False) -> int:
+        """分批索引 id 大于高水位线的行"""
+        cursor = self.db.connection().cursor()
+        pending = 0
+        if verbose:
+            cursor.execute("SELECT count(*) FROM conversation_history WHERE id > ?", (self.indexed_hwm,))
+            pending = cursor.fetchone()[0]
+            if pending == 0:
+                return 0
+            print(f"Indexing {pending} unindexed turns (high-water mark: {self.indexed_hwm})...")
+
+        done = 0
+        while True:
+            cursor.execute(
+                "SELECT id, session_id, turn_number, role, content, timestamp FROM conversation_history WHERE id > ? ORDER BY id LIMIT ?",
+                (self.indexed_hwm, batch_size)
+            )
             rows = cursor.fetchall()
-            
-            for session_id, turn_number, role, content in rows:
-                text = f"[{role}]: {content}"
-                turn_id = f"{session_id}_{turn_number}"
-                self._index_text(text, turn_id)
-            
+            if not rows or EMBEDDING_CLIENT.model is None: break
+            vectors = self._embed_rows(rows)
+            # 向量先 fsync 到日志，高水位线随之推进。并发保存时其他线程可能已经索引了其中一部分行
+            # (行 id 按提交顺序分配，已索引的行总是高水位线以内的前缀)，只添加剩余的行
+            with self._index_lock.writer:
+                fresh = [i for i, row in enumerate(rows) if row[0] > self.indexed_hwm]
+                self._index_rows([rows[i] for i in fresh], vectors[fresh])
+                self._maybe_checkpoint()
+            done += len(fresh)
+            if verbose:
+                print(f"  indexed {done}/{pending}")
+        if verbose and done:
+            self._store_hwm()
+            print("Index sync complete.")
+        return done
+
+    def _apply_index_journal(self):
+        """按替换日志移除被覆盖行的旧向量 (替换后的新行 id 更大，由 _index_pending_rows 索引)"""
+        conn = self.db.connection()
+        # 原地删除向量，不能与后台压缩同时进行
+        with self._compaction_lock, self._index_lock.writer:
+            stale_ids = [row_id for (row_id,) in conn.execute("SELECT row_id FROM index_journal")]
+            if not stale_ids: return
+
+            self._ensure_writable()
+            self.index = ann_index.remove_ids(self.index, np.array(stale_ids, dtype='int64'), self.index_config)
+            self.vector_meta.remove(stale_ids)
+            self.index_generation += 1
+            print(f"Removed {len(stale_ids)} stale vectors of replaced turns.")
+            # 删除操作无法写入追加日志，直接写检查点后再清空替换日志
             self._save_faiss_index()
-            print("Index rebuild complete.")
-        
-        conn.close()
+            conn.execute("DELETE FROM vector_alias WHERE row_id IN (SELECT row_id FROM index_journal) "
+                         "OR target_id IN (SELECT row_id FROM index_journal)")
+            conn.execute("DELETE FROM index_journal")
 
+    @timed("history.save_turn")
     def save_turn(self, session_id: str, turn_number: int, user_content: str, assistant_content: str):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        self._check_writable()
         current_time = time.time()
         created_at = datetime.fromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')
-        
+
+        # 一轮对话的全部写入放在一个短事务中
+        with METRICS.span("history.sqlite_write"), self.db.transaction() as cursor:
+            replaced = self._write_turn(cursor, session_id, turn_number, user_content, assistant_content,
+                                        current_time, created_at)
+        # 覆盖已有轮次时，缓存中引用该轮旧内容的检索结果全部失效
+        if replaced:
+            self.index_generation += 1
+        if self.summaries is not None:
+            # 新对话在会话结束并生成摘要之前，总是作为两阶段检索的候选；被覆盖的轮次所在的块需要重新摘要
+            covered = self._pending_sessions.get(session_id, self.summaries.coverage.get(session_id, 0))
+            self._pending_sessions[session_id] = min(covered, turn_number - 1)
+
+        # 添加到 FAISS：索引高水位线之后的行 (通常就是刚写入的两行，user 与 assistant 一次批量编码)，
+        # 只追加到向量日志 (O(1))，由 _maybe_checkpoint 按阈值写完整检查点
+        if self.index is not None and EMBEDDING_CLIENT.model is not None:
+            self._index_pending_rows()
+            self._saves_since_compaction += 1
+            interval = self.compaction_config["interval_turns"]
+            if self.compaction_config["enabled"] and interval and self._saves_since_compaction >= interval:
+                self.compact_async()
+
+    @staticmethod
+    def _write_turn(cursor, session_id: str, turn_number: int, user_content: str, assistant_content: str,
+                    current_time: float, created_at: str) -> bool:
+        """写入一轮对话，返回是否覆盖了已有的轮次"""
+        # 即将被 INSERT OR REPLACE 覆盖的旧行记入替换日志，其向量在下次同步时移除
+        replaced = cursor.execute(
+            "INSERT OR IGNORE INTO index_journal (row_id, session_id, turn_number, role) "
+            "SELECT id, session_id, turn_number, role FROM conversation_history WHERE session_id = ? AND turn_number = ?",
+            (session_id, turn_number)
+        ).rowcount > 0
         # 保存到 SQLite
         cursor.execute(
             "INSERT OR REPLACE INTO conversation_history (session_id, turn_number, role, content, timestamp, created_at) VALUES (?, ?, 'user', ?, ?, ?)",
@@ -146,76 +498,948 @@ class HistoryStore:
             "UPDATE sessions SET last_update = ?, total_turns = ? WHERE session_id = ?",
             (current_time, turn_number, session_id),
         )
-        conn.commit()
-        conn.close()
-
-        # 添加到 FAISS
-        if self.index is not None:
-            self._index_text(f"[user]: {user_content}", f"{session_id}_{turn_number}")
-            self._index_text(f"[assistant]: {assistant_content}", f"{session_id}_{turn_number}")
-            self._save_faiss_index()
+        return replaced
 
     def update_session_total_turns(self, session_id: str, total_turns: int):
         """【修复点】更新会话总轮数"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
+        self._check_writable()
+        self.db.connection().execute(
             "UPDATE sessions SET total_turns = ?, last_update = ? WHERE session_id = ?",
             (total_turns, time.time(), session_id)
         )
-        conn.commit()
-        conn.close()
+        # 会话结束：为新增的对话生成摘要
+        self.consolidate_session(session_id)
+
+    @timed("history.bulk_insert")
+    def bulk_insert(self, rows: List[Tuple[str, int, str, str, float]], vectors: Optional[np.ndarray] = None,
+                    replace: bool = False, state: Optional[Tuple[str, str]] = None) -> int:
+        """
+        批量导入 (session_id, turn_number, role, content, timestamp) 行：一个事务内 executemany 写入对话和会话，
+        再一次批量编码并添加到索引 (追加到向量日志，但不写检查点)。全部导入后调用 finish_bulk_insert() 写一次检查点。
+        vectors 与 rows 一一对应 (例如导出的向量)，值为 NaN 的行照常编码；
+        replace=False 时已存在的轮次保持不变，replace=True 时与 save_turn 一样覆盖。
+        state 为 (key, value)，与这批行在同一事务中写入 index_state，用于记录导入进度。
+        导入期间不应有其他线程写入。返回实际写入的行数。
+        """
+        self._check_writable()
+        # 先索引之前遗留的未索引行 (例如上次导入在编码前中断)，高水位线之后只剩本批的行
+        if self.index is not None and EMBEDDING_CLIENT.model is not None:
+            self._index_pending_rows()
+
+        params, sessions = [], {}
+        for session_id, turn_number, role, content, timestamp in rows:
+            params.append((session_id, turn_number, role, content, timestamp,
+                           datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')))
+            start, end, turns = sessions.get(session_id, (timestamp, timestamp, turn_number))
+            sessions[session_id] = (min(start, timestamp), max(end, timestamp), max(turns, turn_number))
+        replaced = 0
+        with self.db.transaction() as conn:
+            last_id = conn.execute("SELECT coalesce(max(id), 0) FROM conversation_history").fetchone()[0]
+            if replace:
+                replaced = conn.executemany(
+                    "INSERT OR IGNORE INTO index_journal (row_id, session_id, turn_number, role) "
+                    "SELECT id, session_id, turn_number, role FROM conversation_history "
+                    "WHERE session_id = ? AND turn_number = ? AND role = ?",
+                    [(session_id, turn_number, role) for session_id, turn_number, role, _, _ in rows]
+                ).rowcount
+            conn.executemany(
+                f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO conversation_history "
+                "(session_id, turn_number, role, content, timestamp, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                params
+            )
+            # 已有会话只扩展时间范围和轮数
+            conn.executemany(
+                """
+                INSERT INTO sessions (session_id, start_time, start_time_str, last_update, total_turns)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    start_time_str = CASE WHEN excluded.start_time < start_time THEN excluded.start_time_str
+                                     ELSE start_time_str END,
+                    start_time = min(start_time, excluded.start_time),
+                    last_update = max(last_update, excluded.last_update),
+                    total_turns = max(total_turns, excluded.total_turns)
+                """,
+                [(session_id, start, datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S'), end, turns)
+                 for session_id, (start, end, turns) in sessions.items()]
+            )
+            if state is not None:
+                conn.execute("INSERT OR REPLACE INTO index_state (key, value) VALUES (?, ?)", state)
+            inserted = conn.execute(
+                "SELECT id, session_id, turn_number, role, content, timestamp FROM conversation_history "
+                "WHERE id > ? ORDER BY id",
+                (last_id,)
+            ).fetchall()
+        if replaced:
+            self.index_generation += 1
+        if self.summaries is not None:
+            for session_id, turn_number in {(row[1], row[2]) for row in inserted}:
+                covered = self._pending_sessions.get(session_id, self.summaries.coverage.get(session_id, 0))
+                self._pending_sessions[session_id] = min(covered, turn_number - 1)
+        if self.index is None or not inserted or EMBEDDING_CLIENT.model is None:
+            return len(inserted)
+
+        # 给定的向量按 (会话, 轮次, 角色) 对应到写入的行 (同一批中重复的行以实际保留的一条为准)
+        batch_vectors = np.full((len(inserted), self.vector_dim), np.nan, dtype=np.float32)
+        if vectors is not None:
+            position = {}
+            for i, (session_id, turn_number, role, _, _) in enumerate(rows):
+                if replace or (session_id, turn_number, role) not in position:
+                    position[(session_id, turn_number, role)] = i
+            for j, row in enumerate(inserted):
+                batch_vectors[j] = vectors[position[(row[1], row[2], row[3])]]
+        missing = np.flatnonzero(np.isnan(batch_vectors).any(axis=1))
+        if len(missing):
+            batch_vectors[missing] = self._embed_rows([inserted[j] for j in missing])
+        faiss.normalize_L2(batch_vectors)
+        with self._index_lock.writer:
+            fresh = [j for j, row in enumerate(inserted) if row[0] > self.indexed_hwm]
+            self._index_rows([inserted[j] for j in fresh], batch_vectors[fresh])
+        return len(inserted)
+
+    def finish_bulk_insert(self):
+        """批量导入结束：移除被覆盖行的旧向量，向量数越过训练阈值时迁移索引类型，写一次检查点"""
+        if self.index is None or self.read_only: return
+        self._apply_index_journal()
+        self.migrate_index()
+        with self._index_lock.writer:
+            self._save_faiss_index()
+        self._store_hwm()
+
+    def get_vectors(self, row_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        按行 id 取出向量 (内存索引或冷存储中的)，返回 (找到的掩码, 找到的向量，按 row_ids 的顺序)。
+        PQ 索引与冷存储中的向量是近似值
+        """
+        row_ids = np.asarray(row_ids, dtype='int64')
+        found = np.zeros(len(row_ids), dtype=bool)
+        vectors = np.zeros((len(row_ids), self.vector_dim), dtype=np.float32)
+        if self.index is None or not len(row_ids): return found, vectors[:0]
+        found[:] = np.isin(row_ids, self.vector_meta.present(row_ids))
+        if found.any():
+            with self._index_lock.reader:
+                vectors[found] = self.index.reconstruct_batch(row_ids[found])
+        if self.cold_store is not None and len(self.cold_store) and not found.all():
+            rest = np.flatnonzero(~found)
+            in_cold, cold_vectors = self.cold_store.get(row_ids[rest])
+            vectors[rest[in_cold]] = cold_vectors
+            found[rest[in_cold]] = True
+        if not found.all():
+            # 被去重合并的行使用保留的行的向量 (别名总是指向未被合并的行)
+            rest = np.flatnonzero(~found)
+            placeholders = ",".join("?" * len(rest))
+            targets = dict(self.db.connection().execute(
+                f"SELECT row_id, target_id FROM vector_alias WHERE row_id IN ({placeholders})",
+                [int(row_id) for row_id in row_ids[rest]]
+            ).fetchall())
+            if targets:
+                rest = np.array([i for i in rest if int(row_ids[i]) in targets], dtype='int64')
+                in_target, target_vectors = self.get_vectors(
+                    np.array([targets[int(row_id)] for row_id in row_ids[rest]], dtype='int64'))
+                vectors[rest[in_target]] = target_vectors
+                found[rest[in_target]] = True
+        return found, vectors[found]
+
+    def _load_pending_sessions(self) -> dict:
+        """轮数多于摘要覆盖范围的会话 (上次未正常结束的会话、摘要功能开启前的历史)"""
+        return {
+            session_id: self.summaries.coverage.get(session_id, 0)
+            for session_id, total_turns in self.db.connection().execute("SELECT session_id, total_turns FROM sessions")
+            if total_turns > self.summaries.coverage.get(session_id, 0)
+        }
+
+    @timed("history.consolidate")
+    def consolidate_session(self, session_id: str) -> int:
+        """
+        为会话生成或更新对话块摘要和会话摘要。增量进行：只处理已覆盖轮次所在的块及之后的块。
+        块向量为块内对话向量的平均 (直接从索引取出，不重新编码)，摘要文本抽取自各轮用户提问。
+        返回更新的块数。
+        """
+        if self.summaries is None or self.index is None: return 0
+        block_turns = self.summary_config["block_turns"]
+        covered = self._pending_sessions.get(session_id, self.summaries.coverage.get(session_id, 0))
+        start_turn = (covered // block_turns) * block_turns + 1
+        rows = self.db.connection().execute(
+            """
+            SELECT id, turn_number, role, content, timestamp FROM conversation_history
+            WHERE session_id = ? AND turn_number >= ? ORDER BY turn_number, role DESC
+            """,
+            (session_id, start_turn)
+        ).fetchall()
+
+        blocks = {}
+        for row in rows:
+            blocks.setdefault((row[1] - 1) // block_turns, []).append(row)
+        updated = 0
+        for block_no, block_rows in sorted(blocks.items()):
+            row_ids = self.vector_meta.present(np.array([row[0] for row in block_rows], dtype='int64'))
+            if len(row_ids) == 0: continue
+            with self._index_lock.reader:
+                vectors = self.index.reconstruct_batch(row_ids)
+            turns = {row[1] for row in block_rows}
+            timestamps = [row[4] for row in block_rows]
+            self.summaries.upsert(
+                session_id, "block", block_no * block_turns + 1, max(turns), min(timestamps), max(timestamps),
+                len(turns), memory_summary.extract_summary(
+                    [row[3] for row in block_rows if row[2] == "user"], self.summary_config["summary_tokens"]
+                ),
+                memory_summary.centroid(vectors),
+            )
+            updated += 1
+
+        if updated:
+            self._write_session_summary(session_id)
+        self._pending_sessions.pop(session_id, None)
+        return updated
+
+    def _write_session_summary(self, session_id: str):
+        """会话摘要：向量为各块向量按轮数加权的平均，文本从各块摘要中再抽取"""
+        vectors, weights = self.summaries.block_vectors(session_id)
+        if len(vectors) == 0: return
+        start_time, end_time, last_turn, turn_count = self.db.connection().execute(
+            """
+            SELECT min(start_time), max(end_time), max(last_turn), sum(turn_count) FROM memory_summaries
+            WHERE session_id = ? AND level = 'block'
+            """,
+            (session_id,)
+        ).fetchone()
+        block_summaries = [summary for level, _, _, summary in self.summaries.get_summaries(session_id) if level == "block"]
+        self.summaries.upsert(
+            session_id, "session", 1, last_turn, start_time, end_time, turn_count,
+            memory_summary.extract_summary(block_summaries, self.summary_config["summary_tokens"]),
+            memory_summary.centroid(vectors, weights),
+        )
+
+    def consolidate_sessions(self, session_ids: Optional[List[str]] = None) -> int:
+        """为多个会话生成摘要，默认处理全部待处理的会话 (启动时补齐上次未结束的会话)。返回更新的块数"""
+        if self.summaries is None or self.index is None or self.read_only: return 0
+        if session_ids is None:
+            for session_id, covered in self._load_pending_sessions().items():
+                self._pending_sessions[session_id] = min(covered, self._pending_sessions.get(session_id, covered))
+            session_ids = list(self._pending_sessions)
+        if len(session_ids) > 100:
+            print(f"Summarizing {len(session_ids)} sessions...")
+        updated = 0
+        for i, session_id in enumerate(session_ids, 1):
+            updated += self.consolidate_session(session_id)
+            if len(session_ids) > 100 and i % 1000 == 0:
+                print(f"  summarized {i}/{len(session_ids)} sessions")
+        return updated
+
+    def get_session_summaries(self, session_id: str) -> List[Tuple]:
+        """会话的摘要 [(level, first_turn, last_turn, summary)]，会话摘要在前"""
+        if self.summaries is None: return []
+        return self.summaries.get_summaries(session_id)
+
+    def _coarse_candidates(self, query_vector: np.ndarray, eligible: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """
+        两阶段检索的第一阶段：在摘要索引中选出相关的对话块 (或会话)，返回其中对话的行 id，
+        再加上尚未被摘要覆盖的新对话。不适用 (规模较小、待摘要的会话过多、没有命中) 时返回 None，表示全量搜索。
+        行 id 通过 (session_id, turn_number) 索引读取，开销与选中的块数成正比，与历史总量无关。
+        """
+        cfg = self.summary_config
+        if self.summaries is None or not cfg["two_stage"] or not len(self.summaries): return None
+        if self.index.ntotal < cfg["min_vectors"] or len(self._pending_sessions) > cfg["max_pending_sessions"]:
+            return None
+        hits = self.summaries.search(query_vector, cfg["candidates"], cfg["level"])
+        if not hits: return None
+        ranges = [(session_id, first_turn, last_turn) for session_id, first_turn, last_turn, _ in hits]
+        ranges += [(session_id, covered + 1, MAX_TURN) for session_id, covered in list(self._pending_sessions.items())]
+        conn = self.db.connection()
+        row_ids = []
+        for session_id, first_turn, last_turn in ranges:
+            row_ids.extend(row_id for (row_id,) in conn.execute(
+                "SELECT id FROM conversation_history WHERE session_id = ? AND turn_number BETWEEN ? AND ?",
+                (session_id, first_turn, last_turn)
+            ))
+        candidates = self.vector_meta.present(np.unique(np.array(row_ids, dtype='int64')))
+        if eligible is not None:
+            candidates = np.intersect1d(candidates, eligible)
+        if len(candidates) == 0: return None
+        self.search_stats["two_stage"] += 1
+        return candidates
+
+    @property
+    def _cold_searchable(self) -> bool:
+        return self.cold_store is not None and len(self.cold_store) > 0 and self.compaction_config["cold_search"]
+
+    @property
+    def vector_count(self) -> int:
+        return int(self.index.ntotal) if self.index is not None else 0
 
-    def search_history_index(self, query: str, top_k: int = 5, similarity_threshold: float = 0.0) -> List[Tuple[str, float]]:
+    @property
+    def index_epoch(self) -> Tuple[int, int]:
+        """索引纪元 (generation, 高水位线)：追加对话推进高水位线，替换/删除/重建推进 generation"""
+        return self.index_generation, self.indexed_hwm
+
+    @timed("history.search")
+    def search_history_index(self, query: str, top_k: int = 5, similarity_threshold: float = 0.0,
+                             session_id: Optional[str] = None, role: Optional[str] = None,
+                             since: Optional[float] = None, until: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        混合检索，返回 [(turn_id, score)]。
+        session_id / role / since / until (Unix 时间戳) 用于过滤：只对满足条件的向量打分，
+        而不是先全局搜索再丢弃。
+        启用全文索引时：查询含编号、代码等精确词且 BM25 命中明确，直接返回 (score 记为 1.0，不做向量编码)；
+        否则语义结果与 BM25 结果按倒数排名融合排序，score 为余弦相似度，
+        只被 BM25 命中的轮次同样要满足 similarity_threshold。
+        """
+        filters = (session_id, role, since, until)
+        scope = (top_k, similarity_threshold) + filters
+        start = time.perf_counter()
+        cached = self._cache_lookup(query, scope)
+        if cached is not None and cached.hwm == self.indexed_hwm:
+            self._record_cache("hits", cached.cost - (time.perf_counter() - start))
+            return list(cached.results)
+
+        lexical_rows, fast_turns = self._lexical_stage(query, top_k, filters)
+        if fast_turns is not None:
+            return self._fast_results(fast_turns, top_k)
+        if self.index is None or self.index.ntotal == 0 or EMBEDDING_CLIENT.model is None:
+            return self._fuse([], lexical_rows, top_k, self._embed_query(query) if lexical_rows else None,
+                              similarity_threshold)
+
+        eligible, aliases = self._select_eligible(filters)
+        if eligible is not None and len(eligible) == 0 and not self._cold_searchable:
+            return self._fuse([], lexical_rows, top_k, self._embed_query(query) if lexical_rows else None,
+                              similarity_threshold)
+
+        if cached is not None:
+            # 缓存之后只追加了新对话：沿用缓存的查询向量，只在新增向量中补搜
+            query_vector, outcome = cached.query_vector.reshape(1, -1), "refreshes"
+        else:
+            query_vector = self._embed_query(query)
+            cached = self._cache_similar(query_vector, scope)
+            outcome = "misses" if cached is None else "near_hits"
+        if session_id is None:
+            coarse = self._coarse_candidates(query_vector, eligible)
+            if coarse is not None:
+                eligible = coarse
+        results, semantic = self._semantic_stage(query_vector, top_k, similarity_threshold, eligible,
+                                                 lexical_rows, cached, cold=True, filters=filters,
+                                                 aliases=aliases)
+        elapsed = time.perf_counter() - start
+        self._record_cache(outcome, cached.cost - elapsed if cached is not None else 0.0)
+        self._cache_store(query, scope, query_vector, semantic, results, elapsed if cached is None else cached.cost)
+        return results
+
+    def search_history_batch(self, queries: List[str], top_k: int = 5,
+                             similarity_threshold: float = 0.0) -> List[List[Tuple[str, float]]]:
+        """
+        批量检索：缓存命中和走快速路径之外的查询一次批量编码，再逐个搜索。
+        返回与 queries 对应的结果列表
+        """
+        scope = (top_k, similarity_threshold, None, None, None, None)
+        results = [None] * len(queries)
+        lexical_rows = [None] * len(queries)
+        fast_turns = [None] * len(queries)
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            cached = self._cache_lookup(query, scope)
+            if cached is not None and cached.hwm == self.indexed_hwm:
+                self._record_cache("hits", cached.cost - (time.perf_counter() - start))
+                results[i] = list(cached.results)
+                continue
+            lexical_rows[i], fast_turns[i] = self._lexical_stage(query, top_k, (None, None, None, None))
+            if fast_turns[i] is not None:
+                results[i] = self._fast_results(fast_turns[i], top_k)
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending: return results
+
+        query_vectors = None
+        if EMBEDDING_CLIENT.model is not None:
+            self.search_stats["embedded"] += len(pending)
+            query_vectors = EMBEDDING_CLIENT.get_embeddings([queries[i] for i in pending]).astype('float32')
+            faiss.normalize_L2(query_vectors)
+        for row, i in enumerate(pending):
+            start = time.perf_counter()
+            query_vector = None if query_vectors is None else query_vectors[row:row + 1]
+            if query_vector is None or self.index is None or self.index.ntotal == 0:
+                results[i] = self._fuse([], lexical_rows[i], top_k, query_vector, similarity_threshold)
+                continue
+            eligible = self._coarse_candidates(query_vector, None)
+            results[i], semantic = self._semantic_stage(query_vector, top_k, similarity_threshold, eligible,
+                                                        lexical_rows[i], cold=True)
+            self._record_cache("misses")
+            self._cache_store(queries[i], scope, query_vector, semantic, results[i], time.perf_counter() - start)
+        return results
+
+    def semantic_candidates(self, query_vector: np.ndarray, top_k: int, similarity_threshold: float,
+                            filters: Tuple) -> List[Tuple[str, float]]:
+        """
+        只做向量检索 (过滤、两阶段、冷存储，不融合 BM25、不经过缓存)，返回按相似度排序的至多 2 * top_k 轮。
+        分片存储在各分片上调用：余弦相似度在分片之间可以直接比较，合并后再统一融合
+        """
         if self.index is None or self.index.ntotal == 0: return []
+        eligible, aliases = self._select_eligible(filters)
+        if eligible is not None and len(eligible) == 0 and not self._cold_searchable: return []
+        if filters[0] is None:
+            coarse = self._coarse_candidates(query_vector, eligible)
+            if coarse is not None:
+                eligible = coarse
+        _, semantic = self._semantic_stage(query_vector, top_k, similarity_threshold, eligible, [],
+                                           cold=True, filters=filters, aliases=aliases)
+        return semantic
+
+    def _cache_lookup(self, query: str, scope: Tuple) -> Optional[CacheEntry]:
+        """精确层查找；缓存后追加的向量过多 (补搜不划算) 或结果不可补齐时视为未命中"""
+        if not self.retrieval_cache.enabled: return None
+        entry = self.retrieval_cache.get(query, scope, self.index_generation)
+        if entry is None or entry.hwm == self.indexed_hwm: return entry
+        if not entry.refreshable or self.indexed_hwm - entry.hwm > self.retrieval_cache.config["refresh_max_rows"]:
+            return None
+        return entry
+
+    def _cache_similar(self, query_vector: np.ndarray, scope: Tuple) -> Optional[CacheEntry]:
+        if not self.retrieval_cache.enabled: return None
+        entry = self.retrieval_cache.get_similar(query_vector, scope, self.index_generation)
+        if entry is None or self.indexed_hwm - entry.hwm > self.retrieval_cache.config["refresh_max_rows"]:
+            return None
+        return entry
+
+    def _cache_store(self, query: str, scope: Tuple, query_vector: np.ndarray,
+                     semantic: Optional[List[Tuple[str, float]]], results: List[Tuple[str, float]], cost: float):
+        if not self.retrieval_cache.enabled: return
+        self.retrieval_cache.put(query, CacheEntry(
+            scope, self.index_generation, self.indexed_hwm, query_vector.reshape(-1).copy(), semantic, results, cost
+        ))
+
+    def _record_cache(self, outcome: str, saved_seconds: float = 0.0):
+        """累计缓存命中统计并计入指标 (retrieval_cache.* 计数器，saved_ms 为省下的检索耗时)"""
+        if not self.retrieval_cache.enabled: return
+        self.retrieval_cache.record(outcome, saved_seconds)
+        METRICS.counter(f"retrieval_cache.{outcome}")
+        if saved_seconds > 0:
+            METRICS.counter("retrieval_cache.saved_ms", saved_seconds * 1000.0)
+
+    @staticmethod
+    def _filter_sql(filters: Tuple) -> Tuple[str, list]:
+        """过滤条件 (session_id, role, since, until) 对应的 " AND ..." 子句 (conversation_history 别名为 h) 与参数"""
+        clauses, params = [], []
+        for clause, value in zip(("h.session_id = ?", "h.role = ?", "h.timestamp >= ?", "h.timestamp <= ?"), filters):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return "".join(f" AND {clause}" for clause in clauses), params
+
+    def _alias_hits(self, filters: Tuple) -> Dict[int, str]:
+        """满足过滤条件的被合并轮次：{保留的行 id: 较早的 turn_id}"""
+        where, params = self._filter_sql(filters)
+        rows = self.db.connection().execute(
+            f"""
+            SELECT a.target_id, h.session_id, h.turn_number
+            FROM vector_alias a JOIN conversation_history h ON h.id = a.row_id
+            WHERE 1{where}
+            """,
+            params
+        ).fetchall()
+        aliases = {}
+        for target_id, session_id, turn_number in rows:
+            aliases.setdefault(target_id, f"{session_id}_{turn_number}")
+        return aliases
+
+    def _select_eligible(self, filters: Tuple) -> Tuple[Optional[np.ndarray], Dict[int, str]]:
+        """
+        满足过滤条件的向量行 id (没有过滤条件时为 None)，以及别名命中：
+        被去重合并的较早轮次满足条件而保留的行不满足时，保留的行也参与搜索，命中时记为较早的轮次。
+        返回 (行 id, {保留的行 id: 较早的 turn_id})
+        """
+        # 元数据的各列在写入时整体追加，与写入并发读取需要持读锁
+        with self._index_lock.reader:
+            eligible = self.vector_meta.select(*filters)
+        if eligible is None: return None, {}
+        aliases = self._alias_hits(filters)
+        if not aliases: return eligible, {}
+        targets = np.array(sorted(aliases), dtype='int64')
+        with self._index_lock.reader:
+            targets = self.vector_meta.present(np.setdiff1d(targets, eligible))
+        return np.union1d(eligible, targets), {row_id: aliases[row_id] for row_id in targets.tolist()}
+
+    def _lexical_search(self, terms: List[str], operator: str, limit: int, filters: Tuple,
+                        min_coverage: float = 0.0) -> List[Tuple[int, str, float]]:
+        """
+        FTS5 检索，返回按 BM25 排序的 [(row_id, turn_id, bm25)] (bm25 越小越相关)。
+        min_coverage > 0 时丢弃包含的查询词比例低于该值的行。
+        """
+        where, params = self._filter_sql(filters)
+        params = [lexical.match_expression(terms, operator)] + params
+        rows = self.db.connection().execute(
+            f"""
+            SELECT h.id, h.session_id, h.turn_number, h.content, bm25(conversation_fts) AS score
+            FROM conversation_fts JOIN conversation_history h ON h.id = conversation_fts.rowid
+            WHERE conversation_fts MATCH ?{where}
+            ORDER BY score LIMIT ?
+            """,
+            (*params, limit)
+        ).fetchall()
+        needed = min_coverage * len(terms)
+        return [
+            (row_id, f"{session_id}_{turn_number}", score)
+            for row_id, session_id, turn_number, content, score in rows
+            if not min_coverage or sum(term.lower() in content.lower() for term in terms) >= needed
+        ]
+
+    @timed("history.lexical_search")
+    def _lexical_stage(self, query: str, top_k: int, filters: Tuple):
+        """
+        全文检索阶段，返回 (BM25 候选行, 快速路径命中的轮次)。
+        快速路径：所有精确词同时命中 (AND) 且命中的轮次不超过 fast_path_max_hits 时，直接作为结果 (不编码查询)。
+        """
+        self.search_stats["queries"] += 1
+        cfg = self.lexical_config
+        if not cfg["enabled"]: return [], None
+        terms, specific = lexical.query_terms(query)
+        if cfg["fast_path"] and specific:
+            limit = cfg["fast_path_max_hits"] * 2 + 1
+            rows = self._lexical_search(specific, "AND", limit, filters)
+            turn_ids = list(dict.fromkeys(turn_id for _, turn_id, _ in rows))
+            if rows and len(rows) < limit and len(turn_ids) <= cfg["fast_path_max_hits"]:
+                self.search_stats["fast_path"] += 1
+                METRICS.counter("lexical.fast_path")
+                return rows, turn_ids
+        terms = self._selective_terms(terms)
+        if not terms: return [], None
+        return self._lexical_search(terms, "OR", cfg["candidates"], filters, cfg["min_term_coverage"]), None
+
+    def _selective_terms(self, terms: List[str]) -> List[str]:
+        """
+        去掉出现在超过 max_term_df 比例轮次中的常见词。
+        词频查询结果缓存，历史增长超过 10% 后失效 (词的相对频率变化缓慢)。
+        """
+        conn = self.db.connection()
+        total = conn.execute("SELECT max(id) FROM conversation_history").fetchone()[0] or 0
+        if total > self._term_df_total * 1.1 or len(self._term_df_cache) > TERM_DF_CACHE_ITEMS:
+            self._term_df_cache = {}
+            self._term_df_total = total
+        limit = self.lexical_config["max_term_df"] * total
+        selected = []
+        for term in terms:
+            freq = self._term_df_cache.get(term)
+            if freq is None:
+                freq = self._term_df_cache[term] = lexical.term_doc_freq(conn, term)
+            if 0 < freq <= limit:
+                selected.append(term)
+        return selected
+
+    def _semantic_stage(self, query_vector: np.ndarray, top_k: int, similarity_threshold: float,
+                        eligible: Optional[np.ndarray], lexical_rows: List[Tuple],
+                        cached: Optional[CacheEntry] = None, cold: bool = False,
+                        filters: Tuple = (None, None, None, None), aliases: Optional[Dict[int, str]] = None
+                        ) -> Tuple[List[Tuple[str, float]], Optional[List[Tuple[str, float]]]]:
+        """
+        向量检索；有 BM25 候选时与之融合 (prefilter 模式下只在候选集内做向量搜索)。
+        传入 cached 时只在其高水位线之后新增的向量中搜索，并与缓存的语义结果合并。
+        cold=True 时同时按同样的过滤条件 filters 暴力搜索冷存储，与内存索引的结果按相似度合并。
+        aliases 为过滤检索的别名命中 (见 _select_eligible)。
+        返回 (结果, 融合前的语义结果)；prefilter 的语义结果依赖候选集，不可缓存补齐，返回 None。
+        """
+        # 语义结果固定取 2 * top_k 轮，便于之后与不同的 BM25 候选融合
+        fetch = top_k * 2
+        cfg = self.lexical_config
+        if lexical_rows and cfg["mode"] == "prefilter" and len(lexical_rows) >= cfg["prefilter_min"]:
+            candidates = self.vector_meta.present(np.array([row_id for row_id, _, _ in lexical_rows], dtype='int64'))
+            if eligible is not None:
+                candidates = np.intersect1d(candidates, eligible)
+            if len(candidates):
+                semantic = self._search_vector(query_vector, fetch, similarity_threshold, candidates, aliases)
+                return self._fuse(semantic, lexical_rows, top_k, query_vector, similarity_threshold), None
+        if cached is None:
+            semantic = self._search_vector(query_vector, fetch, similarity_threshold, eligible, aliases)
+        else:
+            fresh = self.vector_meta.ids_after(cached.hwm)
+            if eligible is not None:
+                fresh = np.intersect1d(fresh, eligible)
+            merged = dict(cached.semantic)
+            if len(fresh):
+                for turn_id, score in self._search_vector(query_vector, fetch, similarity_threshold, fresh, aliases):
+                    merged[turn_id] = max(score, merged.get(turn_id, score))
+            semantic = sorted(merged.items(), key=lambda item: -item[1])[:fetch]
+        # 冷存储与内存索引的结果按相似度合并 (只在结果不足时才搜索，会让移入冷存储的强命中输给内存中的弱命中)；
+        # 缓存的语义结果已包含冷存储的命中，冷存储只在压缩时改变 (压缩使缓存失效)，补搜时不再重复
+        if cold and cached is None and self._cold_searchable:
+            merged = dict(semantic)
+            for turn_id, score in self._search_cold(query_vector, fetch, similarity_threshold, filters):
+                merged[turn_id] = max(score, merged.get(turn_id, score))
+            semantic = sorted(merged.items(), key=lambda item: -item[1])[:fetch]
+        return self._fuse(semantic, lexical_rows, top_k, query_vector, similarity_threshold), semantic
+
+    def _fuse(self, semantic: List[Tuple[str, float]], lexical_rows: List[Tuple], top_k: int,
+              query_vector: Optional[np.ndarray] = None, similarity_threshold: float = 0.0) -> List[Tuple[str, float]]:
+        """
+        语义结果与 BM25 结果 (按轮次去重) 按倒数排名融合排序，分数仍为余弦相似度；
+        只被 BM25 命中的轮次按其向量计算余弦，低于阈值的丢弃
+        """
+        lexical_turns = list(dict.fromkeys(turn_id for _, turn_id, _ in lexical_rows))
+        if not lexical_turns:
+            return semantic[:top_k]
+        scores = dict(semantic)
+        scores.update(self._lexical_scores(query_vector, lexical_rows,
+                                           [turn_id for turn_id in lexical_turns if turn_id not in scores],
+                                           similarity_threshold))
+        return lexical.fuse_scored(semantic, lexical_turns, scores, top_k, self.lexical_config["rrf_k"])
+
+    def _lexical_scores(self, query_vector: Optional[np.ndarray], lexical_rows: List[Tuple], turn_ids: List[str],
+                        similarity_threshold: float) -> Dict[str, float]:
+        """
+        BM25 命中的轮次与查询的余弦相似度 (取该轮各行向量中的最大值，向量从内存索引或冷存储重建)，
+        只返回不低于阈值的轮次。没有向量的行 (无法编码查询、尚未建索引) 余弦记为 0.0
+        """
+        wanted = set(turn_ids)
+        rows = [(row_id, turn_id) for row_id, turn_id, _ in lexical_rows if turn_id in wanted]
+        if not rows: return {}
+        scores = {}
+        if query_vector is not None:
+            found, vectors = self.get_vectors(np.array([row_id for row_id, _ in rows], dtype='int64'))
+            found_turns = [turn_id for (_, turn_id), ok in zip(rows, found) if ok]
+            for turn_id, score in zip(found_turns, vectors @ query_vector.reshape(-1)):
+                scores[turn_id] = max(float(score), scores.get(turn_id, -1.0))
+        scores = {turn_id: scores.get(turn_id, 0.0) for _, turn_id in rows}
+        return {turn_id: score for turn_id, score in scores.items() if score >= similarity_threshold}
+
+    @staticmethod
+    def _fast_results(turn_ids: List[str], top_k: int) -> List[Tuple[str, float]]:
+        """
+        快速路径的结果：按 BM25 顺序。查询中的精确词全部命中 (AND) 视为满足相似度阈值，score 记为 1.0，
+        不编码查询 (省去的正是编码的开销)
+        """
+        return [(turn_id, 1.0) for turn_id in turn_ids[:top_k]]
 
+    def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        """编码并归一化查询；没有嵌入模型时返回 None"""
+        if EMBEDDING_CLIENT.model is None: return None
+        self.search_stats["embedded"] += 1
         query_vector = EMBEDDING_CLIENT.get_embedding(query).reshape(1, -1).astype('float32')
-        faiss.normalize_L2(query_vector) 
+        faiss.normalize_L2(query_vector)
+        return query_vector
+
+    @timed("history.vector_search")
+    def _search_vector(self, query_vector: np.ndarray, top_k: int, similarity_threshold: float,
+                       eligible: Optional[np.ndarray] = None,
+                       aliases: Optional[Dict[int, str]] = None) -> List[Tuple[str, float]]:
+        # 每轮最多两个向量 (user/assistant)，先取 2 * top_k 个，去重后不足再加倍
+        limit = self.index.ntotal if eligible is None else len(eligible)
+        if limit == 0: return []
+        fetch = min(top_k * 2, limit)
+        while True:
+            with self._index_lock.reader:
+                if eligible is None:
+                    D, I = self.index.search(query_vector, fetch)
+                else:
+                    D, I = ann_index.search_filtered(self.index, query_vector, fetch, eligible, self.index_config)
+            results = self._collect_hits(D[0], I[0], top_k, similarity_threshold, aliases)
+            exhausted = len(I[0]) == 0 or I[0][-1] == -1 or D[0][-1] < similarity_threshold
+            if len(results) >= top_k or fetch >= limit or exhausted:
+                return results
+            fetch = min(fetch * 2, limit)
 
-        D, I = self.index.search(query_vector, top_k * 5) # 搜索更多以备过滤
-        
+    def _collect_hits(self, distances, row_ids, top_k: int, similarity_threshold: float,
+                      aliases: Optional[Dict[int, str]] = None) -> List[Tuple[str, float]]:
+        """按轮次去重，并跳过已被替换/删除的行的残留向量；aliases 中的行记为其别名对应的较早轮次"""
         results = []
         seen_turns = set()
-        
-        for distance, faiss_id in zip(D[0], I[0]):
-            if faiss_id == -1: continue
+        for distance, row_id in zip(distances, row_ids):
+            if row_id == -1: continue
             if distance < similarity_threshold: continue
-            
-            turn_id = self.faiss_map.get(faiss_id)
-            if turn_id and turn_id not in seen_turns:
+
+            if aliases and row_id in aliases:
+                turn_id = aliases[row_id]
+            else:
+                meta = self.vector_meta.lookup(row_id)
+                if meta is None: continue
+                turn_id = f"{meta[0]}_{meta[1]}"
+            if turn_id not in seen_turns:
                 results.append((turn_id, float(distance)))
                 seen_turns.add(turn_id)
-            
+
             if len(results) >= top_k: break
-                
+
         return results
 
+    def compact_async(self) -> Optional[threading.Thread]:
+        """在后台线程中压缩索引 (上一次压缩尚未结束时不重复启动)"""
+        if self._compaction_thread is not None and self._compaction_thread.is_alive(): return None
+        self._saves_since_compaction = 0
+        self._compaction_thread = threading.Thread(target=self._compact_in_background, name="history-compaction",
+                                                   daemon=True)
+        self._compaction_thread.start()
+        return self._compaction_thread
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Warn: Index compaction failed: {e}")
+
+    def migrate_async(self) -> Optional[threading.Thread]:
+        """在后台线程中把索引迁移到配置的类型 (上一次迁移尚未结束时不重复启动)"""
+        if self._migration_thread is not None and self._migration_thread.is_alive(): return None
+        self._migration_thread = threading.Thread(target=self._migrate_in_background, name="history-migration",
+                                                  daemon=True)
+        self._migration_thread.start()
+        return self._migration_thread
+
+    def _migrate_in_background(self):
+        try:
+            self.migrate_index()
+        except Exception as e:
+            print(f"Warn: Vector index migration failed: {e}")
+
+    @timed("history.migrate")
+    def migrate_index(self) -> bool:
+        """
+        向量数越过训练阈值时把索引迁移到配置的类型，返回是否完成了迁移。
+        与 compact() 相同：只在导出快照时持读锁，训练和构建在锁外进行，期间搜索和保存照常使用旧索引；
+        最后在写锁内补上期间新增的向量、替换索引并写检查点
+        """
+        if self.index is None or self.read_only: return False
+        with self._compaction_lock:
+            with self._index_lock.reader:
+                source, hwm = self.index, self.indexed_hwm
+                target_type = ann_index.desired_type(source, self.index_config)
+            if target_type == ann_index.index_type_of(source): return False
+            new_index = ann_index.migrate(source, target_type, self.index_config, lock=self._index_lock.reader)
+            with self._index_lock.writer:
+                if self.index is not source:
+                    print("Vector index was replaced during migration, skipping.")
+                    return False
+                # 期间新增的向量 (删除与替换索引都要先取得压缩锁，期间只可能追加)
+                late = self.vector_meta.ids_after(hwm)
+                if len(late):
+                    new_index.add_with_ids(np.ascontiguousarray(source.reconstruct_batch(late)), late)
+                self.index = new_index
+                self._index_mapped = False
+                self._save_faiss_index()
+            return True
+
+    @timed("history.compact")
+    def compact(self) -> dict:
+        """
+        压缩向量索引：移除被替换行的旧向量、同角色的重复向量 (保留最新的一条) 和保留策略之外的向量
+        (移入冷存储)，然后按剩余向量数重建索引。
+        重建在索引的快照 (高水位线以内的向量) 上进行，期间搜索照常使用旧索引，新对话照常写入；
+        最后在索引锁内补上期间新增的向量并替换索引、写检查点。
+        返回压缩前后的内存概况和各类移除的向量数。
+        """
+        cfg = self.compaction_config
+        if self.index is None or self.read_only or not cfg["enabled"]: return {}
+        with self._compaction_lock:
+            start = time.perf_counter()
+            conn = self.db.connection()
+            with self._index_lock.reader:
+                before = compaction.memory_report(self.index, self.vector_meta.nbytes, self.cold_store,
+                                                  self.index_config)
+                source, hwm = self.index, self.indexed_hwm
+                indexed = self.vector_meta.row_ids()
+                journal = [row_id for (row_id,) in conn.execute("SELECT row_id FROM index_journal")]
+                expired = self.vector_meta.expired(time.time(), cfg["max_age_days"], cfg["max_sessions"],
+                                                   cfg["max_vectors"])
+            superseded = np.intersect1d(np.array(journal, dtype='int64'), indexed)
+            expired = np.setdiff1d(expired[expired <= hwm], superseded)
+            # 只为上次压缩之后新增、且仍保留在内存索引中的向量查找重复
+            fresh = indexed[indexed > int(self._read_state("dedup_hwm", "0"))]
+            excluded = np.union1d(superseded, expired)
+            aliases = self._find_duplicates(source, np.setdiff1d(fresh, excluded))
+            duplicates = np.setdiff1d(np.array(sorted(aliases), dtype='int64'), excluded)
+            aliases = {row_id: aliases[row_id] for row_id in duplicates.tolist()}
+            drop = np.union1d(np.union1d(superseded, duplicates), expired)
+            removed = {"superseded": len(superseded), "duplicates": len(duplicates), "expired": len(expired)}
+
+            if len(drop):
+                new_index = ann_index.rebuild_subset(source, np.setdiff1d(indexed, drop), self.index_config,
+                                                     lock=self._index_lock.reader)
+            with self._index_lock.writer:
+                if self.index is not source:
+                    # 期间索引被迁移或重建，本次结果作废
+                    print("Vector index was replaced during compaction, skipping.")
+                    return {}
+                if len(drop):
+                    # 确认替换之后才把过期的向量移入冷存储 (作废时它们仍在内存索引中，不能重复写入)
+                    if self.cold_store is not None and len(expired):
+                        for i in range(0, len(expired), COMPACTION_BATCH_SIZE):
+                            batch = expired[i:i + COMPACTION_BATCH_SIZE]
+                            self.cold_store.append(batch, source.reconstruct_batch(batch))
+                    # 期间新增的向量 (IVF-PQ 下按重建的近似向量重新编码)
+                    late = self.vector_meta.ids_after(hwm)
+                    if len(late):
+                        new_index.add_with_ids(np.ascontiguousarray(source.reconstruct_batch(late)), late)
+                    self.index = new_index
+                    self._index_mapped = False
+                    self.vector_meta.remove(drop)
+                    self.index_generation += 1
+                    self._save_faiss_index()
+                if aliases:
+                    with self.db.transaction() as cursor:
+                        # 指向本次被合并的行的旧别名改为指向新的保留行
+                        cursor.executemany("UPDATE vector_alias SET target_id = ? WHERE target_id = ?",
+                                           [(target, row_id) for row_id, target in aliases.items()])
+                        cursor.executemany("INSERT OR REPLACE INTO vector_alias (row_id, target_id) VALUES (?, ?)",
+                                           list(aliases.items()))
+                if journal:
+                    conn.executemany("DELETE FROM vector_alias WHERE row_id = ? OR target_id = ?",
+                                     [(row_id, row_id) for row_id in journal])
+                    conn.executemany("DELETE FROM index_journal WHERE row_id = ?", [(row_id,) for row_id in journal])
+                self._write_state("dedup_hwm", hwm)
+                after = compaction.memory_report(self.index, self.vector_meta.nbytes, self.cold_store,
+                                                 self.index_config)
+            del source
+            self.last_compaction = {"before": before, "after": after, "removed": removed,
+                                    "seconds": time.perf_counter() - start}
+            print(compaction.format_report(before, after, removed, self.last_compaction["seconds"]))
+            return self.last_compaction
+
+    def _find_duplicates(self, index: faiss.Index, row_ids: np.ndarray) -> Dict[int, int]:
+        """
+        在索引中查找 row_ids 的近邻，返回 {被较新向量重复的较早行 id: 保留的行 id}
+        (连续的重复合并到最新的一条)。PQ 索引只保存近似向量，相似度不足以判断重复，不做去重。
+        """
+        cfg = self.compaction_config
+        if not cfg["dedup_threshold"] or ann_index.index_type_of(index) == "ivf_pq": return {}
+        aliases = {}
+        for i in range(0, len(row_ids), DEDUP_BATCH_SIZE):
+            batch = row_ids[i:i + DEDUP_BATCH_SIZE]
+            with self._index_lock.reader:
+                dropped, kept = compaction.find_duplicates(
+                    index, batch, index.reconstruct_batch(batch), self.vector_meta.groups(batch),
+                    self.vector_meta.group_of, cfg["dedup_threshold"], cfg["dedup_neighbors"]
+                )
+            aliases.update(zip(dropped.tolist(), kept.tolist()))
+        for row_id, target in aliases.items():
+            while target in aliases:
+                target = aliases[target]
+            aliases[row_id] = target
+        return aliases
+
+    def _search_cold(self, query_vector: np.ndarray, top_k: int, similarity_threshold: float,
+                     filters: Tuple = (None, None, None, None)) -> List[Tuple[str, float]]:
+        """
+        在冷存储中暴力搜索，按轮次去重；被替换的行已不在 SQLite 中，其冷向量自然被跳过。
+        有过滤条件时先按 SQLite 中的行元数据选出满足条件的行 id (及别名指向的行)，只对这些冷向量打分
+        """
+        allowed, aliases = None, {}
+        if any(f is not None for f in filters):
+            where, params = self._filter_sql(filters)
+            allowed = np.array([row_id for (row_id,) in self.db.connection().execute(
+                f"SELECT h.id FROM conversation_history h WHERE 1{where}", params
+            )], dtype='int64')
+            aliases = self._alias_hits(filters)
+            if aliases:
+                # 保留的行本身不满足条件时，命中记为满足条件的较早轮次
+                targets = np.array(sorted(aliases), dtype='int64')
+                targets = targets[~np.isin(targets, allowed)]
+                aliases = {row_id: aliases[row_id] for row_id in targets.tolist()}
+                allowed = np.union1d(allowed, targets)
+        scores, row_ids = self.cold_store.search(query_vector, top_k * 2, allowed)
+        keep = scores >= similarity_threshold
+        scores, row_ids = scores[keep], row_ids[keep]
+        if not len(row_ids): return []
+        self.search_stats["cold"] += 1
+        placeholders = ",".join("?" * len(row_ids))
+        turns = {
+            row_id: f"{session_id}_{turn_number}"
+            for row_id, session_id, turn_number in self.db.connection().execute(
+                f"SELECT id, session_id, turn_number FROM conversation_history WHERE id IN ({placeholders})",
+                [int(row_id) for row_id in row_ids]
+            )
+        }
+        turns.update(aliases)
+        results = {}
+        for score, row_id in zip(scores, row_ids):
+            turn_id = turns.get(int(row_id))
+            if turn_id is not None and turn_id not in results:
+                results[turn_id] = float(score)
+        return list(results.items())[:top_k]
+
+    def evaluate_recall(self, k: int = 10, n_queries: int = 200, index_types=ann_index.INDEX_TYPES) -> list:
+        """在当前索引的全部向量上构建各类索引，报告相对 flat 基准的 recall@k 与查询延迟"""
+        if self.index is None or self.index.ntotal == 0: return []
+        vectors, ids = ann_index.export_vectors(self.index)
+        return ann_index.compare_index_types(vectors, ids, self.index_config, index_types, k, n_queries)
+
+    def close(self):
+        """退出前等待后台压缩和迁移结束，把向量日志合并进检查点，并关闭数据库连接"""
+        for thread in (self._compaction_thread, self._migration_thread):
+            if thread is not None:
+                thread.join()
+        if self.index is not None and self.vector_log is not None:
+            if EMBEDDING_CLIENT.is_loaded:
+                self._apply_index_journal()
+            if self.vector_log.record_count:
+                self._save_faiss_index()
+            self.vector_log.close()
+        self.db.close()
+
     def start_session(self) -> str:
+        self._check_writable()
         session_id = str(int(time.time() * 1000000))
         current_time = time.time()
         start_time_str = datetime.fromtimestamp(current_time).strftime('%Y-%m-%d %H:%M:%S')
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
+        self.db.connection().execute(
             "INSERT INTO sessions (session_id, start_time, start_time_str, last_update, total_turns) VALUES (?, ?, ?, ?, ?)",
             (session_id, current_time, start_time_str, current_time, 0)
         )
-        conn.commit()
-        conn.close()
         return session_id
 
+    def get_all_sessions(self) -> List[Tuple]:
+        """获取所有会话列表 (按开始时间倒序)"""
+        return self.db.connection().execute(
+            "SELECT session_id, start_time_str, total_turns FROM sessions ORDER BY start_time DESC"
+        ).fetchall()
+
+    @timed("history.recent")
+    def get_recent_history(self, session_id: str, n_turns: int) -> List[Tuple]:
+        """获取会话最近 n_turns 轮 (user + assistant)，按轮次正序返回，格式同 get_session_history"""
+        if n_turns <= 0: return []
+        # 沿 (session_id, turn_number) 索引倒序扫描，只读取最近的行
+        return self.db.connection().execute(
+            """
+            SELECT turn_number, role, content, timestamp, created_at
+            FROM conversation_history
+            WHERE session_id = ? AND turn_number >= (
+                SELECT min(turn_number) FROM (
+                    SELECT DISTINCT turn_number FROM conversation_history
+                    WHERE session_id = ? ORDER BY turn_number DESC LIMIT ?
+                )
+            )
+            ORDER BY turn_number ASC, role DESC
+            """,
+            (session_id, session_id, n_turns)
+        ).fetchall()
+
+    @timed("history.fetch_turns")
+    def get_turns_by_ids(self, turn_ids: List[str]) -> List[Tuple]:
+        """
+        按 search_history_index 返回的 turn_id ("<session_id>_<turn_number>") 批量获取对话，
+        可跨会话。返回 [(session_id, turn_number, role, content, timestamp, created_at)]，按时间排序。
+        """
+        by_session = {}
+        for turn_id in turn_ids:
+            session_id, sep, turn_number = turn_id.rpartition('_')
+            if not sep or not turn_number.isdigit(): continue
+            by_session.setdefault(session_id, set()).add(int(turn_number))
+
+        conn = self.db.connection()
+        results = []
+        for session_id, turn_numbers in by_session.items():
+            placeholders = ",".join("?" * len(turn_numbers))
+            results.extend(conn.execute(
+                f"""
+                SELECT session_id, turn_number, role, content, timestamp, created_at
+                FROM conversation_history
+                WHERE session_id = ? AND turn_number IN ({placeholders})
+                """,
+                (session_id, *sorted(turn_numbers))
+            ).fetchall())
+        results.sort(key=lambda row: row[4])
+        return results
+
     def get_session_history(self, session_id: str, limit: Optional[int] = None) -> List[Tuple]:
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        limit_query = f"LIMIT {limit}" if limit is not None else ""
-        query = f"""
+        # LIMIT 作为参数传入 (-1 表示不限制)，SQL 文本固定以便复用预编译语句
+        return self.db.connection().execute(
+            """
             SELECT turn_number, role, content, timestamp, created_at
             FROM conversation_history
             WHERE session_id = ?
             ORDER BY turn_number ASC, role DESC
-            {limit_query}
-            """
-        cursor.execute(query, (session_id,))
-        results = cursor.fetchall()
-        conn.close()
-        return results
\ No newline at end of file
+            LIMIT ?
+            """,
+            (session_id, -1 if limit is None else limit)
+        ).fetchall()
\ No newline at end of file
@@ -0,0 +1,142 @@
+# src/lexical.py
+
+import re
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_LEXICAL_CONFIG = {
+    "enabled": True,
+    # fusion    - 语义检索与 BM25 结果按倒数排名融合 (RRF)
+    # prefilter - BM25 候选足够多时，只在候选集内做向量搜索，再与 BM25 融合
+    "mode": "fusion",
+    # 查询包含编号、代码标识符等精确词且 BM25 命中明确时，跳过向量编码直接返回
+    "fast_path": True,
+    "fast_path_max_hits": 5,   # 精确匹配的轮次不超过该值时才走快速路径
+    "candidates": 50,          # BM25 候选数
+    "min_term_coverage": 0.5,  # 参与融合的 BM25 命中至少包含查询中这个比例的词 (过滤只命中常见片段的弱匹配)
+    # 出现在超过该比例轮次中的常见词不参与 OR 检索：区分度低，且展开的倒排列表是全文检索的主要开销
+    "max_term_df": 0.02,
+    "prefilter_min": 10,       # prefilter 模式下候选数少于该值时退回 fusion
+    "rrf_k": 60,
+}
+
+# trigram 分词器按 3 字符子串建索引，中文无需分词即可子串匹配；短于 3 个字符的词无法检索
+MIN_TERM_CHARS = 3
+
+_TERM_RE = re.compile(r'"([^"]+)"|(\S+)')
+_SPLIT_RE = re.compile(r"[\s,，。！？!?;；:：()（）\[\]【】<>《》'`]+")
+# 编号、日期、代码标识符、路径等“精确”词
+_SPECIFIC_RE = re.compile(r"\d|[_./\\#@-]|[a-z][A-Z]")
+_CJK_RE = re.compile(r"[\u3400-\u9fff]")
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    merged = dict(DEFAULT_LEXICAL_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    if merged["mode"] not in ("fusion", "prefilter"):
+        raise ValueError(f"Unknown lexical mode: {merged['mode']}. Choose from ('fusion', 'prefilter').")
+    return merged
+
+
+def create_fts(conn: sqlite3.Connection) -> bool:
+    """
+    创建与 conversation_history.content 同步的 FTS5 外部内容表 (不重复存储文本)。
+    插入/删除由触发器在同一事务内同步；INSERT OR REPLACE 的隐式删除需要 recursive_triggers。
+    新建时从现有数据回填，返回是否新建。
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_fts'"
+    ).fetchone()
+    if not exists:
+        _create_fts_table(conn)
+    # 词表视图：按 trigram 查文档频率，用于估计查询词的常见程度
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts_vocab USING fts5vocab(conversation_fts, 'row')"
+    )
+    return not exists
+
+
+def _create_fts_table(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE VIRTUAL TABLE conversation_fts USING fts5(
+        content, content='conversation_history', content_rowid='id', tokenize='trigram'
+    )
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS conversation_fts_ai AFTER INSERT ON conversation_history BEGIN
+        INSERT INTO conversation_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """)
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS conversation_fts_ad AFTER DELETE ON conversation_history BEGIN
+        INSERT INTO conversation_fts (conversation_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """)
+    conn.execute("INSERT INTO conversation_fts (conversation_fts) VALUES ('rebuild')")
+
+
+def query_terms(query: str) -> Tuple[List[str], List[str]]:
+    """拆出可检索的词 (去掉 [user]: 前缀和过短的词)，返回 (全部词, 精确词)"""
+    query = re.sub(r"^\[(user|assistant)\]:\s*", "", query.strip())
+    terms, phrases = [], []
+    for phrase, word in _TERM_RE.findall(query):
+        if phrase:
+            phrases.append(phrase)
+        else:
+            terms.extend(t for t in _SPLIT_RE.split(word) if t)
+    # 引号中的短语也视为精确词
+    specific = phrases + [t for t in terms if _SPECIFIC_RE.search(t)]
+    specific = [t for t in specific if len(t) >= MIN_TERM_CHARS]
+    terms = phrases + terms
+    # 较长的中文片段没有空格分词，拆成重叠的三字片段参与 OR 检索
+    expanded = []
+    for t in terms:
+        if len(t) > MIN_TERM_CHARS and _CJK_RE.search(t) and t not in specific:
+            expanded.extend(t[i:i + MIN_TERM_CHARS] for i in range(len(t) - MIN_TERM_CHARS + 1))
+        else:
+            expanded.append(t)
+    seen = set()
+    terms = [t for t in expanded if len(t) >= MIN_TERM_CHARS and not (t in seen or seen.add(t))]
+    return terms, specific
+
+
+def term_doc_freq(conn: sqlite3.Connection, term: str) -> int:
+    """
+    估计包含该词的轮次数：取词中各 trigram 文档频率的最小值 (上界，词表按小写存储)。
+    """
+    term = term.lower()
+    freq = None
+    for i in range(len(term) - MIN_TERM_CHARS + 1):
+        row = conn.execute(
+            "SELECT doc FROM conversation_fts_vocab WHERE term = ?", (term[i:i + MIN_TERM_CHARS],)
+        ).fetchone()
+        doc = row[0] if row else 0
+        freq = doc if freq is None else min(freq, doc)
+        if freq == 0: break
+    return freq or 0
+
+
+def match_expression(terms: Sequence[str], operator: str = "OR") -> str:
+    """把词列表转成 FTS5 MATCH 表达式 (每个词作为短语引用，避免语法字符被解释)"""
+    quoted = ['"' + t.replace('"', '""') + '"' for t in terms]
+    return f" {operator} ".join(quoted)
+
+
+def rrf_fuse(rankings: Iterable[Sequence[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """倒数排名融合：score = sum(1 / (k + rank))，返回按分数降序的 [(key, score)]"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+def fuse_scored(semantic: Sequence[Tuple[str, float]], lexical_turns: Sequence[str], scores: Dict[str, float],
+                top_k: int, k: int = 60) -> List[Tuple[str, float]]:
+    """
+    按倒数排名融合排序，但返回 scores 中的分数 (余弦相似度)，RRF 分数只用于排序。
+    scores 中没有的 BM25 轮次 (余弦低于阈值) 不参与融合。
+    """
+    lexical_turns = [turn_id for turn_id in lexical_turns if turn_id in scores]
+    ranked = rrf_fuse([[turn_id for turn_id, _ in semantic], lexical_turns], k)
+    return [(turn_id, scores[turn_id]) for turn_id, _ in ranked[:top_k]]
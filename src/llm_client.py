@@ -1,57 +1,221 @@
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Union
+
 import requests
-import yaml
+from requests.adapters import HTTPAdapter
+
+from .metrics import METRICS, timed
 
-CFG_PATH = r"E:\\task\\学校任务\\nlp项目\\llm-memory-improvement\\config.yaml"
+# 可重试的 HTTP 状态码 (限流与服务端临时错误)
+RETRY_STATUS = {429, 500, 502, 503, 504}
 
 
 class LLMClient:
     def generate(self, prompt: str, temperature: float = 0.2, **kwargs) -> str:
         raise NotImplementedError
 
+    def generate_stream(self, prompt: str, temperature: float = 0.2, **kwargs) -> Iterator[str]:
+        """默认实现：一次性生成后整体返回"""
+        yield self.generate(prompt, temperature, **kwargs)
+
 
 class ApiLLMClient(LLMClient):
+    """
+    OpenAI 兼容的 chat/completions 客户端。
+    复用 keep-alive 连接池，设置连接/读取超时，失败时按带抖动的指数退避重试；
+    generate_stream 以 server-sent events 方式逐段返回生成的文本。
+    """
 
     def __init__(
         self,
         api_key: str,
         base_url: str,
         model: str,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 120.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        pool_size: int = 4,
     ):
-        with open(CFG_PATH, "r", encoding="utf-8") as f:
-            config = yaml.safe_load(f)
-        self.api_key = config.get("api_key", api_key)
-        self.base_url = config.get("base_url", base_url)
-        self.model = config.get("model", model)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # 长连接会话：后续请求复用 TCP/TLS 连接
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        })
+
+    def _build_payload(self, prompt: str, temperature: float, stream: bool, **kwargs) -> dict:
+        return {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": stream,
+            "max_tokens": kwargs.get("max_tokens", 4096),
+            "enable_thinking": kwargs.get("enable_thinking", False),
+            "thinking_budget": kwargs.get("thinking_budget", 4096),
+            "min_p": kwargs.get("min_p", 0.05),
+            "stop": kwargs.get("stop", None),
+            "temperature": temperature,
+            "top_p": kwargs.get("top_p", 0.7),
+            "top_k": kwargs.get("top_k", 50),
+            "frequency_penalty": kwargs.get("frequency_penalty", 0.5),
+            "n": kwargs.get("n", 1),
+            "response_format": kwargs.get("response_format", {"type": "text"}),
+        }
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """第 attempt 次重试前的等待时间：优先使用 Retry-After，否则为带全抖动的指数退避"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @timed("llm.request")
+    def _post(self, payload: dict, stream: bool) -> requests.Response:
+        """发送请求；连接错误、超时和可重试状态码按退避策略重试"""
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(self.base_url, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                print(f"Warn: LLM request failed ({e.__class__.__name__}), retrying in {delay:.1f}s...")
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response
+                delay = self._backoff(attempt, response.headers.get("Retry-After"))
+                response.close()
+                print(f"Warn: LLM request returned {response.status_code}, retrying in {delay:.1f}s...")
+            METRICS.counter("llm.retries")
+            time.sleep(delay)
+            attempt += 1
 
     def generate(self, prompt: str, temperature: float = 0.7, **kwargs) -> str:
+        if kwargs.pop("stream", False):
+            return "".join(self.generate_stream(prompt, temperature, **kwargs))
         try:
-            payload = {
-                "model": self.model,
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": kwargs.get("stream", False),
-                "max_tokens": kwargs.get("max_tokens", 4096),
-                "enable_thinking": kwargs.get("enable_thinking", False),
-                "thinking_budget": kwargs.get("thinking_budget", 4096),
-                "min_p": kwargs.get("min_p", 0.05),
-                "stop": kwargs.get("stop", None),
-                "temperature": temperature,
-                "top_p": kwargs.get("top_p", 0.7),
-                "top_k": kwargs.get("top_k", 50),
-                "frequency_penalty": kwargs.get("frequency_penalty", 0.5),
-                "n": kwargs.get("n", 1),
-                "response_format": kwargs.get("response_format", {"type": "text"}),
-            }
-
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-            }
-
-            response = requests.post(self.base_url, json=payload, headers=headers)
-            response.raise_for_status()
-
-            result = response.json()
+            payload = self._build_payload(prompt, temperature, stream=False, **kwargs)
+            result = self._post(payload, stream=False).json()
             return result["choices"][0]["message"]["content"]
 
         except Exception as e:
             raise RuntimeError(f"API call failed: {str(e)}")
+
+    def generate_stream(self, prompt: str, temperature: float = 0.7, **kwargs) -> Iterator[str]:
+        """
+        流式生成：解析 server-sent events ("data: {...}" 行，以 "data: [DONE]" 结束)，
+        每收到一段增量文本就立即返回。只在收到第一段文本之前重试。
+        """
+        start = time.perf_counter()
+        try:
+            payload = self._build_payload(prompt, temperature, stream=True, **kwargs)
+            response = self._post(payload, stream=True)
+        except Exception as e:
+            raise RuntimeError(f"API call failed: {str(e)}")
+
+        # SSE 没有声明 charset 时 requests 会按 ISO-8859-1 解码，这里固定为 UTF-8
+        response.encoding = "utf-8"
+        first = True
+        with response:
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"): continue
+                    data = line[len("data:"):].strip()
+                    # [DONE] 之后继续读到响应结束，连接才能放回连接池复用
+                    if data == "[DONE]": continue
+                    choices = json.loads(data).get("choices") or []
+                    if not choices: continue
+                    delta = choices[0].get("delta") or {}
+                    content = delta.get("content")
+                    if content:
+                        if first:
+                            # 首个 token 延迟 (含连接与排队)，用户感受到的就是这段时间
+                            METRICS.observe("llm.first_token", time.perf_counter() - start)
+                            first = False
+                        yield content
+            except (requests.RequestException, ValueError) as e:
+                raise RuntimeError(f"API stream failed: {str(e)}")
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncRateLimiter:
+    """令牌桶限速：平均每秒最多 rate 个请求，允许 burst 个突发"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def generate_many(
+    client: LLMClient,
+    prompts: Iterable[str],
+    concurrency: int = 8,
+    rate_limit: Optional[float] = None,
+    temperature: float = 0.7,
+    on_result: Optional[Callable[[int, Union[str, Exception]], None]] = None,
+    **kwargs,
+) -> List[Union[str, Exception]]:
+    """
+    并发生成：最多 concurrency 个请求同时进行，rate_limit 限制每秒发出的请求数。
+    阻塞的 client.generate 在线程池中执行 (共享 client 的连接池)。
+    每个请求完成时调用 on_result(i, 结果或异常)；返回与 prompts 顺序对应的结果列表，失败的位置为异常对象。
+    """
+    prompts = list(prompts)
+    results: List[Union[str, Exception]] = [None] * len(prompts)
+    if not prompts: return results
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = AsyncRateLimiter(rate_limit, burst=concurrency) if rate_limit else None
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="llm") as executor:
+        async def run_one(i: int, prompt: str):
+            async with semaphore:
+                if limiter is not None:
+                    await limiter.acquire()
+                try:
+                    results[i] = await loop.run_in_executor(
+                        executor, lambda: client.generate(prompt, temperature, **kwargs)
+                    )
+                except Exception as e:
+                    results[i] = e
+            if on_result is not None:
+                on_result(i, results[i])
+
+        await asyncio.gather(*(run_one(i, prompt) for i, prompt in enumerate(prompts)))
+    return results
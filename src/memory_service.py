@@ -0,0 +1,292 @@
+# src/memory_service.py
+
+import json
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional, Tuple, Union
+
+import faiss
+
+from .history_store import HistoryStore
+from .sharded_store import ShardedHistoryStore
+from .metrics import METRICS
+from .prompts import build_prompt, get_evidence
+
+DEFAULT_SERVICE_CONFIG = {
+    "host": "127.0.0.1",
+    "port": 8765,
+    # 处理请求的线程数：每个连接 (HTTP keep-alive) 占用一个线程直到断开或空闲超时
+    "workers": 32,
+    "idle_timeout": 30.0,
+    # 每次 FAISS 搜索使用的 OpenMP 线程数；并发请求多时设为 1，由请求之间的并行利用多核 (0 表示不修改)
+    "faiss_threads": 1,
+}
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    merged = dict(DEFAULT_SERVICE_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    return merged
+
+
+class _Session:
+    def __init__(self, last_turn: int):
+        # 同一会话的请求依次执行 (轮次编号连续)，不同会话之间并行
+        self.lock = threading.Lock()
+        self.last_turn = last_turn
+
+
+class MemoryService:
+    """
+    在一个进程中为多个并发会话提供对话记忆：所有会话共用一个 HistoryStore
+    (索引由其读写锁保护，搜索并行、写入串行)。传入 llm 时还提供完整的对话接口。
+    """
+
+    def __init__(self, history_store: Union[HistoryStore, ShardedHistoryStore], llm=None,
+                 rag_cfg: Optional[dict] = None, system_role: str = "助理", temperature: float = 0.7):
+        self.history_store = history_store
+        self.llm = llm
+        self.rag_cfg = rag_cfg or {}
+        self.system_role = system_role
+        self.temperature = temperature
+        self._sessions: Dict[str, _Session] = {}
+        self._sessions_lock = threading.Lock()
+        self.started_at = time.time()
+
+    def _session(self, session_id: str) -> _Session:
+        with self._sessions_lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                # 服务重启后继续已有的会话：从数据库读取最后一轮
+                recent = self.history_store.get_recent_history(session_id, 1)
+                session = self._sessions[session_id] = _Session(recent[-1][0] if recent else 0)
+            return session
+
+    def start_session(self) -> str:
+        session_id = self.history_store.start_session()
+        with self._sessions_lock:
+            self._sessions[session_id] = _Session(0)
+        return session_id
+
+    def save_turn(self, session_id: str, user_content: str, assistant_content: str,
+                  turn_number: Optional[int] = None) -> int:
+        """保存一轮对话，未给出轮次时取会话的下一轮；返回轮次"""
+        session = self._session(session_id)
+        with session.lock:
+            turn_number = turn_number or session.last_turn + 1
+            self.history_store.save_turn(session_id, turn_number, user_content, assistant_content)
+            session.last_turn = max(session.last_turn, turn_number)
+            return turn_number
+
+    def evidence(self, session_id: str, query: str, top_k: Optional[int] = None,
+                 similarity_threshold: Optional[float] = None) -> str:
+        return get_evidence(
+            self.history_store, session_id, query,
+            top_k=top_k or self.rag_cfg.get("top_k", 5),
+            similarity_threshold=similarity_threshold if similarity_threshold is not None
+            else self.rag_cfg.get("similarity_threshold", 0.5),
+            packing=self.rag_cfg.get("packing"),
+        )
+
+    def chat(self, session_id: str, message: str) -> Tuple[int, str]:
+        """检索证据、调用大模型并保存本轮，返回 (轮次, 回答)"""
+        if self.llm is None:
+            raise RuntimeError("No LLM client configured.")
+        session = self._session(session_id)
+        with session.lock:
+            prompt = build_prompt(self.system_role, message, self.evidence(session_id, message))
+            answer = self.llm.generate(prompt, temperature=self.temperature)
+            turn_number = session.last_turn + 1
+            self.history_store.save_turn(session_id, turn_number, message, answer)
+            session.last_turn = turn_number
+            return turn_number, answer
+
+    def end_session(self, session_id: str) -> int:
+        """结束会话：记录总轮数 (并生成摘要)，返回总轮数"""
+        session = self._session(session_id)
+        with session.lock:
+            self.history_store.update_session_total_turns(session_id, session.last_turn)
+            with self._sessions_lock:
+                self._sessions.pop(session_id, None)
+            return session.last_turn
+
+    def search(self, query: str, top_k: int = 5, similarity_threshold: float = 0.0,
+               **filters) -> List[Tuple[str, float]]:
+        return self.history_store.search_history_index(query, top_k, similarity_threshold, **filters)
+
+    def stats(self) -> dict:
+        store = self.history_store
+        stats = {
+            "uptime_s": time.time() - self.started_at,
+            "open_sessions": len(self._sessions),
+            "vectors": store.vector_count,
+            "search_stats": dict(store.search_stats),
+        }
+        if isinstance(store, ShardedHistoryStore):
+            stats["shards"] = store.describe_shards()
+        else:
+            stats["indexed_hwm"] = store.indexed_hwm
+        return stats
+
+
+class _RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """JSON over HTTP/1.1 (keep-alive)"""
+
+    protocol_version = "HTTP/1.1"
+    service: MemoryService = None
+
+    # (方法, 路径正则, 处理函数名)
+    ROUTES = [
+        ("GET", r"/health", "_health"),
+        ("GET", r"/stats", "_stats"),
+        ("POST", r"/sessions", "_start_session"),
+        ("GET", r"/sessions/(?P<session_id>[^/]+)/history", "_history"),
+        ("POST", r"/sessions/(?P<session_id>[^/]+)/turns", "_save_turn"),
+        ("POST", r"/sessions/(?P<session_id>[^/]+)/evidence", "_evidence"),
+        ("POST", r"/sessions/(?P<session_id>[^/]+)/chat", "_chat"),
+        ("POST", r"/sessions/(?P<session_id>[^/]+)/end", "_end_session"),
+        ("POST", r"/search", "_search"),
+    ]
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        # 每个请求一行的访问日志在高并发下开销明显，只记录错误
+        pass
+
+    def _dispatch(self, method: str):
+        path = self.path.split("?", 1)[0].rstrip("/") or "/"
+        for route_method, pattern, handler in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                break
+        else:
+            self._send(404, {"error": f"No route for {method} {path}"})
+            return
+        try:
+            body = self._read_body()
+            with METRICS.span(f"service.{handler[1:]}"):
+                result = getattr(self, handler)(body, **match.groupdict())
+            self._send(200, result)
+        except _RequestError as e:
+            self._send(e.status, {"error": str(e)})
+        except (KeyError, TypeError, ValueError) as e:
+            self._send(400, {"error": f"Bad request: {e}"})
+        except Exception as e:
+            print(f"Warn: {method} {path} failed: {e}")
+            self._send(500, {"error": str(e)})
+
+    def _read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length: return {}
+        body = json.loads(self.rfile.read(length))
+        if not isinstance(body, dict):
+            raise _RequestError(400, "Request body must be a JSON object.")
+        return body
+
+    def _send(self, status: int, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _health(self, body):
+        return {"status": "ok"}
+
+    def _stats(self, body):
+        return self.service.stats()
+
+    def _start_session(self, body):
+        return {"session_id": self.service.start_session()}
+
+    def _history(self, body, session_id):
+        rows = self.service.history_store.get_session_history(session_id)
+        return {"session_id": session_id, "turns": [list(row) for row in rows]}
+
+    def _save_turn(self, body, session_id):
+        turn_number = self.service.save_turn(session_id, body["user"], body["assistant"], body.get("turn_number"))
+        return {"session_id": session_id, "turn_number": turn_number}
+
+    def _evidence(self, body, session_id):
+        return {"evidence": self.service.evidence(session_id, body["query"], body.get("top_k"),
+                                                  body.get("similarity_threshold"))}
+
+    def _chat(self, body, session_id):
+        turn_number, answer = self.service.chat(session_id, body["message"])
+        return {"session_id": session_id, "turn_number": turn_number, "answer": answer}
+
+    def _end_session(self, body, session_id):
+        return {"session_id": session_id, "total_turns": self.service.end_session(session_id)}
+
+    def _search(self, body):
+        filters = {name: body.get(name) for name in ("session_id", "role", "since", "until")}
+        results = self.service.search(body["query"], body.get("top_k", 5), body.get("similarity_threshold", 0.0),
+                                      **filters)
+        return {"results": [[turn_id, score] for turn_id, score in results]}
+
+
+class MemoryServer(HTTPServer):
+    """
+    固定大小线程池的 HTTP 服务器：不像 ThreadingHTTPServer 那样每个连接新建线程
+    (HistoryStore 为每个线程保持一个 SQLite 长连接，线程数需要有上限)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, service: MemoryService, cfg: Optional[dict] = None):
+        self.cfg = resolve_config(cfg)
+        handler = type("MemoryHandler", (_Handler,), {"service": service, "timeout": self.cfg["idle_timeout"]})
+        super().__init__((self.cfg["host"], self.cfg["port"]), handler)
+        self.service = service
+        self._pool = ThreadPoolExecutor(max_workers=self.cfg["workers"], thread_name_prefix="memory-service")
+        self._connections = set()
+        self._connections_lock = threading.Lock()
+        if self.cfg["faiss_threads"]:
+            faiss.omp_set_num_threads(self.cfg["faiss_threads"])
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle_connection, request, client_address)
+
+    def _handle_connection(self, request, client_address):
+        with self._connections_lock:
+            self._connections.add(request)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self._connections_lock:
+                self._connections.discard(request)
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """停止接受连接，断开空闲的 keep-alive 连接，等待进行中的请求完成"""
+        super().server_close()
+        with self._connections_lock:
+            for request in self._connections:
+                try:
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        self._pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,178 @@
+# src/memory_summary.py
+
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from .evidence_packer import truncate_to_tokens
+from .sqlite_pool import SQLitePool
+
+DEFAULT_SUMMARY_CONFIG = {
+    "enabled": True,
+    "block_turns": 20,         # 每个对话块包含的轮数
+    "summary_tokens": 120,     # 摘要文本的 token 上限
+    # 两阶段检索：先在摘要索引中选出相关的对话块 (或会话)，再只在其中的对话上做向量搜索
+    "two_stage": True,
+    "level": "block",          # 第一阶段的粒度：block / session
+    "candidates": 16,          # 第一阶段选出的块 (或会话) 数
+    "min_vectors": 50000,      # 对话向量少于该值时直接全量搜索 (flat 已足够快且更准)
+    "max_pending_sessions": 64,  # 尚未生成摘要的会话过多时 (如刚导入大量历史)，退回全量搜索
+}
+
+LEVELS = ("block", "session")
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    merged = dict(DEFAULT_SUMMARY_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    if merged["level"] not in LEVELS:
+        raise ValueError(f"Unknown summary level: {merged['level']}. Choose from {LEVELS}.")
+    return merged
+
+
+def create_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS memory_summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        level TEXT NOT NULL,
+        first_turn INTEGER NOT NULL,
+        last_turn INTEGER NOT NULL,
+        start_time REAL NOT NULL,
+        end_time REAL NOT NULL,
+        turn_count INTEGER NOT NULL,
+        summary TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        updated_at REAL NOT NULL,
+        UNIQUE(session_id, level, first_turn)
+    )
+    """)
+
+
+def extract_summary(questions: Sequence[str], max_tokens: int) -> str:
+    """抽取式摘要：依次截取各轮用户提问的开头，合并到 token 上限内"""
+    per_question = max(16, max_tokens // max(1, len(questions)))
+    parts = [truncate_to_tokens(" ".join(q.split()), per_question) for q in questions if q.strip()]
+    return truncate_to_tokens("；".join(parts), max_tokens)
+
+
+def centroid(vectors: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """(加权) 平均后归一化的向量，作为一组对话的粗粒度表示"""
+    mean = np.average(vectors, axis=0, weights=weights).astype(np.float32).reshape(1, -1)
+    faiss.normalize_L2(mean)
+    return mean[0]
+
+
+class SummaryIndex:
+    """
+    会话摘要与对话块摘要：文本和向量保存在 SQLite 的 memory_summaries 表中，
+    每个粒度一个内存中的 flat 内积索引 (条目数与会话/块数成正比，远小于对话数)，启动时从表中载入。
+    """
+
+    def __init__(self, db: SQLitePool, dim: int):
+        self.db = db
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._indexes: Dict[str, faiss.Index] = {}
+        # 摘要 id -> (session_id, level, first_turn, last_turn, turn_count)
+        self._meta: Dict[int, Tuple[str, str, int, int, int]] = {}
+        # (session_id, level, first_turn) -> 摘要 id
+        self._keys: Dict[Tuple[str, str, int], int] = {}
+        # 会话 -> 已被块摘要覆盖到的轮次
+        self.coverage: Dict[str, int] = {}
+        self.load()
+
+    def _new_index(self) -> faiss.Index:
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+
+    def load(self):
+        with self._lock:
+            self._indexes = {level: self._new_index() for level in LEVELS}
+            self._meta.clear()
+            self._keys.clear()
+            self.coverage.clear()
+            rows = self.db.connection().execute(
+                "SELECT id, session_id, level, first_turn, last_turn, turn_count, vector FROM memory_summaries"
+            ).fetchall()
+            by_level: Dict[str, Tuple[List[int], List[np.ndarray]]] = {level: ([], []) for level in LEVELS}
+            for summary_id, session_id, level, first_turn, last_turn, turn_count, blob in rows:
+                vector = np.frombuffer(blob, dtype=np.float32)
+                if level not in by_level or len(vector) != self.dim: continue
+                self._remember(summary_id, session_id, level, first_turn, last_turn, turn_count)
+                by_level[level][0].append(summary_id)
+                by_level[level][1].append(vector)
+            for level, (ids, vectors) in by_level.items():
+                if ids:
+                    self._indexes[level].add_with_ids(np.stack(vectors), np.asarray(ids, dtype=np.int64))
+
+    def _remember(self, summary_id: int, session_id: str, level: str, first_turn: int, last_turn: int,
+                  turn_count: int):
+        self._meta[summary_id] = (session_id, level, first_turn, last_turn, turn_count)
+        self._keys[(session_id, level, first_turn)] = summary_id
+        if level == "block":
+            self.coverage[session_id] = max(self.coverage.get(session_id, 0), last_turn)
+
+    def __len__(self) -> int:
+        return len(self._meta)
+
+    def upsert(self, session_id: str, level: str, first_turn: int, last_turn: int, start_time: float,
+               end_time: float, turn_count: int, summary: str, vector: np.ndarray):
+        """写入 (或替换同一起始轮次的) 摘要，并同步内存索引"""
+        vector = np.ascontiguousarray(vector, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            with self.db.transaction() as conn:
+                conn.execute(
+                    "DELETE FROM memory_summaries WHERE session_id = ? AND level = ? AND first_turn = ?",
+                    (session_id, level, first_turn)
+                )
+                summary_id = conn.execute(
+                    """
+                    INSERT INTO memory_summaries (session_id, level, first_turn, last_turn, start_time, end_time,
+                                                  turn_count, summary, vector, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (session_id, level, first_turn, last_turn, start_time, end_time, turn_count, summary,
+                     vector.tobytes(), time.time())
+                ).lastrowid
+            old_id = self._keys.get((session_id, level, first_turn))
+            if old_id is not None:
+                self._indexes[level].remove_ids(np.asarray([old_id], dtype=np.int64))
+                del self._meta[old_id]
+            self._indexes[level].add_with_ids(vector, np.asarray([summary_id], dtype=np.int64))
+            self._remember(summary_id, session_id, level, first_turn, last_turn, turn_count)
+
+    def block_vectors(self, session_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """会话已有块摘要的 (向量, 轮数)，用于合成会话摘要向量"""
+        with self._lock:
+            ids = [summary_id for summary_id, meta in self._meta.items()
+                   if meta[0] == session_id and meta[1] == "block"]
+            if not ids:
+                return np.zeros((0, self.dim), dtype=np.float32), np.zeros(0)
+            vectors = self._indexes["block"].reconstruct_batch(np.asarray(ids, dtype=np.int64))
+            return vectors, np.asarray([self._meta[summary_id][4] for summary_id in ids], dtype=np.float64)
+
+    def search(self, query_vector: np.ndarray, k: int, level: str = "block") -> List[Tuple[str, int, int, float]]:
+        """返回最相关的 k 个摘要 [(session_id, first_turn, last_turn, score)]"""
+        with self._lock:
+            index = self._indexes[level]
+            if index.ntotal == 0: return []
+            D, I = index.search(query_vector, min(k, index.ntotal))
+            results = []
+            for score, summary_id in zip(D[0], I[0]):
+                if summary_id == -1: continue
+                session_id, _, first_turn, last_turn, _ = self._meta[int(summary_id)]
+                results.append((session_id, first_turn, last_turn, float(score)))
+            return results
+
+    def get_summaries(self, session_id: str) -> List[Tuple]:
+        """会话的摘要 [(level, first_turn, last_turn, summary)]，会话摘要在前"""
+        return self.db.connection().execute(
+            """
+            SELECT level, first_turn, last_turn, summary FROM memory_summaries
+            WHERE session_id = ? ORDER BY level = 'block', first_turn
+            """,
+            (session_id,)
+        ).fetchall()
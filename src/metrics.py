@@ -0,0 +1,237 @@
+# src/metrics.py
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+from typing import Deque, Dict, List, Optional
+
+# 直方图桶上界 (秒)，覆盖从亚毫秒的 SQLite 读取到数十秒的大模型调用
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 滚动窗口保留的最近样本数，用于计算 p50 / p99
+DEFAULT_WINDOW = 1024
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    """累积桶计数 (导出为 Prometheus histogram) + 最近样本的滚动窗口 (计算分位数)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window: int = DEFAULT_WINDOW):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.bucket_counts[i] += 1
+                break
+
+    def quantile(self, q: float) -> float:
+        if not self.recent: return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _NullSpan:
+    """关闭时使用的空 span，进入/退出不做任何事"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """一次计时；嵌套的 span 记录为父 span 的子节点，最外层 span 结束时输出一条 trace"""
+    __slots__ = ("metrics", "name", "attrs", "start", "children")
+
+    def __init__(self, metrics: "Metrics", name: str, attrs: dict):
+        self.metrics = metrics
+        self.name = name
+        self.attrs = attrs
+        self.children: List[dict] = []
+
+    def set(self, **attrs):
+        """附加属性 (如命中数、文本条数)，写入 trace"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.metrics._stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        stack = self.metrics._stack()
+        stack.pop()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.metrics.observe(self.name, duration)
+        node = {"name": self.name, "duration_ms": round(duration * 1000.0, 3)}
+        if self.attrs:
+            node["attrs"] = self.attrs
+        if self.children:
+            node["spans"] = self.children
+        if stack:
+            parent = stack[-1]
+            node["offset_ms"] = round((self.start - parent.start) * 1000.0, 3)
+            parent.children.append(node)
+        else:
+            node["ts"] = time.time() - duration
+            self.metrics._emit_trace(node)
+        return False
+
+
+class Metrics:
+    """
+    轻量的分阶段计时：span() 计时并按名称累积直方图，counter() 计数。
+    trace_path 指定时，每个最外层 span (如一轮对话) 作为一行 JSON 追加写入；
+    export_prometheus() 把直方图和计数器写成 Prometheus 文本格式。
+    默认关闭，关闭时 span() 直接返回空对象，几乎没有开销。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_path: Optional[str] = None
+        self.prometheus_path: Optional[str] = None
+        self.window = DEFAULT_WINDOW
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._trace_file = None
+
+    def configure(self, enabled: bool = True, trace_path: Optional[str] = None,
+                  prometheus_path: Optional[str] = None, window: int = DEFAULT_WINDOW):
+        self.close()
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.prometheus_path = prometheus_path
+        self.window = window
+        if not enabled: return
+        # 两个输出文件可以在不同目录，分别创建
+        for path in (trace_path, prometheus_path):
+            directory = os.path.dirname(path) if path else ""
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        if trace_path:
+            self._trace_file = open(trace_path, "a", encoding="utf-8")
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, attrs)
+
+    def observe(self, name: str, seconds: float):
+        """记录一个耗时样本 (不经过 span，例如流式输出的首个 token 延迟)"""
+        if not self.enabled: return
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram(window=self.window)
+            hist.observe(seconds)
+
+    def counter(self, name: str, value: float = 1):
+        if not self.enabled: return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _emit_trace(self, node: dict):
+        if self._trace_file is None: return
+        line = json.dumps(node, ensure_ascii=False)
+        with self._lock:
+            self._trace_file.write(line + "\n")
+            self._trace_file.flush()
+
+    def snapshot(self) -> Dict[str, dict]:
+        """各阶段的 count / 总耗时 / 滚动分位数 (毫秒)"""
+        with self._lock:
+            stats = {}
+            for name, hist in self.histograms.items():
+                stats[name] = {"count": hist.count, "sum_ms": hist.sum * 1000.0}
+                for q in QUANTILES:
+                    stats[name][f"p{int(q * 100)}_ms"] = hist.quantile(q) * 1000.0
+            return {"stages": stats, "counters": dict(self.counters)}
+
+    def render_prometheus(self) -> str:
+        lines = [
+            "# HELP chat_stage_duration_seconds Duration of each chat pipeline stage.",
+            "# TYPE chat_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name in sorted(self.histograms):
+                hist = self.histograms[name]
+                cumulative = 0
+                for upper, n in zip(hist.buckets, hist.bucket_counts):
+                    cumulative += n
+                    lines.append(f'chat_stage_duration_seconds_bucket{{stage="{name}",le="{upper}"}} {cumulative}')
+                lines.append(f'chat_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {hist.count}')
+                lines.append(f'chat_stage_duration_seconds_sum{{stage="{name}"}} {hist.sum:.6f}')
+                lines.append(f'chat_stage_duration_seconds_count{{stage="{name}"}} {hist.count}')
+            lines.append("# HELP chat_stage_recent_seconds Quantiles over the most recent samples of each stage.")
+            lines.append("# TYPE chat_stage_recent_seconds summary")
+            for name in sorted(self.histograms):
+                hist = self.histograms[name]
+                for q in QUANTILES:
+                    lines.append(f'chat_stage_recent_seconds{{stage="{name}",quantile="{q}"}} {hist.quantile(q):.6f}')
+            lines.append("# HELP chat_events_total Event counters.")
+            lines.append("# TYPE chat_events_total counter")
+            for name in sorted(self.counters):
+                lines.append(f'chat_events_total{{event="{name}"}} {self.counters[name]}')
+        return "\n".join(lines) + "\n"
+
+    def export_prometheus(self, path: Optional[str] = None):
+        """原子地写出 Prometheus 文本文件 (可由 node_exporter 的 textfile collector 采集)"""
+        path = path or self.prometheus_path
+        if not self.enabled or not path: return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+
+def timed(name: str):
+    """装饰器：把函数调用计为一个 span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return fn(*args, **kwargs)
+            with Span(METRICS, name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# 全局实例，各模块共用
+METRICS = Metrics()
@@ -1,15 +1,16 @@
 # src/prompts.py
 #这个版本实现了混合记忆，并稍微放宽了 Prompt 限制。
-from typing import List, Tuple, Set
+from concurrent.futures import Executor
+from typing import List, Optional, Tuple, Set
 from .history_store import HistoryStore
+from .metrics import METRICS, timed
+from .evidence_packer import EvidenceItem, pack_evidence
 
 def _format_history_content(history_list: List[Tuple], current_citation_index: int) -> Tuple[List[str], int]:
     """格式化历史记录"""
     formatted_parts = []
-    # 按轮次排序
-    history_sorted = sorted(history_list, key=lambda x: x[0]) 
-
-    for turn_num, role, content, _, created_at in history_sorted:
+    # 调用方已按时间排好序 (证据可能来自不同会话，轮次编号不可比)
+    for turn_num, role, content, _, created_at in history_list:
         clean_content = " ".join(content.strip().split())
         if not clean_content: continue
         
@@ -19,6 +20,7 @@ def _format_history_content(history_list: List[Tuple], current_citation_index: i
         
     return formatted_parts, current_citation_index
 
+@timed("prompt.build")
 def build_prompt(system_role: str, query: str, evidence: str = "") -> str:
     """
     构建 Prompt。
@@ -41,67 +43,72 @@ def build_prompt(system_role: str, query: str, evidence: str = "") -> str:
     )
     return prompt
 
+@timed("evidence")
 def get_evidence(
     history_store: HistoryStore,
     session_id: str,
     query: str,
     top_k: int = 5,
     similarity_threshold: float = 0.5,
-    recent_n: int = 2 # 新增：强制包含最近 N 轮
+    recent_n: int = 2, # 新增：强制包含最近 N 轮
+    executor: Optional[Executor] = None,
+    semantic_results: Optional[List[Tuple[str, float]]] = None,
+    packing: Optional[dict] = None,
 ) -> str:
     """
-    混合检索：短期记忆 (最近 N 轮) + 长期记忆 (语义检索)
+    混合检索：短期记忆 (最近 N 轮) + 长期记忆 (语义检索，可来自之前的会话)
+    只按编号读取命中的轮次，开销与命中数成正比，而不是与会话长度成正比。
+    传入 executor 时，最近 N 轮的 SQLite 查询与查询向量的编码/搜索并行执行；
+    传入 semantic_results 时 (例如 search_history_batch 的批量结果) 跳过语义检索。
+    packing 为证据打包配置 (见 evidence_packer.DEFAULT_PACKING_CONFIG)：按检索排名和时间挑选证据，
+    去掉重复的轮次，过长的内容只保留与问题相关的段落，使证据不超过 token 预算。
     """
     evidence_parts = []
-    collected_turn_numbers: Set[int] = set()
-    current_citation_index = 1
-    
-    # --- 1. 获取短期记忆 (最近 N 轮，保证对话流畅性) ---
-    # 我们先获取最近的记录 (不经过筛选)
-    # 注意：这里的 limit 需要稍微大一点以确保覆盖 user+assistant
-    recent_history_raw = history_store.get_session_history(session_id, limit=recent_n)
-    
-    for item in recent_history_raw:
-        # item[0] 是 turn_number
-        collected_turn_numbers.add(item[0])
 
-    # --- 2. 获取长期记忆 (语义检索) ---
-    # 只有当历史足够长时才检索，避免重复
-    semantic_results = history_store.search_history_index(
-        query, top_k=top_k, similarity_threshold=similarity_threshold
-    )
-    
-    for turn_id, score in semantic_results:
-        try:
-            t_id_parts = turn_id.rsplit('_', 1)
-            if len(t_id_parts) == 2:
-                 s_id, t_num = t_id_parts
-                 # 无论是否是当前 session，都可以作为长期记忆检索进来
-                 # 这里我们为了简单，假设是同 session 或跨 session 都可以
-                 collected_turn_numbers.add(int(t_num))
-        except ValueError:
-            continue
-            
-    if not collected_turn_numbers:
+    # --- 1. 获取短期记忆 (当前会话最近 N 轮，保证对话流畅性) ---
+    recent_future = None
+    if executor is not None:
+        recent_future = executor.submit(history_store.get_recent_history, session_id, recent_n)
+
+    # --- 2. 获取长期记忆 (语义检索，跨会话) ---
+    if semantic_results is None:
+        semantic_results = history_store.search_history_index(
+            query, top_k=top_k, similarity_threshold=similarity_threshold
+        )
+
+    if recent_future is not None:
+        recent_history = recent_future.result()
+    else:
+        recent_history = history_store.get_recent_history(session_id, recent_n)
+    recent_turn_ids: Set[str] = {f"{session_id}_{item[0]}" for item in recent_history}
+    # 已在短期记忆中的轮次不再重复读取
+    hit_ids = [turn_id for turn_id, _ in semantic_results if turn_id not in recent_turn_ids]
+
+    # --- 3. 按编号批量获取命中的轮次 ---
+    recalled = history_store.get_turns_by_ids(hit_ids)
+
+    if not recent_history and not recalled:
         return ""
 
-    # --- 3. 统一获取内容并去重 ---
-    # 获取当前 session 的历史 (如果需要跨 session，history_store 需要新增 get_turns_by_ids 方法)
-    # 这里简化处理：只获取当前 session 的相关轮次
-    all_history = history_store.get_session_history(session_id)
-    
-    filtered_history = [
-        h for h in all_history if h[0] in collected_turn_numbers
+    # --- 4. 在 token 预算内打包 ---
+    # 先放较早的相关回忆 (已按时间排序)，再放最近的对话
+    rank_of = {turn_id: rank for rank, (turn_id, _) in enumerate(semantic_results)}
+    items = [
+        EvidenceItem(role, content, timestamp, created_at, rank=rank_of.get(f"{sid}_{turn_num}"))
+        for sid, turn_num, role, content, timestamp, created_at in recalled
+    ] + [
+        EvidenceItem(role, content, timestamp, created_at, recent=True)
+        for _, role, content, timestamp, created_at in recent_history
     ]
-    
-    if not filtered_history:
-        return ""
+    packed, stats = pack_evidence(query, items, packing)
+    METRICS.counter("evidence.tokens_raw", stats["tokens_raw"])
+    METRICS.counter("evidence.tokens_packed", stats["tokens_packed"])
 
-    # --- 4. 格式化 ---
-    # 我们将它们区分为 "近期上下文" 和 "相关历史回忆" 也可以，但合并在一起通常模型也能理解
-    # 这里直接合并
+    # --- 5. 格式化 (引用编号按展示顺序分配) ---
     evidence_parts.append("--- 对话记忆 (短期+语义检索) ---")
-    formatted_parts, _ = _format_history_content(filtered_history, 1)
+    formatted_parts, _ = _format_history_content(
+        [(None, item.role, item.content, item.timestamp, item.created_at) for item in packed], 1
+    )
     evidence_parts.extend(formatted_parts)
 
-    return "\n".join(evidence_parts)
\ No newline at end of file
+    return "\n".join(evidence_parts)
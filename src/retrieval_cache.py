@@ -0,0 +1,148 @@
+# src/retrieval_cache.py
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_RETRIEVAL_CACHE_CONFIG = {
+    "enabled": True,
+    "max_items": 1024,          # 精确查询层的最大条目数 (LRU)
+    "ttl_seconds": 600,         # 条目存活时间，0 表示不过期
+    # 近似查询层：查询向量与某个缓存查询的余弦相似度不低于阈值时复用其语义检索结果
+    "semantic": True,
+    "semantic_threshold": 0.95,
+    "semantic_items": 256,
+    # 缓存之后新增的向量超过该数量时不做增量补搜，直接重新检索
+    "refresh_max_rows": 10000,
+}
+
+_SPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT_RE = re.compile(r"[\s?？!！。.,，~～]+$")
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    merged = dict(DEFAULT_RETRIEVAL_CACHE_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    return merged
+
+
+def normalize_query(query: str) -> str:
+    """归一化查询文本：合并空白、忽略大小写和句末标点"""
+    query = _SPACE_RE.sub(" ", query.strip()).casefold()
+    return _TRAILING_PUNCT_RE.sub("", query)
+
+
+class CacheEntry:
+    """
+    一次检索的缓存：最终结果、融合前的语义结果 (增量补搜时与新向量的结果合并) 和查询向量。
+    generation / hwm 为写入时的索引纪元。
+    """
+    __slots__ = ("scope", "generation", "hwm", "query_vector", "semantic", "results", "cost", "stored_at")
+
+    def __init__(self, scope: Hashable, generation: int, hwm: int, query_vector: Optional[np.ndarray],
+                 semantic: Optional[List[Tuple[str, float]]], results: List[Tuple[str, float]], cost: float):
+        self.scope = scope
+        self.generation = generation
+        self.hwm = hwm
+        self.query_vector = query_vector
+        self.semantic = semantic
+        self.results = results
+        self.cost = cost
+        self.stored_at = time.monotonic()
+
+    @property
+    def refreshable(self) -> bool:
+        """语义结果可以通过只搜索新增向量来补齐 (prefilter 模式下的结果依赖候选集，不可补齐)"""
+        return self.semantic is not None
+
+
+class RetrievalCache:
+    """
+    检索结果缓存，两层：
+    - 精确层：键为 (归一化查询文本, 检索范围)，LRU + TTL；
+    - 近似层：按查询向量的余弦相似度查找同一检索范围内的近似查询。
+    条目记录写入时的索引纪元 (generation, hwm)：generation 变化 (行被替换、重建) 时条目失效；
+    只有 hwm 变化 (追加了新对话) 时，调用方只需在新增向量中补搜并合并。
+    """
+
+    def __init__(self, config: Optional[dict] = None):
+        self.config = resolve_config(config)
+        self._entries: "OrderedDict[Tuple[str, Hashable], CacheEntry]" = OrderedDict()
+        self._semantic: "OrderedDict[Tuple[str, Hashable], CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "near_hits": 0, "refreshes": 0, "misses": 0, "saved_seconds": 0.0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config["enabled"])
+
+    def _alive(self, entry: CacheEntry, generation: int) -> bool:
+        if entry.generation != generation: return False
+        ttl = self.config["ttl_seconds"]
+        return not ttl or time.monotonic() - entry.stored_at <= ttl
+
+    def get(self, query: str, scope: Hashable, generation: int) -> Optional[CacheEntry]:
+        """精确层查找，过期或纪元不符的条目直接丢弃"""
+        key = (normalize_query(query), scope)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if not self._alive(entry, generation):
+                del self._entries[key]
+                self._semantic.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def get_similar(self, query_vector: np.ndarray, scope: Hashable, generation: int) -> Optional[CacheEntry]:
+        """近似层查找：同一检索范围内与查询向量 (已归一化) 最相似且超过阈值的可补齐条目"""
+        if not self.config["semantic"]: return None
+        with self._lock:
+            candidates = [
+                entry for entry in self._semantic.values()
+                if entry.scope == scope and entry.refreshable and self._alive(entry, generation)
+            ]
+            if not candidates: return None
+            matrix = np.stack([entry.query_vector for entry in candidates])
+            sims = matrix @ query_vector.reshape(-1)
+            best = int(np.argmax(sims))
+            if sims[best] < self.config["semantic_threshold"]: return None
+            return candidates[best]
+
+    def put(self, query: str, entry: CacheEntry):
+        key = (normalize_query(query), entry.scope)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.config["max_items"]:
+                old_key, _ = self._entries.popitem(last=False)
+                self._semantic.pop(old_key, None)
+            if self.config["semantic"] and entry.refreshable and entry.query_vector is not None:
+                self._semantic[key] = entry
+                self._semantic.move_to_end(key)
+                while len(self._semantic) > self.config["semantic_items"]:
+                    self._semantic.popitem(last=False)
+
+    def record(self, outcome: str, saved_seconds: float = 0.0):
+        """累计命中统计：outcome 为 hits / near_hits / refreshes / misses"""
+        with self._lock:
+            self.stats[outcome] += 1
+            self.stats["saved_seconds"] += max(0.0, saved_seconds)
+
+    @property
+    def hit_rate(self) -> float:
+        served = self.stats["hits"] + self.stats["near_hits"] + self.stats["refreshes"]
+        total = served + self.stats["misses"]
+        return served / total if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._semantic.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,89 @@
+# src/rwlock.py
+
+import threading
+
+
+class RWLock:
+    """
+    读写锁：多个读者可同时持有，写者独占。有写者等待时新的读者排队 (写者优先，避免写入饿死)。
+    同一线程可重入：持有读锁时再次加读锁、持有写锁时再加读锁或写锁都不会阻塞；
+    持有读锁时加写锁 (升级) 会死锁，直接抛出 RuntimeError。
+
+        with lock.reader: ...   # 搜索
+        with lock.writer: ...   # 修改
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+        self.reader = _Side(self.acquire_read, self.release_read)
+        self.writer = _Side(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        stack = self._read_stack()
+        with self._cond:
+            # 外层已持有读锁或写锁时不计数，也不等待排队的写者
+            counted = not stack and self._writer != me
+            if counted:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+        stack.append(counted)
+
+    def release_read(self):
+        if not self._read_stack().pop(): return
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            if self._read_stack():
+                raise RuntimeError("Cannot acquire the write lock while holding the read lock.")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    def _read_stack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+
+class _Side:
+    """读锁或写锁一侧的上下文管理器 (可重复使用，可作为普通锁传给只认 with 语句的代码)"""
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._release()
+        return False
@@ -0,0 +1,649 @@
+# src/sharded_store.py
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from .embedding_utils import EMBEDDING_CLIENT
+from .embedding_cache import EmbeddingCache
+from .history_store import HistoryStore
+from .retrieval_cache import RetrievalCache, CacheEntry
+from .sqlite_pool import SQLitePool
+from .metrics import METRICS, timed
+from . import lexical
+
+DEFAULT_SHARDING_CONFIG = {
+    "enabled": False,
+    "root": "./cache/shards",
+    # 分片的时间窗口：day / week / month / year。会话整体存放在其开始时间所在窗口的分片中
+    "window": "month",
+    # 同时打开的历史分片数上限 (不含当前窗口的分片)，超出时关闭最久未用的分片
+    "max_open_shards": 4,
+    # 跨分片检索的线程数
+    "search_workers": 4,
+}
+
+WINDOWS = ("day", "week", "month", "year")
+
+CATALOG_NAME = "catalog.db"
+
+
+def resolve_config(cfg: Optional[dict] = None) -> dict:
+    """合并用户配置与默认值，并校验时间窗口"""
+    merged = dict(DEFAULT_SHARDING_CONFIG)
+    merged.update({k: v for k, v in (cfg or {}).items() if v is not None})
+    if merged["window"] not in WINDOWS:
+        raise ValueError(f"Unknown shard window: {merged['window']}. Choose from {WINDOWS}.")
+    return merged
+
+
+def window_of(timestamp: float, window: str) -> Tuple[str, float, float]:
+    """时间戳所在的窗口 (按本地时间划分)，返回 (分片名, 窗口开始, 窗口结束)"""
+    t = datetime.fromtimestamp(timestamp)
+    day = t.replace(hour=0, minute=0, second=0, microsecond=0)
+    if window == "day":
+        start, end, name = day, day + timedelta(days=1), day.strftime("%Y-%m-%d")
+    elif window == "week":
+        start = day - timedelta(days=day.weekday())
+        year, week, _ = start.isocalendar()
+        end, name = start + timedelta(days=7), f"{year}-W{week:02d}"
+    elif window == "month":
+        start = day.replace(day=1)
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        name = start.strftime("%Y-%m")
+    else:
+        start = day.replace(month=1, day=1)
+        end, name = start.replace(year=start.year + 1), start.strftime("%Y")
+    return name, start.timestamp(), end.timestamp()
+
+
+class ShardCatalog:
+    """
+    分片目录 (catalog.db)：每个分片的时间窗口、实际的对话时间范围和向量数，以及会话 -> 分片的映射。
+    分片表很小，常驻内存；时间范围只在扩大时写回。
+    """
+
+    def __init__(self, path: str, sqlite_pragmas: Optional[dict] = None):
+        self.db = SQLitePool(path, sqlite_pragmas)
+        conn = self.db.connection()
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS shards (
+            name TEXT PRIMARY KEY,
+            window_start REAL NOT NULL,
+            window_end REAL NOT NULL,
+            min_ts REAL,
+            max_ts REAL,
+            vectors INTEGER DEFAULT 0
+        )
+        """)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS shard_sessions (
+            session_id TEXT PRIMARY KEY,
+            shard TEXT NOT NULL
+        )
+        """)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """)
+        self._lock = threading.Lock()
+        # name -> [window_start, window_end, min_ts, max_ts, vectors]
+        self.shards: Dict[str, list] = {
+            name: [start, end, min_ts, max_ts, vectors]
+            for name, start, end, min_ts, max_ts, vectors in conn.execute(
+                "SELECT name, window_start, window_end, min_ts, max_ts, vectors FROM shards ORDER BY window_start"
+            )
+        }
+
+    def ensure(self, name: str, window_start: float, window_end: float):
+        with self._lock:
+            if name in self.shards: return
+            self.db.connection().execute(
+                "INSERT OR IGNORE INTO shards (name, window_start, window_end) VALUES (?, ?, ?)",
+                (name, window_start, window_end)
+            )
+            self.shards[name] = [window_start, window_end, None, None, 0]
+
+    def extend(self, name: str, min_ts: float, max_ts: float):
+        """扩大分片中对话的时间范围 (用于按时间过滤时裁剪分片)"""
+        with self._lock:
+            shard = self.shards[name]
+            if shard[2] is not None and shard[2] <= min_ts and shard[3] >= max_ts: return
+            shard[2] = min_ts if shard[2] is None else min(shard[2], min_ts)
+            shard[3] = max_ts if shard[3] is None else max(shard[3], max_ts)
+            self.db.connection().execute(
+                "UPDATE shards SET min_ts = ?, max_ts = ? WHERE name = ?", (shard[2], shard[3], name)
+            )
+
+    def set_vectors(self, name: str, vectors: int):
+        with self._lock:
+            self.shards[name][4] = vectors
+            self.db.connection().execute("UPDATE shards SET vectors = ? WHERE name = ?", (vectors, name))
+
+    def shard_of(self, session_id: str) -> Optional[str]:
+        row = self.db.connection().execute(
+            "SELECT shard FROM shard_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def assign(self, session_id: str, name: str) -> str:
+        """把会话放入分片；会话已有分片 (例如并发写入) 时以已有的为准。返回会话所在的分片"""
+        conn = self.db.connection()
+        conn.execute("INSERT OR IGNORE INTO shard_sessions (session_id, shard) VALUES (?, ?)", (session_id, name))
+        return conn.execute("SELECT shard FROM shard_sessions WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def read_state(self, key: str, default: str = "") -> str:
+        row = self.db.connection().execute("SELECT value FROM catalog_state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def write_state(self, key: str, value):
+        self.db.connection().execute(
+            "INSERT OR REPLACE INTO catalog_state (key, value) VALUES (?, ?)", (key, str(value))
+        )
+
+    def close(self):
+        self.db.close()
+
+
+class ShardedHistoryStore:
+    """
+    按时间窗口分片的对话历史存储：每个窗口 (如每月) 一个目录，内含独立的 SQLite 数据库和向量索引
+    (即一个 HistoryStore)，由 catalog.db 记录各分片与会话的归属。接口与 HistoryStore 相同。
+
+    - 写入：会话整体写入其开始时间所在窗口的分片，写入、检查点和压缩只涉及该分片；
+    - 检索：按时间过滤 (since / until) 或会话裁剪分片，其余分片在线程池中并行检索，
+      语义结果按相似度、BM25 结果按分数合并后统一融合；
+    - 分片在第一次使用时才打开 (检查点以 mmap 方式打开)，打开的历史分片数超过上限时关闭最久未用的；
+    - 重建、压缩可以针对单个分片进行，不影响其他分片的读写。
+    """
+
+    def __init__(self, root: str, sharding_config: Optional[dict] = None,
+                 use_embedding_cache: bool = True, embedding_cache_items: int = 10000,
+                 retrieval_cache_config: Optional[dict] = None, read_only: bool = False, **store_kwargs):
+        self.config = resolve_config(sharding_config)
+        self.root = root
+        self.read_only = read_only
+        os.makedirs(root, exist_ok=True)
+        self.catalog = ShardCatalog(os.path.join(root, CATALOG_NAME), store_kwargs.get("sqlite_pragmas"))
+        # 传给每个分片的 HistoryStore 参数；检索缓存在分片之上统一进行
+        self.store_kwargs = dict(store_kwargs, retrieval_cache_config={"enabled": False})
+        self.lexical_config = lexical.resolve_config(store_kwargs.get("lexical_config"))
+        self.retrieval_cache = RetrievalCache(retrieval_cache_config)
+        self.search_stats = {"queries": 0, "fast_path": 0, "embedded": 0, "shards_searched": 0, "shards_pruned": 0}
+        # 嵌入缓存由所有分片共用，放在根目录
+        if use_embedding_cache and EMBEDDING_CLIENT.cache is None and not read_only:
+            EMBEDDING_CLIENT.set_cache(EmbeddingCache(
+                os.path.join(root, "embedding_cache.db"), EMBEDDING_CLIENT.cache_namespace, embedding_cache_items
+            ))
+        # 已打开的分片 (按最近使用排序)、正在使用各分片的调用数和各分片的打开次数 (参与缓存纪元)
+        self._stores: "OrderedDict[str, HistoryStore]" = OrderedDict()
+        self._users: Dict[str, int] = {}
+        self._opens: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        # 打开和关闭分片互斥进行，同一分片不会被打开两次
+        self._open_lock = threading.Lock()
+        # 本进程写入过的分片 (批量导入结束时写检查点、生成摘要)
+        self._touched = set()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.config["search_workers"]),
+                                            thread_name_prefix="shard-search")
+        print(f"Sharded history store at {root}: {len(self.catalog.shards)} {self.config['window']} shards.")
+
+    @property
+    def vector_dim(self) -> int:
+        return EMBEDDING_CLIENT.vector_dim
+
+    @property
+    def vector_count(self) -> int:
+        """所有分片的向量数 (未打开的分片取其上次关闭时的值)"""
+        with self._lock:
+            opened = {name: store.vector_count for name, store in self._stores.items()}
+        return sum(opened.get(name, shard[4]) for name, shard in self.catalog.shards.items())
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError("ShardedHistoryStore was opened read-only.")
+
+    def _read_state(self, key: str, default: str = "") -> str:
+        return self.catalog.read_state(key, default)
+
+    def _write_state(self, key: str, value):
+        self.catalog.write_state(key, value)
+
+    # ---- 分片的打开与关闭 ----
+
+    def _shard_dir(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _open_shard(self, name: str) -> HistoryStore:
+        path = self._shard_dir(name)
+        store = HistoryStore(os.path.join(path, "conversation_history.db"), path, use_embedding_cache=False,
+                             read_only=self.read_only, **self.store_kwargs)
+        if not self.read_only:
+            # 补上分片上次关闭前未索引的行
+            store.sync_index()
+        return store
+
+    def _checkout(self, name: str) -> Optional[HistoryStore]:
+        """已打开的分片：计入使用并移到最近使用的位置 (调用方持有 _lock)"""
+        store = self._stores.get(name)
+        if store is not None:
+            self._stores.move_to_end(name)
+            self._users[name] += 1
+        return store
+
+    def _acquire(self, name: str) -> HistoryStore:
+        with self._lock:
+            store = self._checkout(name)
+        if store is not None: return store
+        with self._open_lock:
+            with self._lock:
+                store = self._checkout(name)
+            if store is not None: return store
+            with METRICS.span("history.shard_open"):
+                store = self._open_shard(name)
+            with self._lock:
+                self._stores[name] = store
+                self._users[name] = 1
+                self._opens[name] = self._opens.get(name, 0) + 1
+                evicted = self._pick_evictions()
+            # 在 _open_lock 内关闭，关闭完成前同一分片不会被重新打开
+            for old_name, old_store in evicted:
+                self._close_shard(old_name, old_store)
+        return store
+
+    def _release(self, name: str):
+        with self._lock:
+            self._users[name] -= 1
+            over = len(self._stores) > self.config["max_open_shards"]
+        if over:
+            self._evict_idle()
+
+    def _evict_idle(self):
+        """
+        关闭超出上限的空闲分片。打开新分片时的检查无法关闭正在使用的分片 (例如跨全部分片的检索)，
+        使用结束后在这里再检查一次，检索结束后打开的分片数回到上限以内
+        """
+        with self._open_lock:
+            with self._lock:
+                evicted = self._pick_evictions()
+            for name, store in evicted:
+                self._close_shard(name, store)
+
+    @contextmanager
+    def _using(self, name: str) -> Iterator[HistoryStore]:
+        store = self._acquire(name)
+        try:
+            yield store
+        finally:
+            self._release(name)
+
+    def shard(self, name: str):
+        """with 语句中使用一个分片的 HistoryStore (期间不会被关闭)，例如逐个分片导出"""
+        return self._using(name)
+
+    def _pick_evictions(self) -> List[Tuple[str, HistoryStore]]:
+        """打开的历史分片超过上限时，取出最久未用且没有调用在使用的分片 (调用方持有 _lock)"""
+        current = window_of(time.time(), self.config["window"])[0]
+        limit = self.config["max_open_shards"] + (1 if current in self._stores else 0)
+        evicted = []
+        for name in list(self._stores):
+            if len(self._stores) <= limit: break
+            if name == current or self._users[name]: continue
+            evicted.append((name, self._stores.pop(name)))
+            del self._users[name]
+        return evicted
+
+    def _close_shard(self, name: str, store: HistoryStore):
+        store.close()
+        self.catalog.set_vectors(name, store.vector_count)
+        print(f"Closed history shard {name}.")
+
+    def _route(self, session_id: str, timestamp: float) -> str:
+        """会话所在的分片；新会话放入 timestamp 所在窗口的分片"""
+        name = self.catalog.shard_of(session_id)
+        if name is None:
+            name, start, end = window_of(timestamp, self.config["window"])
+            self.catalog.ensure(name, start, end)
+            name = self.catalog.assign(session_id, name)
+        return name
+
+    # ---- 写入 ----
+
+    def start_session(self) -> str:
+        self._check_writable()
+        name, start, end = window_of(time.time(), self.config["window"])
+        self.catalog.ensure(name, start, end)
+        with self._using(name) as store:
+            session_id = store.start_session()
+        self.catalog.assign(session_id, name)
+        return session_id
+
+    def save_turn(self, session_id: str, turn_number: int, user_content: str, assistant_content: str):
+        self._check_writable()
+        start = time.time()
+        name = self._route(session_id, start)
+        with self._using(name) as store:
+            store.save_turn(session_id, turn_number, user_content, assistant_content)
+        self.catalog.extend(name, start, time.time())
+        self._touched.add(name)
+
+    def update_session_total_turns(self, session_id: str, total_turns: int):
+        self._check_writable()
+        name = self.catalog.shard_of(session_id)
+        if name is None: return
+        with self._using(name) as store:
+            store.update_session_total_turns(session_id, total_turns)
+
+    @timed("history.bulk_insert")
+    def bulk_insert(self, rows: List[Tuple[str, int, str, str, float]], vectors: Optional[np.ndarray] = None,
+                    replace: bool = False, state: Optional[Tuple[str, str]] = None) -> int:
+        """
+        批量导入，参数同 HistoryStore.bulk_insert：按会话分组写入各分片 (新会话按其最早一轮的时间放置)。
+        导入进度记在目录中，在各分片写入之后更新；中断后重新导入的行按已存在处理。
+        """
+        self._check_writable()
+        starts = {}
+        for session_id, _, _, _, timestamp in rows:
+            starts[session_id] = min(timestamp, starts.get(session_id, timestamp))
+        placement = {session_id: self._route(session_id, start) for session_id, start in starts.items()}
+        by_shard = {}
+        for i, row in enumerate(rows):
+            by_shard.setdefault(placement[row[0]], []).append(i)
+        written = 0
+        for name, positions in sorted(by_shard.items()):
+            with self._using(name) as store:
+                written += store.bulk_insert([rows[i] for i in positions],
+                                             None if vectors is None else vectors[positions], replace)
+            timestamps = [rows[i][4] for i in positions]
+            self.catalog.extend(name, min(timestamps), max(timestamps))
+            self._touched.add(name)
+        if state is not None:
+            self._write_state(*state)
+        return written
+
+    def finish_bulk_insert(self):
+        """为仍打开的、写入过的分片写检查点 (已关闭的分片在关闭时已写入)"""
+        for name in self._open_names(self._touched):
+            with self._using(name) as store:
+                store.finish_bulk_insert()
+
+    # ---- 读取 ----
+
+    def _open_names(self, extra=()) -> List[str]:
+        with self._lock:
+            names = set(self._stores)
+        return sorted(names | set(extra))
+
+    def _read_shard(self, name: str, sql: str, params: Tuple = ()) -> List[Tuple]:
+        """在分片的数据库上执行只读查询：已打开的分片用其连接，未打开的分片临时只读连接 (不加载索引)"""
+        with self._lock:
+            store = self._checkout(name)
+        if store is not None:
+            try:
+                return store.db.connection().execute(sql, params).fetchall()
+            finally:
+                self._release(name)
+        path = os.path.join(self._shard_dir(name), "conversation_history.db")
+        if not os.path.exists(path): return []
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def get_all_sessions(self) -> List[Tuple]:
+        """获取所有会话列表 (按开始时间倒序)"""
+        sessions = []
+        for name in self.catalog.shards:
+            sessions.extend(self._read_shard(
+                name, "SELECT session_id, start_time_str, total_turns, start_time FROM sessions"
+            ))
+        sessions.sort(key=lambda row: -row[3])
+        return [row[:3] for row in sessions]
+
+    def get_recent_history(self, session_id: str, n_turns: int) -> List[Tuple]:
+        name = self.catalog.shard_of(session_id)
+        if name is None: return []
+        with self._using(name) as store:
+            return store.get_recent_history(session_id, n_turns)
+
+    def get_session_history(self, session_id: str, limit: Optional[int] = None) -> List[Tuple]:
+        name = self.catalog.shard_of(session_id)
+        if name is None: return []
+        with self._using(name) as store:
+            return store.get_session_history(session_id, limit)
+
+    def get_session_summaries(self, session_id: str) -> List[Tuple]:
+        name = self.catalog.shard_of(session_id)
+        if name is None: return []
+        with self._using(name) as store:
+            return store.get_session_summaries(session_id)
+
+    def get_turns_by_ids(self, turn_ids: List[str]) -> List[Tuple]:
+        """按 turn_id 批量获取对话 (可跨会话、跨分片)，格式同 HistoryStore.get_turns_by_ids"""
+        by_shard = {}
+        for turn_id in turn_ids:
+            session_id, sep, _ = turn_id.rpartition('_')
+            name = self.catalog.shard_of(session_id) if sep else None
+            if name is not None:
+                by_shard.setdefault(name, []).append(turn_id)
+        results = []
+        for name, ids in by_shard.items():
+            with self._using(name) as store:
+                results.extend(store.get_turns_by_ids(ids))
+        results.sort(key=lambda row: row[4])
+        return results
+
+    # ---- 检索 ----
+
+    def _candidate_shards(self, session_id: Optional[str], since: Optional[float],
+                          until: Optional[float]) -> List[str]:
+        """需要检索的分片 (新的在前)：按会话直接定位，按时间范围裁剪，跳过没有对话的分片"""
+        if session_id is not None:
+            name = self.catalog.shard_of(session_id)
+            return [] if name is None else [name]
+        return [
+            name for name, (_, _, min_ts, max_ts, _) in sorted(self.catalog.shards.items(), key=lambda item: -item[1][0])
+            if min_ts is not None and (since is None or max_ts >= since) and (until is None or min_ts <= until)
+        ]
+
+    def _fan_out(self, fn, stores: List[HistoryStore]) -> list:
+        if len(stores) == 1:
+            return [fn(stores[0])]
+        return list(self._executor.map(fn, stores))
+
+    def _fuse(self, semantic: List[Tuple[str, float]], lexical_parts: List[Tuple], top_k: int,
+              query_vector: Optional[np.ndarray], similarity_threshold: float,
+              stores: List[HistoryStore]) -> List[Tuple[str, float]]:
+        """
+        与 HistoryStore._fuse 相同：合并后的语义结果与 BM25 结果按倒数排名融合排序，分数为余弦相似度。
+        只被 BM25 命中的轮次由其所在分片计算余弦 (行 id 只在分片内有效)，低于阈值的丢弃
+        """
+        lexical_rows = sorted((row for rows, _ in lexical_parts for row in rows), key=lambda row: row[2])
+        lexical_turns = list(dict.fromkeys(turn_id for _, turn_id, _ in lexical_rows))
+        if not lexical_turns:
+            return semantic[:top_k]
+        scores = dict(semantic)
+        missing = [turn_id for turn_id in lexical_turns if turn_id not in scores]
+        for store, (rows, _) in zip(stores, lexical_parts):
+            scores.update(store._lexical_scores(query_vector, rows, missing, similarity_threshold))
+        return lexical.fuse_scored(semantic, lexical_turns, scores, top_k, self.lexical_config["rrf_k"])
+
+    def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        if EMBEDDING_CLIENT.model is None: return None
+        self.search_stats["embedded"] += 1
+        query_vector = EMBEDDING_CLIENT.get_embedding(query).reshape(1, -1).astype('float32')
+        faiss.normalize_L2(query_vector)
+        return query_vector
+
+    def _lexical_parts(self, query: str, top_k: int, filters: Tuple,
+                       stores: List[HistoryStore]) -> Tuple[List[Tuple], Optional[List[Tuple[str, float]]]]:
+        """各分片的全文检索结果，以及快速路径的结果 (精确词命中的轮次合计不多时，不走快速路径为 None)"""
+        lexical_parts = self._fan_out(lambda store: store._lexical_stage(query, top_k, filters), stores)
+        fast = [turn_id for _, turn_ids in lexical_parts if turn_ids for turn_id in turn_ids]
+        if fast and len(fast) <= self.lexical_config["fast_path_max_hits"]:
+            self.search_stats["fast_path"] += 1
+            return lexical_parts, HistoryStore._fast_results(fast, top_k)
+        return lexical_parts, None
+
+    def _search(self, query: str, query_vector: Optional[np.ndarray], top_k: int, similarity_threshold: float,
+                filters: Tuple, stores: List[HistoryStore], lexical_parts: Optional[List[Tuple]] = None
+                ) -> List[Tuple[str, float]]:
+        """
+        跨分片检索：各分片先做全文检索，精确词命中的轮次合计不多时直接返回 (快速路径，不编码查询)；
+        否则查询只编码一次，各分片并行做向量检索，按相似度合并 2 * top_k 轮后与合并的 BM25 结果融合
+        """
+        if lexical_parts is None:
+            lexical_parts, fast = self._lexical_parts(query, top_k, filters, stores)
+            if fast is not None: return fast
+        if query_vector is None:
+            query_vector = self._embed_query(query)
+            if query_vector is None:
+                return self._fuse([], lexical_parts, top_k, None, similarity_threshold, stores)
+        parts = self._fan_out(
+            lambda store: store.semantic_candidates(query_vector, top_k, similarity_threshold, filters), stores
+        )
+        semantic = sorted((hit for part in parts for hit in part), key=lambda hit: -hit[1])[:top_k * 2]
+        return self._fuse(semantic, lexical_parts, top_k, query_vector, similarity_threshold, stores)
+
+    @contextmanager
+    def _using_all(self, names: List[str]) -> Iterator[List[HistoryStore]]:
+        with ExitStack() as stack:
+            yield [stack.enter_context(self._using(name)) for name in names]
+
+    def _epoch(self, names: List[str], stores: List[HistoryStore]) -> int:
+        """参与检索的分片的索引纪元，作为检索缓存的 generation (任一分片写入后条目失效)"""
+        return hash(tuple((name, self._opens.get(name, 0)) + store.index_epoch for name, store in zip(names, stores)))
+
+    @timed("history.search")
+    def search_history_index(self, query: str, top_k: int = 5, similarity_threshold: float = 0.0,
+                             session_id: Optional[str] = None, role: Optional[str] = None,
+                             since: Optional[float] = None, until: Optional[float] = None) -> List[Tuple[str, float]]:
+        """混合检索，参数与返回值同 HistoryStore.search_history_index"""
+        filters = (session_id, role, since, until)
+        names = self._candidate_shards(session_id, since, until)
+        self.search_stats["queries"] += 1
+        self.search_stats["shards_searched"] += len(names)
+        self.search_stats["shards_pruned"] += len(self.catalog.shards) - len(names)
+        if not names: return []
+        scope = (top_k, similarity_threshold) + filters
+        with self._using_all(names) as stores:
+            start = time.perf_counter()
+            generation = self._epoch(names, stores)
+            cached = self.retrieval_cache.get(query, scope, generation) if self.retrieval_cache.enabled else None
+            if cached is not None:
+                self.retrieval_cache.record("hits", cached.cost - (time.perf_counter() - start))
+                METRICS.counter("retrieval_cache.hits")
+                return list(cached.results)
+            results = self._search(query, None, top_k, similarity_threshold, filters, stores)
+            if self.retrieval_cache.enabled:
+                self.retrieval_cache.record("misses")
+                self.retrieval_cache.put(query, CacheEntry(
+                    scope, generation, 0, None, None, results, time.perf_counter() - start
+                ))
+            return results
+
+    def search_history_batch(self, queries: List[str], top_k: int = 5,
+                             similarity_threshold: float = 0.0) -> List[List[Tuple[str, float]]]:
+        """批量检索：走快速路径之外的查询一次批量编码，再逐个跨分片检索"""
+        names = self._candidate_shards(None, None, None)
+        if not names: return [[] for _ in queries]
+        filters = (None, None, None, None)
+        with self._using_all(names) as stores:
+            results, lexical_parts = [None] * len(queries), [None] * len(queries)
+            for i, query in enumerate(queries):
+                lexical_parts[i], results[i] = self._lexical_parts(query, top_k, filters, stores)
+            pending = [i for i, result in enumerate(results) if result is None]
+            query_vectors = None
+            if pending and EMBEDDING_CLIENT.model is not None:
+                self.search_stats["embedded"] += len(pending)
+                query_vectors = EMBEDDING_CLIENT.get_embeddings([queries[i] for i in pending]).astype('float32')
+                faiss.normalize_L2(query_vectors)
+            for row, i in enumerate(pending):
+                results[i] = self._search(queries[i], None if query_vectors is None else query_vectors[row:row + 1],
+                                          top_k, similarity_threshold, filters, stores, lexical_parts[i])
+            return results
+
+    # ---- 维护 ----
+
+    def sync_index(self) -> int:
+        """同步已打开的分片 (其余分片在打开时同步)"""
+        return sum(self._each(lambda store: store.sync_index(), self._open_names()))
+
+    def _each(self, fn, names: List[str]) -> list:
+        results = []
+        for name in names:
+            with self._using(name) as store:
+                results.append(fn(store))
+        return results
+
+    def consolidate_session(self, session_id: str) -> int:
+        name = self.catalog.shard_of(session_id)
+        if name is None: return 0
+        with self._using(name) as store:
+            return store.consolidate_session(session_id)
+
+    def consolidate_sessions(self, session_ids: Optional[List[str]] = None) -> int:
+        """为会话生成摘要；默认处理已打开和本进程写入过的分片中待处理的会话 (不为此打开其他分片)"""
+        if self.read_only: return 0
+        if session_ids is None:
+            return sum(self._each(lambda store: store.consolidate_sessions(), self._open_names(self._touched)))
+        by_shard = {}
+        for session_id in session_ids:
+            name = self.catalog.shard_of(session_id)
+            if name is not None:
+                by_shard.setdefault(name, []).append(session_id)
+        updated = 0
+        for name, ids in by_shard.items():
+            with self._using(name) as store:
+                updated += store.consolidate_sessions(ids)
+        return updated
+
+    def rebuild_faiss_index(self, name: Optional[str] = None):
+        """重建一个分片的向量索引 (name 为 None 时依次重建全部分片)，期间其他分片照常读写"""
+        for shard in [name] if name is not None else list(self.catalog.shards):
+            print(f"Rebuilding vector index of shard {shard}...")
+            with self._using(shard) as store:
+                store.rebuild_faiss_index()
+
+    def compact(self, name: Optional[str] = None) -> Dict[str, dict]:
+        """压缩一个分片 (name 为 None 时依次压缩全部分片)，返回 {分片: 压缩报告}"""
+        reports = {}
+        for shard in [name] if name is not None else list(self.catalog.shards):
+            with self._using(shard) as store:
+                reports[shard] = store.compact()
+        return reports
+
+    def describe_shards(self) -> List[dict]:
+        """各分片的时间窗口、对话时间范围、向量数与是否已打开"""
+        with self._lock:
+            opened = {name: store.vector_count for name, store in self._stores.items()}
+        return [
+            {"name": name, "window_start": start, "window_end": end, "min_ts": min_ts, "max_ts": max_ts,
+             "vectors": opened.get(name, vectors), "open": name in opened}
+            for name, (start, end, min_ts, max_ts, vectors) in self.catalog.shards.items()
+        ]
+
+    def close(self):
+        """关闭所有已打开的分片 (各自合并向量日志、写检查点) 和目录"""
+        self._executor.shutdown(wait=True)
+        with self._open_lock, self._lock:
+            stores, self._stores = list(self._stores.items()), OrderedDict()
+            self._users = {}
+        for name, store in stores:
+            if self.read_only:
+                store.close()
+            else:
+                self._close_shard(name, store)
+        self.catalog.close()
@@ -0,0 +1,76 @@
+# src/sqlite_pool.py
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Union
+
+# 默认连接参数：WAL 模式下读者不阻塞写者；synchronous=NORMAL 时提交不再 fsync，
+# 只在 WAL 检查点时落盘 (断电最多丢失最近提交的事务，数据库本身不会损坏)
+DEFAULT_PRAGMAS: Dict[str, Union[int, str]] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,          # 负数表示 KiB，即约 16MB 页缓存
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,          # 毫秒，写锁被占用时等待而不是立即报错
+    # INSERT OR REPLACE 隐式删除旧行时也触发 DELETE 触发器 (全文索引依赖它保持同步)
+    "recursive_triggers": "ON",
+}
+
+# 每个连接缓存的预编译语句数 (SQL 文本相同即复用)
+CACHED_STATEMENTS = 128
+
+
+class SQLitePool:
+    """
+    线程感知的 SQLite 连接池：每个线程持有一个长连接，首次使用时创建并设置 PRAGMA。
+    连接处于自动提交模式，写操作通过 transaction() 显式开启短事务。
+    """
+
+    def __init__(self, path: str, pragmas: Optional[dict] = None):
+        self.path = path
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        self.pragmas.update(pragmas or {})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False,
+            cached_statements=CACHED_STATEMENTS,
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """当前线程的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：BEGIN IMMEDIATE 立即获取写锁，异常时回滚"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        """关闭所有线程的连接"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
@@ -0,0 +1,71 @@
+# src/turn_writer.py
+
+import queue
+import threading
+from typing import Optional, Tuple
+
+from .history_store import HistoryStore
+
+# 后台写入队列的默认容量 (满时 submit 阻塞，避免无限堆积)
+DEFAULT_QUEUE_SIZE = 8
+
+_STOP = object()
+
+
+class TurnSaveError(RuntimeError):
+    """后台保存失败，由 flush() 抛出；turn_number 为第一个保存失败的轮次"""
+
+    def __init__(self, turn_number: int, error: Exception):
+        super().__init__(f"Background save of turn {turn_number} failed: {error}")
+        self.turn_number = turn_number
+        self.error = error
+
+
+class TurnWriter:
+    """
+    后台保存对话：save_turn (SQLite 写入 + 编码 + 追加向量日志) 在工作线程中执行，
+    主线程把回答打印给用户后即可等待下一次输入。
+    下一次检索前调用 flush()，保证上一轮对话已经可以被检索到；保存失败时 flush() 抛出 TurnSaveError，
+    调用方据此回退轮次 (与同步保存失败时一致)。
+    """
+
+    def __init__(self, history_store: HistoryStore, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.history_store = history_store
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+        self.last_error: Optional[Exception] = None
+        # 上次 flush() 之后第一个保存失败的 (轮次, 异常)
+        self._failure: Optional[Tuple[int, Exception]] = None
+        self._thread = threading.Thread(target=self._run, name="TurnWriter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP: return
+                self.history_store.save_turn(*item)
+            except Exception as e:
+                self.last_error = e
+                if self._failure is None:
+                    self._failure = (item[1], e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, session_id: str, turn_number: int, user_content: str, assistant_content: str):
+        """排队保存一轮对话 (队列满时阻塞)"""
+        if not self._thread.is_alive():
+            raise RuntimeError("TurnWriter is closed.")
+        self._queue.put((session_id, turn_number, user_content, assistant_content))
+
+    def flush(self):
+        """等待已提交的对话全部写入并索引完成；其间有保存失败时抛出 TurnSaveError (只抛出一次)"""
+        self._queue.join()
+        failure, self._failure = self._failure, None
+        if failure is not None:
+            raise TurnSaveError(*failure)
+
+    def close(self):
+        """写完剩余的对话后停止工作线程"""
+        if not self._thread.is_alive(): return
+        self._queue.put(_STOP)
+        self._thread.join()
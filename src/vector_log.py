@@ -0,0 +1,120 @@
+# src/vector_log.py
+
+import os
+import struct
+import zlib
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+# 文件头: 魔数 + 版本 + 向量维度
+_MAGIC = b"HVLOG"
+_VERSION = 2
+_HEADER = struct.Struct("<5sBI")
+# 记录头: 序号, SQLite 行 id (即向量在索引中的 id)
+_RECORD_HEAD = struct.Struct("<Qq")
+_CRC = struct.Struct("<I")
+
+
+class VectorLog:
+    """
+    追加写入的向量预写日志 (write-ahead log)。
+    每条记录为 (seq, row_id, vector)，带 CRC 校验；
+    append 后立即 fsync，崩溃时最多丢失写了一半的尾部记录 (重放时会被截掉)。
+    检查点完成后调用 truncate() 清空日志。
+    """
+
+    def __init__(self, path: str, vector_dim: int):
+        self.path = path
+        self.vector_dim = vector_dim
+        self._vector_bytes = vector_dim * 4
+        self.last_seq = 0
+        self.record_count = 0
+
+        if not self._header_ok():
+            self._write_header()
+        self._file = open(self.path, "ab")
+
+    def _header_ok(self) -> bool:
+        if not os.path.exists(self.path): return False
+        with open(self.path, "rb") as f:
+            raw = f.read(_HEADER.size)
+        if len(raw) < _HEADER.size: return False
+        magic, version, dim = _HEADER.unpack(raw)
+        if magic != _MAGIC or version != _VERSION or dim != self.vector_dim:
+            print(f"Vector log {self.path} has an incompatible header, discarding it.")
+            return False
+        return True
+
+    def _write_header(self):
+        with open(self.path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.vector_dim))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @property
+    def size_bytes(self) -> int:
+        return self._file.tell()
+
+    def replay(self, after_seq: int = 0) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """
+        按顺序读出 seq > after_seq 的记录。
+        遇到不完整或校验失败的尾部记录时停止，并把文件截断到最后一条完好记录之后。
+        """
+        good_end = _HEADER.size
+        records = []
+        with open(self.path, "rb") as f:
+            f.seek(_HEADER.size)
+            while True:
+                head = f.read(_RECORD_HEAD.size)
+                if len(head) < _RECORD_HEAD.size: break
+                seq, row_id = _RECORD_HEAD.unpack(head)
+                body = f.read(self._vector_bytes + _CRC.size)
+                if len(body) < self._vector_bytes + _CRC.size: break
+                payload, (crc,) = head + body[:-_CRC.size], _CRC.unpack(body[-_CRC.size:])
+                if zlib.crc32(payload) != crc: break
+
+                good_end = f.tell()
+                self.last_seq = max(self.last_seq, seq)
+                self.record_count += 1
+                if seq <= after_seq: continue
+                vector = np.frombuffer(body[:self._vector_bytes], dtype=np.float32)
+                records.append((seq, row_id, vector))
+
+        if good_end < os.path.getsize(self.path):
+            print(f"Vector log: dropping torn tail after byte {good_end}.")
+            self._file.close()
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+                os.fsync(f.fileno())
+            self._file = open(self.path, "ab")
+        # 检查点之后日志被清空过，新记录的序号必须接在检查点之后
+        self.last_seq = max(self.last_seq, after_seq)
+        return iter(records)
+
+    def append(self, row_ids: Sequence[int], vectors: np.ndarray, sync: bool = True) -> List[int]:
+        """追加一批记录并 fsync，返回分配的序号"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.vector_dim)
+        chunks = []
+        seqs = []
+        for row_id, vector in zip(row_ids, vectors):
+            self.last_seq += 1
+            payload = _RECORD_HEAD.pack(self.last_seq, int(row_id)) + vector.tobytes()
+            chunks.append(payload + _CRC.pack(zlib.crc32(payload)))
+            seqs.append(self.last_seq)
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self.record_count += len(seqs)
+        return seqs
+
+    def truncate(self):
+        """检查点完成后清空日志 (序号继续递增)"""
+        self._file.close()
+        self._write_header()
+        self._file = open(self.path, "ab")
+        self.record_count = 0
+
+    def close(self):
+        self._file.close()
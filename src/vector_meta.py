@@ -0,0 +1,226 @@
+# src/vector_meta.py
+
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+ROLE_CODES = {"user": 0, "assistant": 1}
+ROLE_NAMES = {code: name for name, code in ROLE_CODES.items()}
+
+
+class VectorMetadata:
+    """
+    索引中每个向量的元数据 (行 id, 会话, 轮次, 角色, 时间戳)，以紧凑的 NumPy 列存储。
+    会话 id 字符串被编码为 int32，过滤时只需对数组做向量化比较。
+    行 id 按升序存放 (向量按行 id 顺序写入)，按行 id 查找用二分搜索，不需要额外的哈希表。
+    检查点时各列保存为 .npy 文件，启动时以只读 mmap 打开 (首次追加或删除时才复制到私有内存)。
+    """
+
+    _COLUMNS = (("ids", np.int64), ("sessions", np.int32), ("turns", np.int32),
+                ("roles", np.int8), ("timestamps", np.float64))
+
+    def __init__(self, capacity: int = 1024):
+        self._size = 0
+        for name, dtype in self._COLUMNS:
+            setattr(self, "_" + name, np.zeros(capacity, dtype=dtype))
+        self.session_names: List[str] = []
+        self.session_codes: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, "_" + name).nbytes for name, _ in self._COLUMNS)
+
+    def _column(self, name: str) -> np.ndarray:
+        return getattr(self, "_" + name)[:self._size]
+
+    def _session_code(self, session_id: str) -> int:
+        code = self.session_codes.get(session_id)
+        if code is None:
+            code = len(self.session_names)
+            self.session_codes[session_id] = code
+            self.session_names.append(session_id)
+        return code
+
+    def _reserve(self, extra: int):
+        capacity = len(self._ids)
+        if self._size + extra <= capacity: return
+        new_capacity = max(capacity * 2, self._size + extra)
+        for name, dtype in self._COLUMNS:
+            old = getattr(self, "_" + name)
+            grown = np.zeros(new_capacity, dtype=dtype)
+            grown[:self._size] = old[:self._size]
+            setattr(self, "_" + name, grown)
+
+    def add(self, rows: Sequence[Tuple[int, str, int, str, float]]):
+        """追加 (row_id, session_id, turn_number, role, timestamp) 行"""
+        if not rows: return
+        self._reserve(len(rows))
+        start = self._size
+        for offset, (row_id, session_id, turn_number, role, timestamp) in enumerate(rows):
+            i = start + offset
+            self._ids[i] = row_id
+            self._sessions[i] = self._session_code(session_id)
+            self._turns[i] = turn_number
+            self._roles[i] = ROLE_CODES.get(role, -1)
+            self._timestamps[i] = timestamp
+        self._size += len(rows)
+        ids = self._column("ids")
+        if start and ids[start - 1] >= ids[start] or not np.all(ids[start + 1:] > ids[start:-1]):
+            self._sort()
+
+    def _sort(self):
+        """保持行 id 升序 (正常写入不会触发)"""
+        order = np.argsort(self._column("ids"), kind="stable")
+        for name, _ in self._COLUMNS:
+            col = getattr(self, "_" + name)
+            col[:self._size] = col[:self._size][order]
+
+    def remove(self, row_ids: Sequence[int]):
+        """删除给定行 id 的元数据 (压缩数组；删除大部分行后按剩余行数重新分配)"""
+        if not len(row_ids) or not self._size: return
+        keep = ~np.isin(self._column("ids"), np.asarray(row_ids, dtype=np.int64))
+        n = int(keep.sum())
+        capacity = len(self._ids)
+        if n * 4 < capacity:
+            capacity = max(1024, n * 2)
+        # 先生成新的列再整体替换，不在原数组上移动 (其他线程可能正在查询)
+        for name, dtype in self._COLUMNS:
+            col = np.zeros(capacity, dtype=dtype)
+            col[:n] = getattr(self, "_" + name)[:self._size][keep]
+            setattr(self, "_" + name, col)
+        self._size = n
+
+    def clear(self):
+        for name, dtype in self._COLUMNS:
+            setattr(self, "_" + name, np.zeros(1024, dtype=dtype))
+        self._size = 0
+
+    def _index_of(self, row_id: int) -> Optional[int]:
+        ids = self._column("ids")
+        i = int(np.searchsorted(ids, row_id))
+        return i if i < len(ids) and ids[i] == row_id else None
+
+    def lookup(self, row_id: int) -> Optional[Tuple[str, int, str, float]]:
+        """行 id -> (session_id, turn_number, role, timestamp)，不存在时返回 None"""
+        i = self._index_of(row_id)
+        if i is None: return None
+        return (self.session_names[self._sessions[i]], int(self._turns[i]),
+                ROLE_NAMES.get(int(self._roles[i]), "unknown"), float(self._timestamps[i]))
+
+    def ids_after(self, row_id: int) -> np.ndarray:
+        """行 id 大于 row_id 的向量 (检索缓存增量补搜用)"""
+        ids = self._column("ids")
+        return ids[ids > row_id]
+
+    def row_ids(self) -> np.ndarray:
+        return self._column("ids").copy()
+
+    @staticmethod
+    def _group(sessions: np.ndarray, roles: np.ndarray) -> np.ndarray:
+        return (sessions.astype(np.int64) << 8) | (roles.astype(np.int64) & 0xFF)
+
+    def group_of(self, row_id: int) -> Optional[int]:
+        """行的 (会话, 角色) 组合编码，不存在时返回 None"""
+        i = self._index_of(row_id)
+        return None if i is None else int(self._group(self._sessions[i], self._roles[i]))
+
+    def groups(self, row_ids: np.ndarray) -> np.ndarray:
+        """row_ids (均已存在) 的 (会话, 角色) 组合编码"""
+        pos = np.searchsorted(self._column("ids"), row_ids)
+        return self._group(self._column("sessions")[pos], self._column("roles")[pos])
+
+    def expired(self, now: float, max_age_days: float = 0, max_sessions: int = 0,
+                max_vectors: int = 0) -> np.ndarray:
+        """
+        按保留策略应移出的行 id (0 表示不限制)：早于 max_age_days 天的向量、
+        最近活跃的 max_sessions 个会话之外的向量、超出 max_vectors 条的最早的向量
+        """
+        ids = self._column("ids")
+        drop = np.zeros(self._size, dtype=bool)
+        if max_age_days:
+            drop |= self._column("timestamps") < now - max_age_days * 86400.0
+        if max_sessions and len(self.session_names) > max_sessions:
+            sessions = self._column("sessions")
+            last_active = np.full(len(self.session_names), -np.inf)
+            np.maximum.at(last_active, sessions, self._column("timestamps"))
+            recent = np.argsort(-last_active)[:max_sessions]
+            drop |= ~np.isin(sessions, recent)
+        if max_vectors and self._size > max_vectors:
+            # 行 id 随写入时间递增，最早的向量 id 最小
+            drop |= ids < np.partition(ids, self._size - max_vectors)[self._size - max_vectors]
+        return ids[drop]
+
+    def present(self, row_ids: np.ndarray) -> np.ndarray:
+        """返回 row_ids 中已有向量 (元数据) 的那些"""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        # 在有序的行 id 上二分查找，开销为 O(len(row_ids) * log n)，不扫描整个数组
+        ids = self._column("ids")
+        if not len(ids): return row_ids[:0]
+        pos = np.minimum(np.searchsorted(ids, row_ids), len(ids) - 1)
+        return row_ids[ids[pos] == row_ids]
+
+    def save(self, directory: str, tag: str):
+        """
+        把各列写成 .npy 文件 (先写临时文件再原子替换)；tag 为对应检查点的标识，
+        与会话名一起写入 sessions.json，加载时据此确认各文件属于同一个检查点
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name, _ in self._COLUMNS:
+            tmp_path = os.path.join(directory, f"{name}.tmp.npy")
+            with open(tmp_path, "wb") as f:
+                np.save(f, self._column(name))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(directory, f"{name}.npy"))
+        tmp_path = os.path.join(directory, "sessions.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"tag": tag, "size": self._size, "sessions": self.session_names}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(directory, "sessions.json"))
+
+    @classmethod
+    def load(cls, directory: str, tag: str) -> Optional["VectorMetadata"]:
+        """以只读 mmap 打开 save() 写入的列；文件缺失、损坏或不属于 tag 对应的检查点时返回 None"""
+        try:
+            with open(os.path.join(directory, "sessions.json"), "r", encoding="utf-8") as f:
+                header = json.load(f)
+            if header.get("tag") != tag: return None
+            meta = cls(capacity=0)
+            for name, dtype in cls._COLUMNS:
+                # 空文件无法 mmap
+                col = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if header["size"] else None)
+                if col.dtype != dtype or len(col) != header["size"]: return None
+                setattr(meta, "_" + name, col)
+        except (OSError, ValueError, KeyError):
+            return None
+        meta._size = header["size"]
+        meta.session_names = header["sessions"]
+        meta.session_codes = {session_id: code for code, session_id in enumerate(meta.session_names)}
+        return meta
+
+    def select(self, session_id: Optional[str] = None, role: Optional[str] = None,
+               since: Optional[float] = None, until: Optional[float] = None) -> Optional[np.ndarray]:
+        """
+        返回满足过滤条件的行 id 数组；没有任何过滤条件时返回 None (表示全部)。
+        """
+        if session_id is None and role is None and since is None and until is None:
+            return None
+        mask = np.ones(self._size, dtype=bool)
+        if session_id is not None:
+            code = self.session_codes.get(session_id)
+            if code is None:
+                return np.zeros(0, dtype=np.int64)
+            mask &= self._column("sessions") == code
+        if role is not None:
+            mask &= self._column("roles") == ROLE_CODES.get(role, -2)
+        if since is not None:
+            mask &= self._column("timestamps") >= since
+        if until is not None:
+            mask &= self._column("timestamps") <= until
+        return self._column("ids")[mask]
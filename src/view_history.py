@@ -1,7 +1,16 @@
 from .history_store import HistoryStore
+from .sharded_store import ShardedHistoryStore
 import yaml
 
-CFG_PATH = r"E:\\task\\学校任务\\nlp项目\\llm-memory-improvement\\config.yaml"
+CFG_PATH = r"config.yaml"
+
+
+def _open_store(cfg):
+    """只读打开历史记录 (分片模式下打开分片目录)"""
+    sharding_cfg = cfg.get("storage", {}).get("sharding", {})
+    if sharding_cfg.get("enabled", False):
+        return ShardedHistoryStore(sharding_cfg.get("root", "./cache/shards"), sharding_cfg, read_only=True)
+    return HistoryStore(db_path=cfg.get("storage", {}).get("history_db_path"), read_only=True)
 
 
 def view_all_sessions():
@@ -9,8 +18,7 @@ def view_all_sessions():
     with open(CFG_PATH, "r", encoding="utf-8") as f:
         cfg = yaml.safe_load(f)
 
-    db_path = cfg.get("storage", {}).get("history_db_path")
-    store = HistoryStore(db_path=db_path)
+    store = _open_store(cfg)
 
     sessions = store.get_all_sessions()
 
@@ -31,8 +39,7 @@ def view_session_detail(session_id: str):
     with open(CFG_PATH, "r", encoding="utf-8") as f:
         cfg = yaml.safe_load(f)
 
-    db_path = cfg.get("storage", {}).get("history_db_path")
-    store = HistoryStore(db_path=db_path)
+    store = _open_store(cfg)
 
     history = store.get_session_history(session_id)
 
@@ -0,0 +1,180 @@
+# tests/test_compaction.py
+"""
+HistoryStore.compact() 的本地检查 (使用 benchmarks.stub_embedder 的离线模型，不需要下载嵌入模型)：
+被覆盖轮次的旧向量被移除，重复向量只在同一会话内合并并通过别名找回，
+移入冷存储的向量按过滤条件检索、与内存索引的结果按相似度合并，以及作废的压缩不改变冷存储。
+
+用法:
+    python -m pytest -q tests/test_compaction.py
+    python -m unittest tests.test_compaction
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from benchmarks.stub_embedder import StubEmbeddingModel
+from src import ann_index, history_store
+from src.embedding_utils import EMBEDDING_CLIENT
+from src.history_store import HistoryStore
+
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        EMBEDDING_CLIENT.set_model(StubEmbeddingModel())
+        self.dir = tempfile.mkdtemp()
+        self.store = None
+
+    def tearDown(self):
+        if self.store is not None:
+            self.store.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _open(self, **compaction_config):
+        # 压缩默认关闭，测试中显式开启；不在后台自动压缩，由测试手动调用 compact()
+        config = {"enabled": True, "interval_turns": 0, **compaction_config}
+        self.store = HistoryStore(os.path.join(self.dir, "history.db"), self.dir,
+                                  retrieval_cache_config={"enabled": False},
+                                  lexical_config={"enabled": False}, compaction_config=config)
+        return self.store
+
+    def _row_ids(self, session_id, turn_number):
+        rows = self.store.db.connection().execute(
+            "SELECT id FROM conversation_history WHERE session_id = ? AND turn_number = ? ORDER BY id",
+            (session_id, turn_number)
+        ).fetchall()
+        return np.array([row[0] for row in rows], dtype='int64')
+
+    def test_disabled_by_default(self):
+        self.store = HistoryStore(os.path.join(self.dir, "history.db"), self.dir,
+                                  retrieval_cache_config={"enabled": False})
+        sid = self.store.start_session()
+        self.store.save_turn(sid, 1, "我喜欢喝绿茶", "好的")
+        self.assertEqual(self.store.compact(), {})
+        self.assertEqual(self.store.vector_count, 2)
+
+    def test_superseded_vectors_removed(self):
+        store = self._open(dedup_threshold=0)
+        sid = store.start_session()
+        store.save_turn(sid, 1, "我喜欢喝绿茶", "好的")
+        store.save_turn(sid, 2, "今天天气不错", "是的")
+        old_rows = self._row_ids(sid, 1)
+        store.save_turn(sid, 1, "我喜欢喝咖啡", "好的")
+        self.assertEqual(store.vector_count, 6)
+
+        result = store.compact()
+        self.assertEqual(result["removed"]["superseded"], 2)
+        self.assertEqual(store.vector_count, 4)
+        found, _ = store.get_vectors(old_rows)
+        self.assertFalse(found.any())
+        found, _ = store.get_vectors(self._row_ids(sid, 1))
+        self.assertTrue(found.all())
+
+    def test_duplicates_merged_within_session(self):
+        store = self._open()
+        a = store.start_session()
+        time.sleep(0.01)
+        b = store.start_session()
+        store.save_turn(a, 1, "请记住我的车牌号是 京A12345", "好的，已记住车牌号 京A12345")
+        t_mid = time.time()
+        time.sleep(0.05)
+        for t in range(2, 5):
+            store.save_turn(a, t, f"其他话题 {t} 天气", f"回答 {t} 晴天")
+        store.save_turn(a, 5, "请记住我的车牌号是 京A12345", "好的，已记住车牌号 京A12345")
+        store.save_turn(b, 1, "请记住我的车牌号是 京A12345", "好的，已记住车牌号 京A12345")
+
+        result = store.compact()
+        # 会话 a 中较早的一轮 (用户与助手各一条) 合并到第 5 轮，会话 b 的相同内容保留
+        self.assertEqual(result["removed"]["duplicates"], 2)
+        aliases = dict(store.db.connection().execute("SELECT row_id, target_id FROM vector_alias").fetchall())
+        self.assertEqual(sorted(aliases), self._row_ids(a, 1).tolist())
+        self.assertEqual(sorted(aliases.values()), self._row_ids(a, 5).tolist())
+
+        query = "[user]: 请记住我的车牌号是 京A12345"
+        hits = [turn_id for turn_id, _ in store.search_history_index(query, top_k=3)]
+        self.assertIn(f"{b}_1", hits)
+        self.assertIn(f"{a}_5", hits)
+        # 按时间过滤时较早的轮次通过保留的向量命中
+        self.assertEqual([turn_id for turn_id, _ in store.search_history_index(query, top_k=3, until=t_mid)],
+                         [f"{a}_1"])
+        found, vectors = store.get_vectors(self._row_ids(a, 1))
+        self.assertTrue(found.all())
+        _, kept = store.get_vectors(self._row_ids(a, 5))
+        np.testing.assert_allclose(vectors, kept)
+
+    def test_cold_tier_search_with_filters(self):
+        store = self._open(max_vectors=10)
+        old = store.start_session()
+        for t in range(1, 6):
+            store.save_turn(old, t, f"旧会话内容 第{t}轮 关于花园", f"旧回答 {t}")
+        t_mid = time.time()
+        time.sleep(0.02)
+        new = store.start_session()
+        for t in range(1, 6):
+            store.save_turn(new, t, f"新会话内容 第{t}轮 关于汽车", f"新回答 {t}")
+
+        result = store.compact()
+        self.assertEqual(result["removed"]["expired"], 10)
+        self.assertEqual(len(store.cold_store), 10)
+        self.assertEqual(store.vector_count, 10)
+
+        query = "[user]: 旧会话内容 第3轮 关于花园"
+        for filters in ({"session_id": old}, {"until": t_mid}):
+            hits = store.search_history_index(query, top_k=3, **filters)
+            self.assertEqual(hits[0][0], f"{old}_3")
+        self.assertEqual(store.search_history_index(query, top_k=3, since=t_mid, similarity_threshold=0.5), [])
+        hits = store.search_history_index("[assistant]: 旧回答 3", top_k=2, role="assistant", until=t_mid)
+        self.assertEqual(hits[0][0], f"{old}_3")
+
+    def test_cold_hit_outranks_weaker_memory_hits(self):
+        store = self._open(dedup_threshold=0, max_vectors=200)
+        sid = store.start_session()
+        store.save_turn(sid, 1, "我家的猫叫做团子，喜欢晒太阳", "好的")
+        for t in range(2, 152):
+            store.save_turn(sid, t, f"随便聊聊 话题 {t}", f"回复 {t}")
+        store.compact()
+        self.assertGreater(len(store.cold_store), 0)
+        # 最早的一轮已移出内存索引，只在冷存储中
+        first = self._row_ids(sid, 1)
+        self.assertEqual(len(store.vector_meta.present(first)), 0)
+        self.assertTrue(store.get_vectors(first)[0].all())
+
+        # 内存索引中的向量远多于 top_k，冷存储中的强命中仍然排在最前
+        hits = store.search_history_index("[user]: 我家的猫叫做团子，喜欢晒太阳", top_k=3)
+        self.assertEqual(hits[0][0], f"{sid}_1")
+        self.assertEqual(len(hits), 3)
+
+    def test_aborted_compaction_keeps_cold_tier(self):
+        store = self._open(max_vectors=4)
+        sid = store.start_session()
+        for t in range(1, 6):
+            store.save_turn(sid, t, f"内容 {t}", f"回答 {t}")
+        rebuild_subset = ann_index.rebuild_subset
+
+        def racing_rebuild(index, keep, config=None, lock=None, **kwargs):
+            # 模拟压缩期间索引被迁移：重建完成时 store.index 已不是压缩开始时的索引
+            rebuilt = rebuild_subset(index, keep, config, lock=lock, **kwargs)
+            store.index = rebuild_subset(index, ann_index.all_ids(index), config)
+            return rebuilt
+
+        history_store.ann_index.rebuild_subset = racing_rebuild
+        try:
+            self.assertEqual(store.compact(), {})
+        finally:
+            history_store.ann_index.rebuild_subset = rebuild_subset
+        self.assertEqual(len(store.cold_store), 0)
+        self.assertEqual(store.vector_count, 10)
+
+        # 再次压缩时过期的向量只写入冷存储一次
+        result = store.compact()
+        self.assertEqual(result["removed"]["expired"], 6)
+        self.assertEqual(len(store.cold_store), 6)
+        self.assertEqual(store.vector_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
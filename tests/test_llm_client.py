@@ -0,0 +1,114 @@
+# tests/test_llm_client.py
+"""
+ApiLLMClient 的本地检查：在临时端口上启动 http.server 模拟 OpenAI 兼容接口，
+验证 503 + Retry-After 后的重试，以及 SSE 流式输出是逐段到达的 (以 [DONE] 结束)。
+
+用法:
+    python -m pytest -q tests/test_llm_client.py
+    python -m unittest tests.test_llm_client
+"""
+
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.llm_client import ApiLLMClient
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+        if payload.get("stream"):
+            self._stream(server)
+        elif count <= server.fail_first:
+            self._send_json(503, {"error": "overloaded"}, {"Retry-After": "0"})
+        else:
+            self._send_json(200, {"choices": [{"message": {"content": "ok"}}]})
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, server):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = ["He", "llo", "，世界"]
+        self._chunk(f"data: {json.dumps({'choices': [{'delta': {'content': pieces[0]}}]})}\n\n")
+        # 客户端拿到第一段之后才继续发送；如果客户端把整个响应缓冲完才返回，这里会等到超时
+        server.first_piece_seen = server.first_piece_event.wait(timeout=5)
+        for piece in pieces[1:]:
+            self._chunk(f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n")
+        self._chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class ApiLLMClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.fail_first = 0
+        self.server.first_piece_event = threading.Event()
+        self.server.first_piece_seen = None
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"
+        self.client = ApiLLMClient("test-key", url, "test-model", connect_timeout=2, read_timeout=10,
+                                   max_retries=3, backoff_base=0.01, backoff_max=0.05)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(timeout=5)
+
+    def test_retry_after_503(self):
+        self.server.fail_first = 1
+        self.assertEqual(self.client.generate("hi"), "ok")
+        self.assertEqual(self.server.requests, 2)
+
+    def test_retry_gives_up(self):
+        self.server.fail_first = 100
+        with self.assertRaises(RuntimeError):
+            self.client.generate("hi")
+        # 首次请求 + max_retries 次重试
+        self.assertEqual(self.server.requests, 4)
+
+    def test_stream_is_incremental(self):
+        stream = self.client.generate_stream("hi")
+        self.assertEqual(next(stream), "He")
+        self.server.first_piece_event.set()
+        self.assertEqual(list(stream), ["llo", "，世界"])
+        self.assertTrue(self.server.first_piece_seen)
+
+    def test_stream_via_generate(self):
+        self.server.first_piece_event.set()
+        self.assertEqual(self.client.generate("hi", stream=True), "Hello，世界")
+
+
+if __name__ == "__main__":
+    unittest.main()
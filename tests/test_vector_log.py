@@ -0,0 +1,150 @@
+# tests/test_vector_log.py
+"""
+向量日志 (VectorLog) 与 HistoryStore 启动重放的崩溃恢复检查：
+写了一半或校验失败的尾部记录在重放时被截掉，检查点之后写入的完好记录重放回索引，
+重新打开后 vector_count 与 indexed_hwm 与幸存的行一致。
+
+用法:
+    python -m pytest -q tests/test_vector_log.py
+    python -m unittest tests.test_vector_log
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from benchmarks.stub_embedder import StubEmbeddingModel
+from src.embedding_utils import EMBEDDING_CLIENT
+from src.history_store import HistoryStore
+from src.vector_log import VectorLog
+
+
+def _record_size(dim):
+    # 序号 (8) + 行 id (8) + 向量 + CRC (4)
+    return 8 + 8 + dim * 4 + 4
+
+
+class VectorLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "vectors.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_replay_after_seq(self):
+        log = VectorLog(self.path, 4)
+        vectors = np.arange(12, dtype=np.float32).reshape(3, 4)
+        self.assertEqual(log.append([10, 11, 12], vectors), [1, 2, 3])
+        log.close()
+
+        log = VectorLog(self.path, 4)
+        records = list(log.replay(after_seq=1))
+        self.assertEqual([(seq, row_id) for seq, row_id, _ in records], [(2, 11), (3, 12)])
+        np.testing.assert_array_equal(records[1][2], vectors[2])
+        # 新记录的序号接在已有记录之后
+        self.assertEqual(log.append([13], vectors[:1]), [4])
+        log.close()
+
+    def test_torn_tail_truncated(self):
+        log = VectorLog(self.path, 4)
+        log.append([1, 2], np.ones((2, 4), dtype=np.float32))
+        log.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(size - _record_size(4) // 2)
+
+        log = VectorLog(self.path, 4)
+        self.assertEqual([row_id for _, row_id, _ in log.replay()], [1])
+        self.assertEqual(os.path.getsize(self.path), size - _record_size(4))
+        self.assertEqual(log.append([3], np.ones((1, 4), dtype=np.float32)), [2])
+        log.close()
+
+    def test_crc_mismatch_truncated(self):
+        log = VectorLog(self.path, 4)
+        log.append([1, 2, 3], np.ones((3, 4), dtype=np.float32))
+        log.close()
+        size = os.path.getsize(self.path)
+        # 改坏第二条记录向量中的一个字节：它和之后的记录都被丢弃
+        with open(self.path, "r+b") as f:
+            f.seek(size - 2 * _record_size(4) + 16)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+        log = VectorLog(self.path, 4)
+        self.assertEqual([row_id for _, row_id, _ in log.replay()], [1])
+        self.assertEqual(os.path.getsize(self.path), size - 2 * _record_size(4))
+        log.close()
+
+
+class HistoryStoreRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        EMBEDDING_CLIENT.set_model(StubEmbeddingModel())
+        self.dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.dir, "history.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _open(self):
+        return HistoryStore(self.db_path, self.dir, retrieval_cache_config={"enabled": False})
+
+    @staticmethod
+    def _crash(store):
+        # 模拟进程崩溃：不写检查点，直接关闭日志和数据库连接
+        store.vector_log.close()
+        store.db.close()
+
+    def test_torn_log_recovery(self):
+        store = self._open()
+        sid = store.start_session()
+        store.save_turn(sid, 1, "我喜欢喝绿茶", "好的")
+        store.close()
+
+        # 检查点之后再写 3 轮 (6 条日志记录)，崩溃时最后一条记录只写了一半
+        store = self._open()
+        self.assertEqual(store.vector_count, 2)
+        for t in range(2, 5):
+            store.save_turn(sid, t, f"话题 {t} 天气", f"回答 {t}")
+        self.assertEqual(store.vector_log.record_count, 6)
+        log_path = store.log_path
+        self._crash(store)
+        with open(log_path, "r+b") as f:
+            f.truncate(os.path.getsize(log_path) - _record_size(store.vector_dim) // 2)
+
+        store = self._open()
+        try:
+            row_ids = [row[0] for row in store.db.connection().execute(
+                "SELECT id FROM conversation_history ORDER BY id").fetchall()]
+            self.assertEqual(len(row_ids), 8)
+            # 检查点中的 2 个向量 + 日志中完好的 5 条记录；写了一半的记录被截掉
+            self.assertEqual(store.vector_count, 7)
+            self.assertEqual(store.indexed_hwm, row_ids[-2])
+            self.assertEqual(store.vector_log.record_count, 5)
+            self.assertEqual(store.vector_meta.row_ids().tolist(), row_ids[:-1])
+
+            # 丢失的行仍在 SQLite 中，增量同步时重新索引
+            store.sync_index()
+            self.assertEqual(store.vector_count, 8)
+            self.assertEqual(store.indexed_hwm, row_ids[-1])
+            hits = store.search_history_index("[assistant]: 回答 4", top_k=1, role="assistant")
+            self.assertEqual(hits[0][0], f"{sid}_4")
+        finally:
+            store.close()
+
+        # 正常关闭写入检查点后重新打开，不再需要重放
+        store = self._open()
+        try:
+            self.assertEqual(store.vector_count, 8)
+            self.assertEqual(store.indexed_hwm, row_ids[-1])
+            self.assertEqual(store.vector_log.record_count, 0)
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()